@@ -34,6 +34,15 @@ def print_flush(msg):
     sys.stdout.flush()
 
 
+def parse_size(size):
+    """Parse a size in bytes with an optional K, M, G or T suffix"""
+    size = str(size).strip().upper()
+    units = 'KMGT'
+    if size and size[-1] in units:
+        return int(float(size[:-1]) * 1024 ** (units.index(size[-1]) + 1))
+    return int(size)
+
+
 def sort_check(keys):
     parsed_keys = list((tuple(re.split(r'-|_|\.', key)), key) for key in keys)
     keys_map = dict(parsed_keys)
@@ -15,22 +15,35 @@
 # along with this library; if not, write to the Free Software Foundation, Inc.,
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
 
+import contextlib
 from datetime import datetime
+import fcntl
 import fnmatch
+import glob
+import gzip
+import hashlib
 import itertools
 import json
+import multiprocessing
 import os
 import platform
 import re
 import shutil
+import subprocess
 import tarfile
+import threading
 import time
 import urllib.parse
 
-import requests
 from kernelci import shell_cmd, print_flush, __version__ as kernelci_version
+import kernelci.buildprof
+import kernelci.ccache
 import kernelci.elf
+import kernelci.fdt
+import kernelci.http
+import kernelci.install
 from kernelci.storage import upload_files
+from kernelci.storage.uploader import QUEUE_DIR, UploadQueue
 
 # This is used to get the mainline tags as a minimum for git describe
 TORVALDS_GIT_URL = \
@@ -50,6 +63,14 @@ MAKE_TARGETS = {
     'mips': 'uImage.gz',
 }
 
+# Compression formats for the modules tarball, with the file extension and
+# the compressor commands to use in order of preference
+MODULES_COMPRESSION = {
+    'xz': ('xz', [['xz', '-T0']]),
+    'zstd': ('zst', [['zstd', '-T0', '-q'], ['pzstd', '-q']]),
+    'gz': ('gz', [['pigz'], ['gzip']]),
+}
+
 # Hard-coded binary kernel image names for each CPU architecture
 KERNEL_IMAGE_NAMES = {
     'arm': {'zImage', 'xipImage'},
@@ -79,7 +100,7 @@ def get_last_commit(config, storage):
     last_commit_url = "{storage}/{tree}/{file_name}".format(
         storage=storage, tree=config.tree.name,
         file_name=_get_last_commit_file_name(config))
-    last_commit_resp = requests.get(last_commit_url)
+    last_commit_resp = kernelci.http.get(last_commit_url)
     if last_commit_resp.status_code != 200:
         return False
     return last_commit_resp.text.strip()
@@ -92,9 +113,15 @@ def set_last_commit(config, api, token, commit):
     *api* is the URL of the KernelCI backend API
     *token* is the backend API token to use
     *commit* is the git SHA to send
+
+    The returned value is True if the commit was uploaded, False otherwise.
     """
-    upload_files(api, token, config.tree.name,
-                 {_get_last_commit_file_name(config): commit})
+    report = upload_files(api, token, config.tree.name,
+                          {_get_last_commit_file_name(config): commit})
+    for name in report['failed']:
+        print("Failed to upload {}: {}".format(
+            name, report['files'][name]['error']))
+    return not report['failed']
 
 
 def get_branch_head(config):
@@ -332,7 +359,8 @@ def push_tarball(config, kdir, storage, api, token):
     *api* is the URL of the KernelCI backend API
     *token* is the token to use with the KernelCI backend API
 
-    The returned value is the URL of the uploaded tarball.
+    The returned value is the URL of the uploaded tarball, or None if the
+    upload failed.
     """
     tarball_name = "linux-src_{}.tar.gz".format(config.name)
     describe = git_describe(config.tree.name, kdir)
@@ -340,13 +368,18 @@ def push_tarball(config, kdir, storage, api, token):
         config.tree.name, config.branch, describe
     ]))
     tarball_url = urllib.parse.urljoin(storage, '/'.join([path, tarball_name]))
-    resp = requests.head(tarball_url)
+    resp = kernelci.http.head(tarball_url)
     if resp.status_code == 200:
         return tarball_url
     tarball = "{}.tar.gz".format(config.name)
     make_tarball(kdir, tarball)
-    upload_files(api, token, path, {tarball_name: open(tarball, 'rb')})
+    with open(tarball, 'rb') as tarball_file:
+        report = upload_files(api, token, path, {tarball_name: tarball_file})
     os.unlink(tarball)
+    if report['failed']:
+        print("Failed to upload {}: {}".format(
+            tarball_name, report['files'][tarball_name]['error']))
+        return None
     return tarball_url
 
 
@@ -354,7 +387,7 @@ def _download_file(url, dest_filename, chunk_size=1024):
     headers = {
         'User-Agent': 'kernelci {}'.format(kernelci_version),
     }
-    resp = requests.get(url, stream=True, headers=headers)
+    resp = kernelci.http.get(url, stream=True, headers=headers)
     if resp.status_code == 200:
         with open(dest_filename, 'wb') as out_file:
             for chunk in resp.iter_content(chunk_size):
@@ -448,30 +481,82 @@ def list_kernel_configs(config, kdir, single_variant=None, single_arch=None):
     return kernel_configs
 
 
+def artifact_exists(path):
+    """Check whether a text artifact exists, compressed or not
+
+    *path* is the path to the artifact file without any .gz extension
+    """
+    return os.path.exists(path) or os.path.exists(path + '.gz')
+
+
+def open_artifact(path):
+    """Open a text artifact file for reading
+
+    Text artifacts may have been compressed with gzip when installed, in
+    which case they get decompressed transparently.
+
+    *path* is the path to the artifact file without any .gz extension
+    """
+    if not os.path.exists(path) and os.path.exists(path + '.gz'):
+        return gzip.open(path + '.gz', 'rt')
+    return open(path)
+
+
 class Metadata:
     """Kernel build meta-data"""
 
-    def __init__(self, data_path, reset=False):
+    def __init__(self, data_path, reset=False, journal=False):
         """All the kernel build meta-data is read and written via this class
 
+        The meta-data is stored in bmeta.json, steps.json and artifacts.json.
+        When using the journal, changes are appended to a journal file instead
+        of rewriting these files each time the meta-data is saved.  The
+        journal gets replayed when loading the meta-data, and compacted back
+        into the JSON files with compact().  The artifacts are only loaded
+        when they are needed.
+
+        Several instances may be used concurrently with the same data path,
+        for example to run build steps in parallel in separate processes.
+        The files are only accessed with an advisory lock held, and only the
+        changes made by each instance are written: new steps, new artifacts
+        and the bmeta sections and keys which have been modified.  They get
+        merged with the data already saved by the other instances.
+
         *data_path* is the path to where the meta-data can be found
         *reset* is whether the meta-data should be reset in this step
+        *journal* is whether to save changes in the journal
         """
+        self._data_path = data_path
         self._bmeta_path = os.path.join(data_path, 'bmeta.json')
         self._steps_path = os.path.join(data_path, 'steps.json')
         self._artifacts_path = os.path.join(data_path, 'artifacts.json')
-        self._bmeta = self._load_json(self._bmeta_path, dict(), reset)
-        self._steps = self._load_json(self._steps_path, list(), reset)
-        self._artifacts = self._load_json(self._artifacts_path, dict(), reset)
-        self._artifacts_map = {
-            step: {art['path']: art for art in artifacts}
-            for step, artifacts in self._artifacts.items()
-        }
+        self._journal_path = os.path.join(data_path, 'meta.journal')
+        self._journal = journal
+        self._pending = list()
+        self._artifacts = None
+        self._artifacts_map = None
+        self._artifacts_keys = None
+        self._artifacts_events = list()
+        with self._lock():
+            if reset:
+                for path in (self._artifacts_path, self._journal_path):
+                    if os.path.exists(path):
+                        os.unlink(path)
+            self._bmeta = self._load_json(self._bmeta_path, dict(), reset)
+            self._steps = self._load_json(self._steps_path, list(), reset)
+            for record in self._read_journal():
+                self._apply_record(
+                    record, self._bmeta, self._steps,
+                    self._apply_artifacts_event)
         self._data = {
             'bmeta': self._bmeta,
             'steps': self._steps,
-            'artifacts': self._artifacts,
         }
+        self._bmeta_saved = self._get_bmeta_sections()
+        self._duration = sum(s['duration'] for s in self._steps)
+        self._all_status = set(s['status'] for s in self._steps)
+        if self._steps:
+            self._update_build()
 
     @property
     def bmeta_path(self):
@@ -488,33 +573,239 @@ class Metadata:
         """Path to artifacts.json"""
         return self._artifacts_path
 
+    @contextlib.contextmanager
+    def _lock(self):
+        if not os.path.isdir(self._data_path):
+            yield
+            return
+        # The lock is on the directory itself so no extra file gets created
+        fd = os.open(self._data_path, os.O_RDONLY)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            yield
+        finally:
+            os.close(fd)
+
     def _load_json(self, json_path, default, reset):
         data = default
-        if os.path.exists(json_path):
-            if reset:
+        if reset:
+            if os.path.exists(json_path):
                 os.unlink(json_path)
-            else:
-                with open(json_path) as json_file:
-                    data = json.load(json_file)
+        elif artifact_exists(json_path):
+            with open_artifact(json_path) as json_file:
+                data = json.load(json_file)
         return data
 
+    def _save_json(self, json_path, data):
+        tmp_path = '.'.join([json_path, 'tmp'])
+        with open(tmp_path, 'w') as json_file:
+            json.dump(data, json_file, indent=4, sort_keys=True)
+        os.replace(tmp_path, json_path)
+
+    def _index_artifacts(self):
+        self._artifacts_map = {
+            step: {art['path']: art for art in artifacts}
+            for step, artifacts in self._artifacts.items()
+        }
+        self._artifacts_keys = {
+            step: {art['key']: art for art in artifacts if 'key' in art}
+            for step, artifacts in self._artifacts.items()
+        }
+
+    def _load_artifacts(self):
+        if self._artifacts is None:
+            with self._lock():
+                self._artifacts = self._load_json(
+                    self._artifacts_path, dict(), False)
+            self._index_artifacts()
+            self._data['artifacts'] = self._artifacts
+            for event in self._artifacts_events:
+                self._apply_artifacts_event(*event)
+            self._artifacts_events = list()
+        return self._artifacts
+
+    def _apply_artifacts_event(self, step_name, entry=None):
+        if self._artifacts is None:
+            self._artifacts_events.append((step_name, entry))
+        elif entry is None:
+            self._artifacts[step_name] = list()
+            self._artifacts_map[step_name] = dict()
+            self._artifacts_keys[step_name] = dict()
+        else:
+            paths = self._artifacts_map.setdefault(step_name, dict())
+            keys = self._artifacts_keys.setdefault(step_name, dict())
+            existing = paths.get(entry['path'])
+            if existing is None:
+                paths[entry['path']] = entry
+                self._artifacts.setdefault(step_name, list()).append(entry)
+            elif existing is not entry:
+                keys.pop(existing.get('key'), None)
+                existing.clear()
+                existing.update(entry)
+                entry = existing
+            if 'key' in entry:
+                keys[entry['key']] = entry
+
+    @classmethod
+    def _apply_record(cls, record, bmeta, steps, apply_artifacts):
+        if 'bmeta' in record:
+            bmeta.update(record['bmeta'])
+        elif 'bmeta_merge' in record:
+            for section, values in record['bmeta_merge'].items():
+                if isinstance(bmeta.get(section), dict):
+                    bmeta[section].update(values)
+                else:
+                    bmeta[section] = dict(values)
+        elif 'step' in record:
+            steps.append(record['step'])
+        elif 'clear' in record:
+            apply_artifacts(record['clear'])
+        elif 'artifact' in record:
+            apply_artifacts(*record['artifact'])
+
+    def _read_journal(self):
+        if not os.path.exists(self._journal_path):
+            return
+        with open(self._journal_path) as journal:
+            for line in journal:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue  # incomplete record from an interrupted write
+                yield record
+
+    def _get_bmeta_sections(self):
+        return {
+            key: json.dumps(value, sort_keys=True)
+            for key, value in self._bmeta.items()
+            if key != 'build'
+        }
+
+    def _get_bmeta_records(self, sections):
+        replaced, merged = dict(), dict()
+        for section, value in sections.items():
+            saved = self._bmeta_saved.get(section)
+            if saved == value:
+                continue
+            old, new = json.loads(saved or 'null'), self._bmeta[section]
+            if old is None and isinstance(new, dict):
+                # Merge new sections as other writers may have added them
+                old = dict()
+            if isinstance(old, dict) and isinstance(new, dict) and \
+                    set(old.keys()).issubset(new.keys()):
+                merged[section] = {
+                    key: new[key] for key in new
+                    if key not in old or json.dumps(
+                        old[key], sort_keys=True) != json.dumps(
+                            new[key], sort_keys=True)
+                }
+            else:
+                replaced[section] = new
+        records = []
+        if replaced:
+            records.append({'bmeta': replaced})
+        if merged:
+            records.append({'bmeta_merge': merged})
+        return records
+
+    def _record(self, record):
+        self._pending.append(record)
+
+    def _take_records(self):
+        sections = self._get_bmeta_sections()
+        records = self._get_bmeta_records(sections) + self._pending
+        self._pending = list()
+        self._bmeta_saved = sections
+        return records
+
+    def _flush(self):
+        records = self._take_records()
+        if not records:
+            return
+        with self._lock(), open(self._journal_path, 'a+') as journal:
+            data = ''.join(json.dumps(record) + '\n' for record in records)
+            if journal.tell():
+                journal.seek(journal.tell() - 1)
+                if journal.read(1) != '\n':
+                    data = '\n' + data  # after an interrupted write
+            journal.write(data)
+            journal.flush()
+            os.fsync(journal.fileno())
+
+    def _merge(self):
+        records = self._take_records()
+        bmeta = self._load_json(self._bmeta_path, dict(), False)
+        steps = self._load_json(self._steps_path, list(), False)
+        artifacts = {
+            step: {art['path']: art for art in arts}
+            for step, arts in self._load_json(
+                self._artifacts_path, dict(), False).items()
+        }
+
+        def apply_artifacts(step_name, entry=None):
+            if entry is None:
+                artifacts[step_name] = dict()
+            else:
+                artifacts.setdefault(step_name, dict())[entry['path']] = entry
+
+        for record in itertools.chain(self._read_journal(), records):
+            self._apply_record(record, bmeta, steps, apply_artifacts)
+
+        self._steps[:] = steps
+        self._duration = sum(s['duration'] for s in steps)
+        self._all_status = set(s['status'] for s in steps)
+        self._bmeta.clear()
+        self._bmeta.update(bmeta)
+        if steps:
+            self._update_build()
+        self._bmeta_saved = self._get_bmeta_sections()
+        if self._artifacts is None:
+            self._artifacts = dict()
+            self._data['artifacts'] = self._artifacts
+            self._artifacts_events = list()
+        self._artifacts.clear()
+        self._artifacts.update({
+            step: list(arts.values()) for step, arts in artifacts.items()
+        })
+        self._index_artifacts()
+
     def save(self, save_artifacts=True):
         """Save all the meta-data
 
-        *save_artifacts* is to tell whether artifacts.json should also be saved
+        With the journal, all the pending changes are appended to it and
+        synchronised to disk in one go.  Otherwise, the changes are merged
+        with the meta-data saved on disk and the JSON files are rewritten.
+
+        *save_artifacts* is only kept for compatibility, artifacts.json is
+                         always saved with the other files to keep them
+                         consistent
         """
-        with open(self._bmeta_path, 'w') as json_file:
-            json.dump(self._bmeta, json_file, indent=4, sort_keys=True)
-        with open(self._steps_path, 'w') as json_file:
-            json.dump(self._steps, json_file, indent=4, sort_keys=True)
-        if save_artifacts:
-            self.save_artifacts()
+        if self._journal:
+            self._flush()
+        else:
+            self.compact()
 
     def save_artifacts(self):
         """Save artifacts.json"""
-        artifacts = {step: art for step, art in self._artifacts.items() if art}
-        with open(self._artifacts_path, 'w') as json_file:
-            json.dump(artifacts, json_file, indent=4, sort_keys=True)
+        self.save()
+
+    def compact(self):
+        """Save all the meta-data in the JSON files and remove the journal
+
+        The meta-data saved on disk is merged with any pending changes and
+        each JSON file is replaced atomically, so they can always be read
+        safely.  The meta-data from this object is then updated with the
+        merged result.
+        """
+        with self._lock():
+            self._merge()
+            self._save_json(self._bmeta_path, self._bmeta)
+            self._save_json(self._steps_path, self._steps)
+            self._save_json(self._artifacts_path, {
+                step: art for step, art in self._artifacts.items() if art
+            })
+            if os.path.exists(self._journal_path):
+                os.unlink(self._journal_path)
 
     def get(self, *keys):
         """Find some meta-data value
@@ -527,6 +818,8 @@ class Metadata:
 
         *keys* is an arbitary number of keys to look up the meta-data
         """
+        if len(keys) == 0 or keys[0] == 'artifacts':
+            self._load_artifacts()
         if len(keys) == 0:
             return self._data
         if len(keys) == 1:
@@ -544,11 +837,15 @@ class Metadata:
         *data* is the data for the step, following the schema
         """
         self._steps.append(data)
-        total_duration = sum(s['duration'] for s in self._steps)
-        all_status = set(s['status'] for s in self._steps)
+        self._record({'step': data})
+        self._duration += data['duration']
+        self._all_status.add(data['status'])
+        self._update_build()
+
+    def _update_build(self):
         self._bmeta['build'] = {
-            'duration': total_duration,
-            'status': 'PASS' if all_status == {'PASS'} else 'FAIL'
+            'duration': self._duration,
+            'status': 'PASS' if self._all_status == {'PASS'} else 'FAIL'
         }
 
     def clear_artifacts(self, step_name):
@@ -557,10 +854,12 @@ class Metadata:
         *step_name* is the name of the step for which artifact entries should
                     be removed from the meta-data
         """
-        self._artifacts[step_name] = dict()
+        self._apply_artifacts_event(step_name)
+        self._record({'clear': step_name})
 
     def _add_artifact(self, step_name, artifact_type, artifact_path,
-                      contents=None, key=None):
+                      contents=None, key=None, attrs=None):
+        self._load_artifacts()
         artifacts = self._artifacts_map.setdefault(step_name, dict())
         entry = artifacts.get(artifact_path)
         if entry is None:
@@ -572,15 +871,21 @@ class Metadata:
                 entry['key'] = key
             if contents:
                 entry['contents'] = list(sorted(set(contents)))
-            artifacts[artifact_path] = entry
+            if attrs:
+                entry.update(attrs)
+            self._apply_artifacts_event(step_name, entry)
+            self._record({'artifact': [step_name, entry]})
         elif entry['type'] != artifact_type:
             raise ValueError("Conflicting artifact types")
         elif entry.get('key') != key:
             raise ValueError("Conflicting artifact keys")
-        self._artifacts[step_name] = list(artifacts.values())
+        elif attrs and any(entry.get(k) != v for k, v in attrs.items()):
+            entry.update(attrs)
+            self._record({'artifact': [step_name, entry]})
         return entry
 
-    def add_artifact(self, step_name, directory, file_name, key=None):
+    def add_artifact(self, step_name, directory, file_name, key=None,
+                     attrs=None):
         """Add meta-data for a single artifact file
 
         Add a meta-data entry for a single file located in a given directory.
@@ -591,12 +896,14 @@ class Metadata:
         *directory* is the directory where the file is
         *file_name* is the name of the file within that directory
         *key* is an optional key attribute to retrieve the artifact
+        *attrs* is an optional dictionary with extra attributes such as the
+                'size' and 'sha256' checksum of the file
         """
         path = os.path.join(directory, file_name)
-        return self._add_artifact(step_name, 'file', path, None, key)
+        return self._add_artifact(step_name, 'file', path, None, key, attrs)
 
     def add_artifact_contents(self, step_name, artifact_type, path,
-                              contents, key=None):
+                              contents, key=None, attrs=None):
         """Add meta-data for artifacts with file contents
 
         Add a meta-data entry for an artifact with a list of files as its
@@ -611,9 +918,11 @@ class Metadata:
         *contents* is a list of file names contained in the directory or
                    tarball
         *key* is an optional key attribute to retrieve the artifact
+        *attrs* is an optional dictionary with extra attributes such as the
+                'size' and 'sha256' checksum of a tarball
         """
         return self._add_artifact(
-            step_name, artifact_type, path, contents, key)
+            step_name, artifact_type, path, contents, key, attrs)
 
     def get_single_artifact(self, step_name, key=None, attr=None):
         """Get meta-data for a single artifact
@@ -629,18 +938,295 @@ class Metadata:
         artifacts = self.get('artifacts', step_name)
         if artifacts:
             if key:
-                artifacts_map = {art['key']: art for art in artifacts}
-                artifact = artifacts_map.get(key)
+                artifact = self._artifacts_keys.get(step_name, {}).get(key)
             else:
                 artifact = artifacts[0]
             return artifact.get(attr) if attr and artifact else artifact
         return None
 
+    def get_checksums(self):
+        """Get the checksums of all the installed artifact files
+
+        Return a dictionary with the path of each file relative to the
+        install directory and its SHA-256 checksum, as computed when the
+        files were installed.  This includes the files in directory
+        artifacts such as dtbs, but not the contents of tarballs.
+        """
+        checksums = dict()
+        for artifacts in (self.get('artifacts') or {}).values():
+            for artifact in artifacts:
+                path = artifact['path']
+                if 'sha256' in artifact:
+                    checksums[path] = artifact['sha256']
+                if artifact['type'] == 'directory':
+                    for name, sha256 in artifact.get(
+                            'contents_sha256', {}).items():
+                        checksums[os.path.join(path, name)] = sha256
+        return checksums
+
+
+class OutputCache:
+    """Cache of kernel build output directories"""
+
+    # Files and directories in the output directory which are specific to
+    # each build and never cached
+    EXCLUDE = {
+        '_install_',
+        '_modules_',
+        'artifacts.json',
+        'bmeta.json',
+        'meta.journal',
+        'steps.json',
+        kernelci.buildprof.PROFILE_LOG,
+        QUEUE_DIR,
+    }
+
+    def __init__(self, path):
+        """Save and restore build output directories for incremental builds
+
+        The output directory of a build can be saved in the cache and then
+        restored before building a subsequent revision with the same
+        parameters, so only the objects affected by the changes need to be
+        rebuilt.  Files are copied with reflinks when supported by the file
+        system, to avoid copying all the data.  Otherwise, `cp --reflink=auto`
+        silently makes full copies which take as much space and time as the
+        output directory itself.  Hard links can't be used as Kbuild and the
+        compiler may rewrite output files in place.
+
+        *path* is the path to the cache directory
+        """
+        self._path = path
+
+    @classmethod
+    def get_key(cls, bmeta):
+        """Get the cache key for a given build
+
+        The key is based on the kernel tree, branch, CPU architecture,
+        defconfig and build environment.  Return None if any of them is
+        missing from the meta-data.
+
+        *bmeta* is the build meta-data dictionary
+        """
+        rev, env, kernel = (
+            bmeta.get(cat) or dict()
+            for cat in ('revision', 'environment', 'kernel')
+        )
+        params = [
+            rev.get('tree'), rev.get('branch'), env.get('arch'),
+            kernel.get('defconfig_full'), env.get('name'),
+        ]
+        if not all(params):
+            return None
+        return hashlib.sha256('\n'.join(params).encode()).hexdigest()
+
+    def _copy(self, src, dst):
+        items = list(
+            os.path.join(src, item) for item in os.listdir(src)
+            if item not in self.EXCLUDE and not item.endswith('.log')
+        )
+        if not items:
+            return True
+        return shell_cmd("cp -a --reflink=auto {} {}".format(
+            ' '.join("'{}'".format(item) for item in items), dst), True)
+
+    def restore(self, key, output_path):
+        """Restore a cached output directory
+
+        Return True if a cached output directory was restored, or False if
+        there was none for the given key.
+
+        *key* is the cache key as returned by get_key()
+        *output_path* is the path to the build output directory
+        """
+        cache_path = os.path.join(self._path, key)
+        if not os.path.isdir(cache_path):
+            return False
+        return self._copy(cache_path, output_path)
+
+    def save(self, key, output_path):
+        """Save an output directory in the cache
+
+        Any previously cached output directory with the same key gets
+        replaced.
+
+        *key* is the cache key as returned by get_key()
+        *output_path* is the path to the build output directory
+        """
+        cache_path = os.path.join(self._path, key)
+        tmp_path = '.'.join([cache_path, 'tmp'])
+        old_path = '.'.join([cache_path, 'old'])
+        for path in (tmp_path, old_path):
+            shutil.rmtree(path, ignore_errors=True)
+        os.makedirs(tmp_path)
+        if not self._copy(output_path, tmp_path):
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            return False
+        if os.path.exists(cache_path):
+            os.rename(cache_path, old_path)
+        os.rename(tmp_path, cache_path)
+        shutil.rmtree(old_path, ignore_errors=True)
+        return True
+
+
+class ConfigCache:
+    """Cache of kernel config files"""
+
+    def __init__(self, path):
+        """Save and restore kernel config files to skip making them
+
+        Config files are stored with a key based on all the inputs which can
+        affect the result of making the kernel config: the Kconfig files, the
+        kconfig scripts, defconfigs and fragments from the source tree and
+        the KernelCI fragment as well as the compiler and binutils versions
+        and the make options.
+
+        *path* is the path to the cache directory
+        """
+        self._path = path
+
+    # Kernel architecture names with a different source directory name
+    SRCARCH = {
+        'i386': 'x86',
+        'x86_64': 'x86',
+        'sparc32': 'sparc',
+        'sparc64': 'sparc',
+        'parisc64': 'parisc',
+        'sh64': 'sh',
+    }
+
+    # Kconfig statements to include other Kconfig files
+    SOURCE = re.compile(r'^\s*(o?r?source)\s+"([^"]+)"', re.MULTILINE)
+
+    # Kconfig variables in file paths, with or without parentheses
+    VARIABLE = re.compile(r'\$\((\w+)\)|\$(\w+)')
+
+    @classmethod
+    def _get_kconfig_files(cls, kdir, srcarch):
+        """Follow the source statements from the top-level Kconfig file"""
+        variables = {'SRCARCH': srcarch}
+        found, todo = set(), ['Kconfig']
+        while todo:
+            rel_path = todo.pop()
+            file_path = os.path.join(kdir, rel_path)
+            if rel_path in found or not os.path.isfile(file_path):
+                continue
+            found.add(rel_path)
+            with open(file_path, errors='replace') as kconfig:
+                sources = cls.SOURCE.findall(kconfig.read())
+            for statement, pattern in sources:
+                pattern = cls.VARIABLE.sub(
+                    lambda m: variables.get(m.group(1) or m.group(2), '*'),
+                    pattern)
+                if 'r' in statement:
+                    pattern = os.path.join(os.path.dirname(rel_path), pattern)
+                todo.extend(
+                    os.path.relpath(path, kdir)
+                    for path in glob.glob(os.path.join(kdir, pattern))
+                )
+        return found
+
+    @classmethod
+    def _get_inputs(cls, kdir, srcarch):
+        inputs = cls._get_kconfig_files(kdir, srcarch)
+        inputs.update(['Makefile', os.path.join('arch', srcarch, 'Makefile')])
+        for dir_name in [os.path.join('arch', srcarch, 'configs'),
+                         os.path.join('kernel', 'configs'),
+                         os.path.join('scripts', 'kconfig')]:
+            for root, dirs, files in os.walk(os.path.join(kdir, dir_name)):
+                inputs.update(
+                    os.path.relpath(os.path.join(root, file_name), kdir)
+                    for file_name in files
+                )
+        inputs.update(
+            os.path.relpath(path, kdir)
+            for path in glob.glob(os.path.join(kdir, 'scripts', '*.sh'))
+        )
+        return sorted(inputs)
+
+    @classmethod
+    def _get_binutils_version(cls, cross_compile):
+        cmd = ["{}ld".format(cross_compile or ''), '--version']
+        try:
+            output = subprocess.check_output(cmd, stderr=subprocess.DEVNULL)
+        except (OSError, subprocess.CalledProcessError):
+            return None
+        lines = output.decode(errors='replace').splitlines()
+        return lines[0] if lines else None
+
+    @classmethod
+    def get_key(cls, kdir, bmeta, frag_path=None):
+        """Get the cache key for a given kernel config
+
+        Only the files which can affect the result of making the config are
+        read: the Kconfig files found by following the source statements
+        from the top-level one, the main Makefiles, the kconfig scripts and
+        the defconfigs and fragments from the source tree.  The whole source
+        tree is not scanned, to keep this much faster than making the config.
+
+        *kdir* is the path to the kernel source directory
+        *bmeta* is the build meta-data dictionary
+        *frag_path* is the path to the KernelCI config fragment if any
+        """
+        env, kernel = (bmeta[cat] for cat in ('environment', 'kernel'))
+        params = {
+            'defconfig': kernel['defconfig_expanded'],
+            'environment': {
+                key: env[key] for key in [
+                    'arch', 'compiler', 'compiler_version_full',
+                    'cross_compile', 'cross_compile_compat', 'make_opts',
+                ]
+            },
+            'binutils': cls._get_binutils_version(env['cross_compile']),
+        }
+        digest = hashlib.sha256(json.dumps(params, sort_keys=True).encode())
+        srcarch = cls.SRCARCH.get(env['arch'], env['arch'])
+        for rel_path in cls._get_inputs(kdir, srcarch):
+            file_path = os.path.join(kdir, rel_path)
+            if not os.path.isfile(file_path):
+                continue
+            digest.update(rel_path.encode())
+            with open(file_path, 'rb') as input_file:
+                digest.update(input_file.read())
+        if frag_path:
+            with open(frag_path, 'rb') as frag:
+                digest.update(frag.read())
+        return digest.hexdigest()
+
+    def restore(self, key, dot_config):
+        """Restore a cached config file
+
+        Return True if a cached config file was restored, or False if there
+        was none for the given key.
+
+        *key* is the cache key as returned by get_key()
+        *dot_config* is the path to the kernel .config file to restore
+        """
+        cached = os.path.join(self._path, '.'.join([key, 'config']))
+        if not os.path.exists(cached):
+            return False
+        shutil.copyfile(cached, dot_config)
+        return True
+
+    def save(self, key, dot_config):
+        """Save a config file in the cache
+
+        *key* is the cache key as returned by get_key()
+        *dot_config* is the path to the kernel .config file to save
+        """
+        if not os.path.exists(self._path):
+            os.makedirs(self._path)
+        cached = os.path.join(self._path, '.'.join([key, 'config']))
+        tmp = '.'.join([cached, str(os.getpid())])
+        shutil.copyfile(dot_config, tmp)
+        os.replace(tmp, cached)
+
 
 class Step:
     """Kernel build step"""
 
-    def __init__(self, kdir, output_path=None, log=None, reset=False):
+    def __init__(self, kdir, output_path=None, log=None, reset=False,
+                 ccache_url=None, install_mode=None, compress_text=False,
+                 upload_queue=False, install_checksums=True):
         """Each Step deals with a part of the build and its related meta-data
 
         This abstract class handles the common code to run any kernel build
@@ -657,20 +1243,45 @@ class Step:
         *log* is the name of the log file within the output directory, or in
               the format step-name.log where step-name is the Step.name value.
         *reset* is whether the meta-data should be reset in this step
+        *ccache_url* is the URL of a remote compiler cache, or None to use a
+                     local ccache directory
+        *install_mode* is how to install the artifacts, see
+                       kernelci.install.INSTALL_MODES
+        *compress_text* is whether to compress text artifacts such as logs
+                        with gzip when installing them
+        *upload_queue* is whether to add the installed artifacts to the
+                       upload queue, see kernelci.storage.uploader
+        *install_checksums* is whether to compute the checksums of artifacts
+                            installed without copying them
         """
         self._kdir = kdir
+        self._ccache_url = ccache_url
+        self._installer = kernelci.install.Installer(
+            install_mode, install_checksums)
+        self._compress_text = compress_text
+        self._upload_queue = upload_queue
+        self._installed = dict()
         self._output_path = output_path or self.get_default_output_path(kdir)
         if not os.path.exists(self._output_path):
             os.mkdir(self._output_path)
         self._install_path = self.get_install_path(kdir, self._output_path)
         self._create_install_dir(reset)
-        self._meta = Metadata(self._output_path, reset)
+        self._meta = Metadata(self._output_path, reset, journal=True)
         self._meta.clear_artifacts(self.name)
         self._log_file = '.'.join([self.name, 'log']) if log is None else log
         self._log_path = os.path.join(self._output_path, self._log_file)
+        self._profile_path = os.path.join(
+            self._output_path, kernelci.buildprof.PROFILE_LOG)
+        if reset and os.path.exists(self._profile_path):
+            os.unlink(self._profile_path)
+        if reset:
+            shutil.rmtree(UploadQueue.get_path(self._output_path),
+                          ignore_errors=True)
         if log is None and os.path.exists(self._log_path):
             os.unlink(self._log_path)
         self._dot_config = None
+        self._ccache_stats = None
+        self._objects_since = None
         self._start_time = time.time()
 
     @property
@@ -743,7 +1354,25 @@ class Step:
         if jopt is not None:
             run_data['threads'] = str(jopt)
         if self._log_path and os.path.exists(self._log_path):
-            run_data['log_file'] = self._log_file
+            run_data['log_file'] = self._get_install_name(
+                self._log_file, text=True)
+        if self._ccache_stats:
+            run_data['ccache'] = self._ccache_stats
+            kernelci.ccache.add_stats(
+                self._meta.get('bmeta').setdefault('ccache', dict()),
+                self._ccache_stats)
+            self._ccache_stats = None
+        if self._objects_since is not None:
+            objects_rebuilt = self._count_objects(self._objects_since)
+            run_data['objects_rebuilt'] = objects_rebuilt
+            cache = self._meta.get('bmeta', 'kernel', 'output_cache')
+            cache['objects_rebuilt'] = \
+                cache.get('objects_rebuilt', 0) + objects_rebuilt
+            self._objects_since = None
+        install_stats = self._installer.stats
+        if install_stats['files']:
+            run_data['install'] = install_stats
+            self._installer.reset()
         run_data['status'] = "PASS" if status is True else "FAIL"
         self._meta.add_step(run_data)
         self._meta.save(save_artifacts=False)
@@ -762,12 +1391,37 @@ class Step:
                 cpus[cpu] = ncpus + 1
         return cpus
 
+    def _get_artifact_attrs(self, path, contents=None):
+        installed = self._installed.get(path)
+        if installed:
+            return {
+                key: value for key, value in installed.items()
+                if key != 'method'
+            }
+        if not contents:
+            return None
+        files = {
+            name: self._installed.get(os.path.join(path, name))
+            for name in contents
+        }
+        if not all(files.values()):
+            return None
+        attrs = {'size': sum(item['size'] for item in files.values())}
+        if all('sha256' in item for item in files.values()):
+            attrs['contents_sha256'] = {
+                name: item['sha256'] for name, item in files.items()
+            }
+        return attrs
+
     def _add_artifact(self, directory, file_name, key=None):
-        return self._meta.add_artifact(self.name, directory, file_name, key)
+        attrs = self._get_artifact_attrs(os.path.join(directory, file_name))
+        return self._meta.add_artifact(
+            self.name, directory, file_name, key, attrs)
 
     def _add_artifact_contents(self, artifact_type, path, contents, key=None):
+        attrs = self._get_artifact_attrs(path, contents)
         return self._meta.add_artifact_contents(
-            self.name, artifact_type, path, contents, key)
+            self.name, artifact_type, path, contents, key, attrs)
 
     def _kernel_config_enabled(self, config_name):
         dot_config = os.path.join(self._output_path, '.config')
@@ -812,13 +1466,22 @@ class Step:
         if cross_compile_compat:
             make_opts['CROSS_COMPILE_COMPAT'] = cross_compile_compat
 
+        px = cross_compile if cc == 'gcc' and cross_compile else ''
+        cc_cmd = None
         if env['use_ccache']:
-            px = cross_compile if cc == 'gcc' and cross_compile else ''
-            make_opts['CC'] = '"ccache {}{}"'.format(px, cc)
-            ccache_dir = '-'.join(['.ccache', arch, cc])
-            os.environ.setdefault('CCACHE_DIR', ccache_dir)
+            cc_cmd = 'ccache {}{}'.format(px, cc)
+            backend = kernelci.ccache.get_backend(arch, cc, self._ccache_url)
+            for key, value in backend.get_env().items():
+                os.environ.setdefault(key, value)
         elif cc != 'gcc':
-            make_opts['CC'] = cc
+            cc_cmd = cc
+
+        if env.get('build_profile'):
+            cc_cmd = kernelci.buildprof.get_wrapper(
+                self._profile_path, cc_cmd or ''.join([px, cc]))
+
+        if cc_cmd:
+            make_opts['CC'] = '"{}"'.format(cc_cmd)
 
         if self._output_path and (self._output_path != make_path):
             # due to kselftest Makefile issues, O= cannot be a relative path
@@ -826,6 +1489,20 @@ class Step:
 
         return make_opts
 
+    def _count_objects(self, since):
+        count = 0
+        for root, dirs, files in os.walk(self._output_path):
+            if root == self._output_path:
+                dirs[:] = list(d for d in dirs if d not in OutputCache.EXCLUDE)
+            # Kbuild creates and removes a dependency file next to each
+            # object it builds, so other directories can be skipped
+            if os.stat(root).st_mtime < since:
+                continue
+            for obj in (f for f in files if f.endswith('.o')):
+                if os.stat(os.path.join(root, obj)).st_mtime >= since:
+                    count += 1
+        return count
+
     def _make(self, target, jopt=None, verbose=False, opts=None, subdir=None):
         make_path = os.path.join(self._kdir, subdir) if subdir else self._kdir
         make_opts = self._get_make_opts(opts, make_path)
@@ -849,18 +1526,50 @@ class Step:
         print_flush(cmd)
         if self._log_path:
             cmd = self._output_to_file(cmd, self._log_path)
-        return shell_cmd(cmd, True)
 
-    def _install_file(self, path, dest_dir='', dest_name=None, verbose=False):
+        use_ccache = self._meta.get('bmeta', 'environment', 'use_ccache')
+        ccache_before = kernelci.ccache.get_stats() if use_ccache else None
+        if self._objects_since is None and self._meta.get(
+                'bmeta', 'kernel', 'output_cache', 'restored'):
+            # Objects are counted once for the whole step
+            self._objects_since = time.time()
+        res = shell_cmd(cmd, True)
+        if ccache_before:
+            ccache_after = kernelci.ccache.get_stats()
+            if ccache_after:
+                self._ccache_stats = kernelci.ccache.add_stats(
+                    self._ccache_stats or dict(),
+                    kernelci.ccache.diff_stats(ccache_before, ccache_after))
+        return res
+
+    def _get_install_name(self, file_name, text=False):
+        if text and self._compress_text:
+            return file_name + '.gz'
+        return file_name
+
+    def _install_file(self, path, dest_dir='', dest_name=None, verbose=False,
+                      text=False):
         install_dir = os.path.join(self._install_path, dest_dir)
         if not dest_name:
             dest_name = os.path.basename(path)
+        compress = text and self._compress_text
+        # Remove any file left from an install with the other encoding
+        stale_name = dest_name if compress else dest_name + '.gz'
+        dest_name = self._get_install_name(dest_name, text)
         install_path = os.path.join(install_dir, dest_name)
         if verbose:
             print("Installing {}".format(install_path))
         if not os.path.exists(install_dir):
             os.makedirs(install_dir)
-        shutil.copy(path, install_path)
+        stale_path = os.path.join(install_dir, stale_name)
+        if text and os.path.lexists(stale_path):
+            os.unlink(stale_path)
+        if compress:
+            installed = self._installer.install_gzip(path, install_path)
+            installed['encoding'] = 'gzip'
+        else:
+            installed = self._installer.install(path, install_path)
+        self._installed[os.path.join(dest_dir, dest_name)] = installed
         return dest_name
 
     def is_enabled(self):
@@ -879,26 +1588,43 @@ class Step:
     def install(self, verbose=False, status=True):
         """Base method to install the build artifacts.
 
-        The default behaviour is to install bmeta.json and steps.json in the
-        output install directory.  Sub-classes should call this parent method
-        to have them installed too.
+        The default behaviour is to install the log files as well as
+        bmeta.json, steps.json and artifacts.json in the output install
+        directory, after compacting the meta-data journal.  Sub-classes should
+        call this parent method to have them installed too.  All the installed
+        files are then added to the upload queue if enabled, except the
+        meta-data files which are only uploaded at the end.
 
         *verbose* is whether to show what is being installed
         *status* is True if install commands succeeded, False otherwise
         """
+        if verbose:
+            stats = self._installer.stats
+            print("Installed {} files, {} bytes, {} bytes copied".format(
+                stats['files'], stats['bytes'], stats['bytes_copied']))
         self._add_run_step(status, action='install')
-        files = [
-            (self._meta.bmeta_path, '', ''),
-            (self._meta.steps_path, '', ''),
-            (self._log_path, 'logs', 'log'),
+        logs = [
+            (self._log_path, 'log'),
+            (self._profile_path, 'build_profile'),
         ]
-        for file_name, dest_dir, key in files:
+        for file_name, key in logs:
             if os.path.exists(file_name):
-                item = self._install_file(file_name, dest_dir, verbose=verbose)
-                if dest_dir:
-                    self._add_artifact(dest_dir, item, key)
-        self._meta.save_artifacts()
-        self._install_file(self._meta.artifacts_path, verbose=verbose)
+                item = self._install_file(
+                    file_name, 'logs', verbose=verbose, text=True)
+                self._add_artifact('logs', item, key)
+        self._meta.compact()
+        for file_name in [self._meta.bmeta_path, self._meta.steps_path,
+                          self._meta.artifacts_path]:
+            self._install_file(file_name, verbose=verbose, text=True)
+        publish_path = self._meta.get('bmeta', 'kernel', 'publish_path')
+        if self._upload_queue and publish_path:
+            queue = UploadQueue(self._output_path)
+            queue.create()
+            queue.add(publish_path, list(self._installed), {
+                path: installed['sha256']
+                for path, installed in self._installed.items()
+                if 'sha256' in installed
+            })
         return status
 
 
@@ -961,6 +1687,10 @@ class EnvironmentData(Step):
         Required options in *opts*:
         *build_env* is a BuildEnvironment object
         *arch* is the CPU architecture name e.g. x86_64, arm64, riscv...
+
+        Other options:
+        *build_profile* is whether to record the compile time of each object
+                        file in a profile log
         """
         keys = ('build_env', 'arch')
         if not self._check_opts(opts, keys):
@@ -988,6 +1718,7 @@ class EnvironmentData(Step):
             'platform': platform_data,
             'use_ccache': shell_cmd("which ccache > /dev/null", True),
             'make_opts': make_opts,
+            'build_profile': bool(opts.get('build_profile')),
         }
         return self._add_run_step(True)
 
@@ -1092,22 +1823,27 @@ scripts/kconfig/merge_config.sh -O {output} '{base}' '{frag}' {redir}
         Required options in *opts*:
         *defconfig* is the defconfig name, e.g. defconfig, x86_64_defconfig...
         *frags_config* is a dict with the Fragment configuration objects
+
+        Other options:
+        *output_cache* is the path to an OutputCache directory to restore the
+                       output of a previous build with the same parameters
+        *config_cache* is the path to a ConfigCache directory to reuse a
+                       config file made previously with the same inputs
         """
         keys = ('defconfig', 'frags_config')
         if not self._check_opts(opts, keys):
             return False
 
         defconfig, frags_config = (opts[key] for key in keys)
+        output_cache, config_cache = (
+            opts.get(key) for key in ('output_cache', 'config_cache')
+        )
         defconfig_expanded = self._expand_defconfig(defconfig, frags_config)
         elements = defconfig_expanded.split('+')
         target = elements.pop(0)
         kci_frag_name = None
         opts, configs, fragments, extras = self._parse_elements(elements)
 
-        if configs or fragments:
-            kci_frag_name = 'kernelci.config'
-            self._gen_kci_frag(configs, fragments, kci_frag_name)
-
         bmeta = self._meta.get('bmeta')
         rev, env = (bmeta[cat] for cat in ('revision', 'environment'))
         publish_path = '/'.join(item.replace('/', '-') for item in [
@@ -1129,6 +1865,36 @@ scripts/kconfig/merge_config.sh -O {output} '{base}' '{frag}' {redir}
             'publish_path': publish_path,
         }
 
+        if output_cache:
+            cache = OutputCache(output_cache)
+            key = cache.get_key(bmeta)
+            bmeta['kernel']['output_cache'] = {
+                'key': key,
+                'restored': bool(key) and cache.restore(
+                    key, self._output_path),
+            }
+
+        if configs or fragments:
+            kci_frag_name = 'kernelci.config'
+            self._gen_kci_frag(configs, fragments, kci_frag_name)
+            # ToDo: treat kernelci.config as an implementation detail and list
+            # the actual input config fragment files here instead
+            bmeta['kernel']['fragments'] = [kci_frag_name]
+
+        dot_config = os.path.join(self._output_path, '.config')
+        if config_cache and not target.startswith("cip://"):
+            cache = ConfigCache(config_cache)
+            key = cache.get_key(
+                self._kdir, bmeta,
+                os.path.join(self._output_path, kci_frag_name)
+                if kci_frag_name else None)
+            hit = cache.restore(key, dot_config)
+            bmeta['kernel']['config_cache'] = {'key': key, 'hit': hit}
+            if hit:
+                return self._add_run_step(True, jopt)
+        else:
+            cache = None
+
         if target.startswith("cip://"):
             self._create_cip_config(target)
             res = self._make('olddefconfig', jopt, verbose, opts)
@@ -1136,11 +1902,11 @@ scripts/kconfig/merge_config.sh -O {output} '{base}' '{frag}' {redir}
             res = self._make(target, jopt, verbose, opts)
 
         if res and kci_frag_name:
-            # ToDo: treat kernelci.config as an implementation detail and list
-            # the actual input config fragment files here instead
-            bmeta['kernel']['fragments'] = [kci_frag_name]
             res = self._merge_config(kci_frag_name, verbose)
 
+        if res and cache:
+            cache.save(key, dot_config)
+
         return self._add_run_step(res, jopt)
 
     def install(self, verbose=False):
@@ -1152,12 +1918,13 @@ scripts/kconfig/merge_config.sh -O {output} '{base}' '{frag}' {redir}
         """
         item = self._install_file(
             os.path.join(self._output_path, '.config'), 'config',
-            'kernel.config', verbose
+            'kernel.config', verbose, text=True
         )
         self._add_artifact('config', item, 'config')
         for frag in self._meta.get('bmeta', 'kernel').get('fragments', list()):
             item = self._install_file(
-                os.path.join(self._output_path, frag), 'config', frag, verbose
+                os.path.join(self._output_path, frag), 'config', frag, verbose,
+                text=True
             )
             self._add_artifact('config', item, 'fragment')
         return super().install(verbose)
@@ -1174,7 +1941,8 @@ class MakeKernel(Step):
 
         Make the actual kernel image given the parameters already provided in
         previous steps via `bmeta.json`.  This will also add some meta-data
-        such as the kernel image name and ELF properties.
+        such as the kernel image name and ELF properties, and save the size
+        of each symbol from vmlinux in a compressed JSON file.
 
         *jopt* is the `make -j` option which will default to `nproc + 2`
         *verbose* is whether the build output should be shown
@@ -1199,6 +1967,13 @@ class MakeKernel(Step):
                 vmlinux_meta = kernelci.elf.read(vmlinux_file)
                 kbmeta.update(vmlinux_meta)
                 kbmeta['vmlinux_file_size'] = os.stat(vmlinux_file).st_size
+                try:
+                    size_info = kernelci.elf.read_size_info(vmlinux_file)
+                except ValueError as ex:
+                    print_flush("Skipping size info: {}".format(ex))
+                else:
+                    kernelci.elf.save_size_info(size_info, os.path.join(
+                        self._output_path, kernelci.elf.SIZE_INFO_FILE))
 
         return self._add_run_step(res, jopt)
 
@@ -1228,14 +2003,23 @@ class MakeKernel(Step):
         if os.path.exists(system_map):
             text = shell_cmd('grep " _text" {}'.format(system_map)).split()[0]
             text_offset = int(text, 16) & (1 << 30)-1  # phys: cap at 1G
-            item = self._install_file(system_map, 'kernel', file_name, verbose)
-            self._add_artifact('kernel', file_name, 'system_map')
+            item = self._install_file(
+                system_map, 'kernel', file_name, verbose, text=True)
+            self._add_artifact('kernel', item, 'system_map')
             kbmeta['text_offset'] = '0x{:08x}'.format(text_offset)
 
+    def _install_size_info(self, verbose):
+        file_name = kernelci.elf.SIZE_INFO_FILE
+        size_info = os.path.join(self._output_path, file_name)
+        if os.path.exists(size_info):
+            self._install_file(size_info, 'kernel', file_name, verbose)
+            self._add_artifact('kernel', file_name, 'size_info')
+
     def install(self, verbose=False):
         """Install the kernel image
 
-        Install the Linux kernel image as well as System.map.
+        Install the Linux kernel image as well as System.map and the vmlinux
+        symbol size info.
 
         *verbose* is whether the build output should be shown
         """
@@ -1248,6 +2032,7 @@ class MakeKernel(Step):
             print_flush("No kernel image found")
         else:
             self._install_system_map(kbmeta, verbose)
+            self._install_size_info(verbose)
             if image not in kimages:
                 image = sorted(kimages.keys())[0]
                 kbmeta['image'] = image
@@ -1257,6 +2042,22 @@ class MakeKernel(Step):
         return super().install(verbose, res)
 
 
+def get_compressor(compression):
+    """Get the file extension and command to use for a compression format
+
+    The first available command listed in MODULES_COMPRESSION is used.
+
+    *compression* is the compression format name from MODULES_COMPRESSION
+    """
+    if compression not in MODULES_COMPRESSION:
+        raise ValueError("Invalid compression: {}".format(compression))
+    ext, cmds = MODULES_COMPRESSION[compression]
+    for cmd in cmds:
+        if shutil.which(cmd[0]):
+            return ext, cmd
+    raise FileNotFoundError("No {} compressor found".format(compression))
+
+
 class MakeModules(Step):
 
     def __init__(self, *args, **kwargs):
@@ -1300,42 +2101,85 @@ class MakeModules(Step):
         }
         return self._make('modules_install', jopt, verbose, opts)
 
-    def _get_modules_artifacts(self, modules_tarball):
-        with tarfile.open(modules_tarball, 'r:xz') as tarball:
-            modules = sorted(list(set(
-                path for path in (
-                    os.path.basename(entry.name)
-                    for entry in tarball
-                )
-                if path and path.endswith('.ko')
-            )))
+    def _add_modules_files(self, tar):
+        modules = dict()
+        tar.add(self._mod_path, '.', recursive=False)
+        for root, dirs, files in os.walk(self._mod_path):
+            dirs.sort()
+            for name in sorted(dirs + files):
+                path = os.path.join(root, name)
+                arcname = os.path.join(
+                    '.', os.path.relpath(path, self._mod_path))
+                info = tar.gettarinfo(path, arcname)
+                if not info.isreg():
+                    tar.addfile(info)
+                    continue
+                with open(path, 'rb') as src:
+                    reader = kernelci.install.HashReader(src)
+                    tar.addfile(info, reader)
+                if name.endswith('.ko'):
+                    modules[os.path.relpath(path, self._mod_path)] = {
+                        'size': reader.size,
+                        'sha256': reader.sha256,
+                    }
         return modules
 
-    def _create_modules_tarball(self, verbose, modules_tarball, compr='J'):
+    def _create_modules_tarball(self, verbose, compression='xz'):
+        ext, cmd = get_compressor(compression)
+        modules_tarball = '.'.join(['modules', 'tar', ext])
         modules_tarball_path = os.path.join(
             self._install_path, modules_tarball)
         if verbose:
-            print("Creating {}".format(modules_tarball_path))
-        shell_cmd("tar -C{path} -c{compr}f {tarball} .".format(
-            path=self._mod_path, compr=compr, tarball=modules_tarball_path))
-        return modules_tarball_path
+            print("Creating {} with {}".format(
+                modules_tarball_path, ' '.join(cmd)))
+        # The tarball is written in a single pass: the module files are
+        # hashed while being added to the archive, which is compressed by a
+        # separate multi-threaded process and its output hashed by a thread
+        # while being written.
+        proc = subprocess.Popen(
+            cmd + ['-c'], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        installed = dict()
+        writer = threading.Thread(target=lambda: installed.update(
+            self._installer.install_stream(proc.stdout, modules_tarball_path)
+        ))
+        writer.start()
+        try:
+            with tarfile.open(fileobj=proc.stdin, mode='w|',
+                              format=tarfile.GNU_FORMAT) as tar:
+                modules = self._add_modules_files(tar)
+        finally:
+            proc.stdin.close()
+            writer.join()
+            proc.stdout.close()
+        if proc.wait() != 0:
+            raise subprocess.CalledProcessError(proc.returncode, proc.args)
+        installed['contents_size'] = {
+            name: data['size'] for name, data in modules.items()
+        }
+        installed['contents_sha256'] = {
+            name: data['sha256'] for name, data in modules.items()
+        }
+        self._installed[modules_tarball] = installed
+        return modules_tarball, sorted(set(
+            os.path.basename(path) for path in modules.keys()
+        ))
 
-    def install(self, verbose=False, jopt=None):
+    def install(self, verbose=False, jopt=None, compression='xz'):
         """Install the kernel modules
 
         Install the kernel modules as stripped binaries in a _modules_ build
         sub-directory.  Also install a tarball with all the module files and
-        list all the files as artifacts.
+        list all the files as artifacts, with their sizes and checksums.
 
         *verbose* is whether the build output should be shown
         *jopt* is the `make -j` option which will default to `nproc + 2`
+        *compression* is the tarball compression from MODULES_COMPRESSION
         """
         res = self._make_modules_install(jopt, verbose)
 
         if res:
-            tarball = 'modules.tar.xz'
-            tarball_path = self._create_modules_tarball(verbose, tarball)
-            modules = self._get_modules_artifacts(tarball_path)
+            tarball, modules = self._create_modules_tarball(
+                verbose, compression or 'xz')
             self._add_artifact_contents('tarball', tarball, modules)
 
         return super().install(verbose, res)
@@ -1390,7 +2234,8 @@ class MakeDeviceTrees(Step):
                 dest_dir = os.path.dirname(dest_path)
                 if not os.path.exists(dest_dir):
                     os.makedirs(dest_dir)
-                shutil.copy(dtb_path, dest_path)
+                self._installed[os.path.join('dtbs', dtb_rel)] = \
+                    self._installer.install(dtb_path, dest_path)
 
         return dtb_list
 
@@ -1407,6 +2252,80 @@ class MakeDeviceTrees(Step):
         return super().install(verbose)
 
 
+class TarballIndex:
+    """Index of the members of a tarball"""
+
+    def __init__(self, members):
+        """A TarballIndex lists what a tarball contains
+
+        The index can be saved in a small JSON file alongside the tarball, so
+        consumers know what it contains without downloading or decompressing
+        it.  See scan() to create an index from the directory which was
+        packed into the tarball.
+
+        *members* is a list of [name, type, size] entries for each member
+        """
+        self._members = members
+
+    @classmethod
+    def scan(cls, path, exclude=None):
+        """Create an index from the directory which was packed in a tarball
+
+        Member names are relative to the directory and start with './' as
+        when packing it with `tar -C path .`, and they are sorted by name.
+
+        *path* is the path to the directory
+        *exclude* is an optional list of names to skip in the top directory
+        """
+        members = list()
+        for root, dirs, files in os.walk(path):
+            if root == path and exclude:
+                dirs[:] = list(name for name in dirs if name not in exclude)
+                files = list(name for name in files if name not in exclude)
+            for name in dirs + files:
+                file_path = os.path.join(root, name)
+                if os.path.islink(file_path):
+                    kind = 'l'
+                elif os.path.isdir(file_path):
+                    kind = 'd'
+                elif os.path.isfile(file_path):
+                    kind = 'f'
+                else:
+                    kind = 'o'
+                members.append([
+                    os.path.join('.', os.path.relpath(file_path, path)),
+                    kind, os.path.getsize(file_path) if kind == 'f' else 0,
+                ])
+        return cls(sorted(members))
+
+    @property
+    def members(self):
+        """List of [name, type, size] entries for each member
+
+        The type is 'f' for regular files, 'd' for directories, 'l' for
+        symbolic links and 'o' for anything else.
+        """
+        return self._members
+
+    def save(self, path):
+        """Save the index in a JSON file
+
+        *path* is the path to the index file
+        """
+        with open(path, 'w') as index_file:
+            json.dump({'members': self._members}, index_file,
+                      separators=(',', ':'))
+
+    @classmethod
+    def load(cls, path):
+        """Load the list of members from an index file
+
+        *path* is the path to the index file
+        """
+        with open(path) as index_file:
+            return json.load(index_file)['members']
+
+
 class MakeSelftests(Step):
 
     @property
@@ -1440,15 +2359,14 @@ class MakeSelftests(Step):
                          'tools/testing/selftests')
         return self._add_run_step(res, jopt)
 
-    def _get_kselftests(self, kselftest_tarball):
-        with tarfile.open(kselftest_tarball, 'r:xz') as tarball:
-            kselftests = set(
-                path for path in (
-                    os.path.split(os.path.relpath(entry.name))[0]
-                    for entry in tarball
-                )
-                if path
+    def _get_kselftests(self, members):
+        kselftests = set(
+            path for path in (
+                os.path.split(os.path.relpath(member[0]))[0]
+                for member in members
             )
+            if path
+        )
         return kselftests
 
     def install(self, verbose=False):
@@ -1459,15 +2377,103 @@ class MakeSelftests(Step):
 
         *verbose* is whether the build output should be shown
         """
+        kselftest_dir = os.path.join(
+            self._output_path, 'kselftest/kselftest_install')
         kselftest_tarball = os.path.join(
-            self._output_path,
-            'kselftest/kselftest_install/kselftest-packages/kselftest.tar.xz'
-        )
+            kselftest_dir, 'kselftest-packages/kselftest.tar.xz')
 
         res = os.path.exists(kselftest_tarball)
         if res:
             tarball = self._install_file(kselftest_tarball, verbose=verbose)
-            kselftests = self._get_kselftests(kselftest_tarball)
+            index = TarballIndex.scan(
+                kselftest_dir, exclude=['kselftest-packages'])
+            kselftests = self._get_kselftests(index.members)
             self._add_artifact_contents('tarball', tarball, kselftests)
+            index_path = '.'.join([kselftest_tarball, 'index', 'json'])
+            index.save(index_path)
+            index_file = self._install_file(index_path, verbose=verbose)
+            self._add_artifact('', index_file, 'index')
+
+        return super().install(verbose, res)
+
+
+def _read_file_sizes(item):
+    kind, path = item
+    try:
+        if kind == 'modules':
+            return kernelci.elf.read_section_sizes(path)
+        return kernelci.fdt.read_sizes(path)
+    except (OSError, ValueError):
+        return None
+
+
+class SizeAnalysis(Step):
+    """Size analysis of the kernel modules and device trees"""
+
+    # Name of the file with the size table, installed with artifacts.json
+    SIZES_FILE = 'sizes.json.gz'
+
+    @property
+    def name(self):
+        return 'sizes'
+
+    def _find_files(self):
+        dirs = {
+            'modules': (os.path.join(self._output_path, '_modules_'), '.ko'),
+            'dtbs': (os.path.join(self._install_path, 'dtbs'), '.dtb'),
+        }
+        for kind, (root_dir, ext) in dirs.items():
+            for root, _, files in os.walk(root_dir):
+                for file_name in files:
+                    if file_name.endswith(ext):
+                        path = os.path.join(root, file_name)
+                        yield kind, os.path.relpath(path, root_dir), path
+
+    def run(self, jopt=None, verbose=False, opts=None):
+        """Analyse the size of the kernel modules and device trees
+
+        Read the size of the allocated ELF sections of each kernel module
+        installed in the _modules_ directory, and the size of the blocks of
+        each device tree blob installed in the dtbs directory.  The files are
+        processed in parallel using a pool of processes, and a compact table
+        with the sizes of each file is saved in a compressed JSON file.
 
+        *jopt* is the number of processes, one per CPU by default
+        *verbose* is whether to print the number of files processed
+        """
+        files = list(self._find_files())
+        processes = int(jopt) if jopt else None
+        with multiprocessing.Pool(processes) as pool:
+            sizes = pool.map(
+                _read_file_sizes, ((kind, path) for kind, _, path in files),
+                chunksize=64)
+        table = {
+            'fields': {
+                'modules': list(kernelci.elf.SECTION_KINDS),
+                'dtbs': list(kernelci.fdt.FDT_SIZES),
+            },
+            'modules': dict(),
+            'dtbs': dict(),
+        }
+        for (kind, rel_path, _), file_sizes in zip(files, sizes):
+            if file_sizes is not None:
+                table[kind][rel_path] = file_sizes
+        if verbose:
+            print("Modules: {}, dtbs: {}".format(
+                len(table['modules']), len(table['dtbs'])))
+        sizes_path = os.path.join(self._output_path, self.SIZES_FILE)
+        with gzip.open(sizes_path, 'wt') as sizes_file:
+            json.dump(table, sizes_file, separators=(',', ':'))
+        return self._add_run_step(True, jopt)
+
+    def install(self, verbose=False):
+        """Install the size table
+
+        *verbose* is whether the build output should be shown
+        """
+        sizes_path = os.path.join(self._output_path, self.SIZES_FILE)
+        res = os.path.exists(sizes_path)
+        if res:
+            item = self._install_file(sizes_path, verbose=verbose)
+            self._add_artifact('', item, 'sizes')
         return super().install(verbose, res)
@@ -0,0 +1,192 @@
+# Copyright (C) 2021 Collabora Limited
+# Author: Guillaume Tucker <guillaume.tucker@collabora.com>
+#
+# This module is free software; you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation; either version 2.1 of the License, or (at your option)
+# any later version.
+#
+# This library is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this library; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""Per-object compile time profiling
+
+This module is also a compiler wrapper script.  When kernel builds are
+profiled, it gets called instead of the compiler with the path to the profile
+log as the first argument followed by the actual compiler command.  Each
+compiled object then adds one line to the log with the compile time in
+milliseconds, the ccache result, the size of the object file and its path.
+
+Note: only modules from the standard library can be imported here as the
+wrapper is run directly as a script, for every single object file.
+"""
+
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+# Name of the profile log file in the build output directory
+PROFILE_LOG = 'build-profile.csv'
+
+# ccache counters for cache hits, with names from ccache 3.7 and 4.x.  This is
+# the only definition as this module can't import anything from kernelci, and
+# kernelci.ccache uses it for the statistics of each build step.
+CCACHE_HITS = {
+    'cache_hit_direct',
+    'cache_hit_preprocessed',
+    'direct_cache_hit',
+    'preprocessed_cache_hit',
+}
+
+
+def get_wrapper(log_path, cc_cmd):
+    """Get the compiler command with the profiling wrapper
+
+    *log_path* is the path to the profile log file
+    *cc_cmd* is the compiler command to wrap, e.g. "ccache gcc"
+    """
+    return ' '.join([
+        sys.executable, os.path.abspath(__file__),
+        os.path.abspath(log_path), cc_cmd,
+    ])
+
+
+def _get_output(args):
+    if '-c' not in args:
+        return None
+    for i, arg in enumerate(args):
+        if arg == '-o' and i + 1 < len(args):
+            return args[i + 1]
+        if arg.startswith('-o') and len(arg) > 2:
+            return arg[2:]
+    return None
+
+
+def _read_ccache_result(stats_log):
+    try:
+        with open(stats_log) as stats_file:
+            counters = set(
+                line.strip() for line in stats_file
+                if not line.startswith('#')
+            )
+    except FileNotFoundError:
+        return ''
+    if not counters:
+        return ''
+    return 'hit' if counters & CCACHE_HITS else 'miss'
+
+
+def run_wrapper(log_path, args):
+    """Run the compiler and record the profile data for the object file
+
+    *log_path* is the path to the profile log file
+    *args* is the compiler command line with all its arguments
+    """
+    output = _get_output(args)
+    if output is None or output == '/dev/null':
+        os.execvp(args[0], args)
+
+    env = None
+    stats_log = None
+    if os.path.basename(args[0]) == 'ccache':
+        fd, stats_log = tempfile.mkstemp(prefix='kci-ccache-')
+        os.close(fd)
+        env = dict(os.environ, CCACHE_STATSLOG=stats_log)
+
+    start = time.monotonic()
+    ret = subprocess.call(args, env=env)
+    duration = int((time.monotonic() - start) * 1000)
+
+    cache = ''
+    if stats_log:
+        cache = _read_ccache_result(stats_log)
+        os.unlink(stats_log)
+
+    if ret == 0:
+        size = os.stat(output).st_size if os.path.exists(output) else 0
+        if os.path.isabs(output):
+            output = os.path.relpath(output)
+        line = ','.join([str(duration), cache, str(size), output]) + '\n'
+        # Single small write with O_APPEND so parallel jobs don't interleave
+        fd = os.open(log_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, line.encode())
+        finally:
+            os.close(fd)
+
+    return ret
+
+
+def load(path):
+    """Load a profile log file
+
+    Return a list of (duration, cache, size, path) tuples with the duration in
+    milliseconds, the ccache result as 'hit', 'miss' or an empty string and
+    the object file size in bytes.
+
+    *path* is the path to the profile log file
+    """
+    entries = []
+    with open(path) as log_file:
+        for line in log_file:
+            duration, cache, size, obj = line.rstrip('\n').split(',', 3)
+            entries.append((int(duration), cache, int(size), obj))
+    return entries
+
+
+def summarise(entries):
+    """Summarise profile log entries for each directory
+
+    Return a dictionary with the directory names as keys and dictionaries as
+    values with the total compile time in milliseconds, the number of objects,
+    ccache hits and misses and the total size of the object files.
+
+    *entries* is a list of entries as returned by load()
+    """
+    dirs = dict()
+    for duration, cache, size, obj in entries:
+        data = dirs.setdefault(os.path.dirname(obj) or '.', {
+            'duration': 0,
+            'objects': 0,
+            'hits': 0,
+            'misses': 0,
+            'size': 0,
+        })
+        data['duration'] += duration
+        data['objects'] += 1
+        data['size'] += size
+        if cache == 'hit':
+            data['hits'] += 1
+        elif cache == 'miss':
+            data['misses'] += 1
+    return dirs
+
+
+def compare(base, new):
+    """Compare two directory summaries
+
+    Return a list of (directory, base duration, new duration) tuples sorted by
+    decreasing difference in compile time.
+
+    *base* is the reference summary as returned by summarise()
+    *new* is the summary to compare with the reference
+    """
+    diff = list(
+        (path, base.get(path, {}).get('duration', 0),
+         new.get(path, {}).get('duration', 0))
+        for path in set(base.keys()).union(new.keys())
+    )
+    diff.sort(key=lambda item: item[2] - item[1], reverse=True)
+    return diff
+
+
+if __name__ == '__main__':
+    sys.exit(run_wrapper(sys.argv[1], sys.argv[2:]))
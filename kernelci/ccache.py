@@ -0,0 +1,461 @@
+# Copyright (C) 2021 Collabora Limited
+# Author: Guillaume Tucker <guillaume.tucker@collabora.com>
+#
+# This module is free software; you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation; either version 2.1 of the License, or (at your option)
+# any later version.
+#
+# This library is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this library; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""Compiler cache helpers
+
+This module provides ccache backends to configure where compiled objects get
+cached, helpers to get ccache statistics and a small HTTP cache server which
+can be used as ccache remote storage to share a cache between build machines.
+"""
+
+import collections
+import http.server
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+import urllib.parse
+
+from kernelci.buildprof import CCACHE_HITS
+
+# ccache counters for compiler calls that could not be cached
+CCACHE_UNCACHEABLE = {
+    'autoconf_test',
+    'bad_compiler_arguments',
+    'bad_output_file',
+    'called_for_link',
+    'called_for_preprocessing',
+    'compile_failed',
+    'compiler_produced_empty_output',
+    'compiler_produced_no_output',
+    'compiler_produced_stdout',
+    'could_not_use_modules',
+    'could_not_use_precompiled_header',
+    'multiple_source_files',
+    'no_input_file',
+    'output_to_stdout',
+    'preprocessor_error',
+    'unsupported_code_directive',
+    'unsupported_compiler_option',
+    'unsupported_source_language',
+}
+
+
+def parse_stats(output):
+    """Parse the output of ccache --print-stats
+
+    Return a dictionary with the number of cache hits, misses, uncacheable
+    compiler calls and the cache size in bytes.  Counters missing from the
+    output, for example with older ccache versions, are treated as zero.
+
+    *output* is the text printed by ccache --print-stats
+    """
+    counters = dict()
+    for line in output.splitlines():
+        split = line.split('\t')
+        if len(split) == 2 and split[1].isdigit():
+            counters[split[0]] = int(split[1])
+    return {
+        'hits': sum(counters.get(name, 0) for name in CCACHE_HITS),
+        'misses': counters.get('cache_miss', 0),
+        'uncacheable': sum(
+            counters.get(name, 0) for name in CCACHE_UNCACHEABLE),
+        'size': counters.get('cache_size_kibibyte', 0) * 1024,
+    }
+
+
+def get_stats():
+    """Get the current ccache statistics
+
+    Return a dictionary as returned by parse_stats(), or None if the
+    statistics could not be retrieved.  The cache directory is the one set
+    in the environment with CCACHE_DIR, or the ccache default one.
+    """
+    try:
+        output = subprocess.check_output(
+            ['ccache', '--print-stats'], stderr=subprocess.DEVNULL
+        ).decode()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return parse_stats(output)
+
+
+def diff_stats(before, after):
+    """Get the ccache statistics difference between two snapshots
+
+    The hits, misses and uncacheable values are the difference between the
+    two snapshots, and the size is the cache size from the second snapshot.
+
+    *before* is the first snapshot as returned by get_stats()
+    *after* is the second snapshot as returned by get_stats()
+    """
+    stats = {
+        key: after[key] - before[key]
+        for key in ('hits', 'misses', 'uncacheable')
+    }
+    stats['size'] = after['size']
+    return stats
+
+
+def add_stats(total, stats):
+    """Add some ccache statistics to a running total
+
+    *total* is a dictionary with the running total, updated in place
+    *stats* is a dictionary with the statistics to add as returned by
+            diff_stats()
+    """
+    for key in ('hits', 'misses', 'uncacheable'):
+        total[key] = total.get(key, 0) + stats[key]
+    total['size'] = stats['size']
+    return total
+
+
+def hit_rate(stats):
+    """Get the ccache hit rate as a percentage or None if nothing cacheable"""
+    cacheable = stats['hits'] + stats['misses']
+    return (stats['hits'] * 100.0 / cacheable) if cacheable else None
+
+
+def report(bmeta_list):
+    """Aggregate ccache statistics from several builds
+
+    Return a dictionary with (arch, compiler, build environment name) tuples
+    as keys and the aggregated ccache statistics as values, including the
+    number of builds and the largest cache size.
+
+    *bmeta_list* is an iterable with the bmeta data from several builds
+    """
+    groups = dict()
+    for bmeta in bmeta_list:
+        stats = bmeta.get('ccache')
+        env = bmeta.get('environment')
+        if not stats or not env:
+            continue
+        key = (env['arch'], env['compiler'], env['name'])
+        group = groups.setdefault(key, {
+            'builds': 0,
+            'hits': 0,
+            'misses': 0,
+            'uncacheable': 0,
+            'size': 0,
+        })
+        group['builds'] += 1
+        for counter in ('hits', 'misses', 'uncacheable'):
+            group[counter] += stats[counter]
+        group['size'] = max(group['size'], stats['size'])
+    return groups
+
+
+def format_report(groups):
+    """Format aggregated ccache statistics as a table
+
+    Return a list of lines with a header and one line for each group, sorted
+    by architecture, compiler and build environment name.
+
+    *groups* is a dictionary as returned by report()
+    """
+    lines = ["{:>8} {:>8} {:>8} {:>8} {:>6} {:>10}  {}".format(
+        'builds', 'hits', 'misses', 'uncache', 'rate', 'size (MB)',
+        'arch/compiler/build_env')]
+    for key, stats in sorted(groups.items()):
+        rate = hit_rate(stats)
+        lines.append("{:8} {:8} {:8} {:8} {:>6} {:10}  {}".format(
+            stats['builds'], stats['hits'], stats['misses'],
+            stats['uncacheable'],
+            '{:.1f}%'.format(rate) if rate is not None else '-',
+            stats['size'] // (1024 * 1024), '/'.join(key)))
+    return lines
+
+
+class CacheBackend:
+    """Compiler cache backend"""
+
+    def __init__(self, arch, cc, url=None):
+        """A cache backend provides the environment to configure ccache
+
+        Each combination of CPU architecture and compiler uses a separate
+        cache as objects can't be shared between them.
+
+        *arch* is the CPU architecture name
+        *cc* is the compiler name
+        *url* is the URL of the cache storage, if applicable
+        """
+        self._arch = arch
+        self._cc = cc
+        self._url = url
+
+    @property
+    def name(self):
+        """Name of the cache, unique for each architecture and compiler"""
+        return '-'.join([self._arch, self._cc])
+
+    def get_env(self):
+        """Get a dictionary with the environment variables for ccache"""
+        return {
+            'CCACHE_DIR': '-'.join(['.ccache', self.name]),
+        }
+
+
+class LocalCache(CacheBackend):
+    """Local ccache directory, the default"""
+
+
+class RemoteCache(CacheBackend):
+    """ccache remote storage
+
+    Objects are only stored in a remote location such as an HTTP cache server,
+    which can be shared by ephemeral build environments.  The local cache
+    directory is still used by ccache to store its statistics.  This requires
+    ccache 4.4 or later.
+    """
+
+    def get_env(self):
+        env = super().get_env()
+        url = '/'.join([self._url.rstrip('/'), self.name])
+        env.update({
+            'CCACHE_REMOTE_STORAGE': url,
+            'CCACHE_SECONDARY_STORAGE': url,  # ccache < 4.8
+            'CCACHE_REMOTE_ONLY': 'true',
+        })
+        return env
+
+
+CACHE_BACKENDS = {
+    '': LocalCache,
+    'file': RemoteCache,
+    'http': RemoteCache,
+    'https': RemoteCache,
+    'redis': RemoteCache,
+}
+
+
+def get_backend(arch, cc, url=None):
+    """Get a CacheBackend object
+
+    The URL scheme determines which backend is used, or the local cache
+    directory if no URL is provided.
+
+    *arch* is the CPU architecture name
+    *cc* is the compiler name
+    *url* is the optional URL of the cache storage
+    """
+    scheme = urllib.parse.urlparse(url).scheme if url else ''
+    backend_cls = CACHE_BACKENDS.get(scheme)
+    if backend_cls is None:
+        raise ValueError("Unsupported cache URL: {}".format(url))
+    return backend_cls(arch, cc, url)
+
+
+class CacheStore:
+    """File storage with a size limit for the cache server"""
+
+    def __init__(self, path, max_size):
+        """Cache storage with least-recently used eviction
+
+        When the total size of the cached files goes above the limit, the
+        files which haven't been accessed for the longest time get removed.
+
+        *path* is the path to the directory where to store the files
+        *max_size* is the maximum total size of the files in bytes
+        """
+        self._path = path
+        self._max_size = max_size
+        self._lock = threading.Lock()
+        self._files = collections.OrderedDict()
+        self._size = 0
+        if not os.path.exists(path):
+            os.makedirs(path)
+        existing = []
+        for root, _, files in os.walk(path):
+            for file_name in files:
+                file_path = os.path.join(root, file_name)
+                stat = os.stat(file_path)
+                key = os.path.relpath(file_path, path)
+                existing.append((stat.st_atime, key, stat.st_size))
+        for _, key, size in sorted(existing):
+            self._files[key] = size
+            self._size += size
+
+    @property
+    def size(self):
+        """Total size of the cached files in bytes"""
+        return self._size
+
+    def _get_path(self, key):
+        key = os.path.normpath(key.strip('/'))
+        if not key or key == '.' or key.startswith('..'):
+            raise ValueError("Invalid key: {}".format(key))
+        return key, os.path.join(self._path, key)
+
+    def open(self, key):
+        """Open a cached file for reading or return None if not found
+
+        The file is opened while holding the lock, so it can still be read
+        even if it gets evicted by another thread afterwards.
+        """
+        key, path = self._get_path(key)
+        with self._lock:
+            if key not in self._files:
+                return None
+            self._files.move_to_end(key)
+            return open(path, 'rb')
+
+    def _discard(self, stream, size):
+        while size:
+            chunk = stream.read(min(size, 65536))
+            if not chunk:
+                break
+            size -= len(chunk)
+
+    def put(self, key, stream, size):
+        """Store a file
+
+        Return True if the file was stored, or False if it's larger than the
+        maximum cache size in which case the data is read and discarded.
+
+        *key* is the relative path of the file in the cache
+        *stream* is a file object to read the data from
+        *size* is the number of bytes to read from the stream
+        """
+        key, path = self._get_path(key)
+        if size > self._max_size:
+            self._discard(stream, size)
+            return False
+        dir_path = os.path.dirname(path)
+        if not os.path.exists(dir_path):
+            os.makedirs(dir_path, exist_ok=True)
+        with tempfile.NamedTemporaryFile(dir=dir_path, delete=False) as tmp:
+            remaining = size
+            while remaining:
+                chunk = stream.read(min(remaining, 65536))
+                if not chunk:
+                    break
+                tmp.write(chunk)
+                remaining -= len(chunk)
+        if remaining:
+            os.unlink(tmp.name)
+            raise ValueError("Incomplete data for {}".format(key))
+        with self._lock:
+            os.replace(tmp.name, path)
+            self._size += size - self._files.pop(key, 0)
+            self._files[key] = size
+            self._evict()
+        return True
+
+    def delete(self, key):
+        """Remove a file, return True if found or False otherwise"""
+        key, path = self._get_path(key)
+        with self._lock:
+            if key not in self._files:
+                return False
+            self._size -= self._files.pop(key)
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                return False
+        return True
+
+    def _evict(self):
+        while self._size > self._max_size and self._files:
+            key, size = self._files.popitem(last=False)
+            self._size -= size
+            try:
+                os.unlink(os.path.join(self._path, key))
+            except FileNotFoundError:
+                pass
+
+
+class CacheRequestHandler(http.server.BaseHTTPRequestHandler):
+    """HTTP request handler implementing the ccache http storage protocol"""
+
+    def _get_key(self):
+        key = urllib.parse.urlparse(self.path).path
+        if '..' in key.split('/') or not key.strip('/'):
+            self.send_error(400)
+            return None
+        return key
+
+    def _get(self, send_data):
+        key = self._get_key()
+        if key is None:
+            return
+        cached = self.server.store.open(key)
+        if cached is None:
+            self.send_error(404)
+            return
+        with cached:
+            size = os.fstat(cached.fileno()).st_size
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/octet-stream')
+            self.send_header('Content-Length', size)
+            self.end_headers()
+            if send_data:
+                shutil.copyfileobj(cached, self.wfile)
+
+    def do_GET(self):
+        self._get(True)
+
+    def do_HEAD(self):
+        self._get(False)
+
+    def do_PUT(self):
+        key = self._get_key()
+        if key is None:
+            return
+        size = int(self.headers.get('Content-Length', 0))
+        try:
+            stored = self.server.store.put(key, self.rfile, size)
+        except ValueError:
+            self.close_connection = True
+            self.send_error(400)
+            return
+        if not stored:
+            self.send_error(413)
+            return
+        self.send_response(201)
+        self.send_header('Content-Length', 0)
+        self.end_headers()
+
+    def do_DELETE(self):
+        key = self._get_key()
+        if key is None:
+            return
+        found = self.server.store.delete(key)
+        self.send_response(200 if found else 404)
+        self.send_header('Content-Length', 0)
+        self.end_headers()
+
+    def log_message(self, *args):
+        if self.server.verbose:
+            super().log_message(*args)
+
+
+class CacheServer(http.server.ThreadingHTTPServer):
+    """HTTP cache server to use as ccache remote storage"""
+
+    def __init__(self, address, path, max_size, verbose=False):
+        """The cache server stores objects sent by ccache in a local directory
+
+        *address* is a (host, port) tuple with the address to listen on
+        *path* is the path to the directory where to store the objects
+        *max_size* is the maximum size of the cache in bytes
+        *verbose* is whether to print each request
+        """
+        super().__init__(address, CacheRequestHandler)
+        self.store = CacheStore(path, max_size)
+        self.verbose = verbose
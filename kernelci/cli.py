@@ -52,6 +52,11 @@ class Args:
         'help': "Path to the build output directory",
     }
 
+    base = {
+        'name': '--base',
+        'help': "Path to the output directory of a base build to compare",
+    }
+
     bmeta_json = {
         'name': '--bmeta-json',
         'help': "Path to the build.json file",
@@ -67,11 +72,27 @@ class Args:
         'help': "Build config name",
     }
 
+    build_profile = {
+        'name': '--build-profile',
+        'action': 'store_true',
+        'help': "Record the compile time of each object file",
+    }
+
+    builds_dir = {
+        'name': '--builds-dir',
+        'help': "Path to a directory with the meta-data of several builds",
+    }
+
     build_env = {
         'name': '--build-env',
         'help': "Build environment name",
     }
 
+    cache_dir = {
+        'name': '--cache-dir',
+        'help': "Path to the cache directory",
+    }
+
     callback_dataset = {
         'name': '--callback-dataset',
         'help': "Dataset to include in a lab callback",
@@ -101,11 +122,39 @@ class Args:
         'help': "Recipients to be added as Cc:",
     }
 
+    ccache_url = {
+        'name': '--ccache-url',
+        'help': "URL of a remote compiler cache e.g. http://localhost:8080",
+    }
+
+    check_artifacts = {
+        'name': '--check-artifacts',
+        'help': "Skip test jobs with artifact URLs which don't exist",
+        'action': 'store_true',
+    }
+
     commit = {
         'name': '--commit',
         'help': "Git commit checksum",
     }
 
+    compress_text = {
+        'name': '--compress-text',
+        'help': "Compress text artifacts such as logs with gzip",
+        'action': 'store_true',
+    }
+
+    compression = {
+        'name': '--compression',
+        'help': "Compression format for the modules tarball, xz by default",
+        'choices': ('xz', 'zstd', 'gz'),
+    }
+
+    config_cache = {
+        'name': '--config-cache',
+        'help': "Path to the cache of kernel config files",
+    }
+
     data_file = {
         'name': '--data-file',
         'help': "Path to the file with data to be submitted to storage",
@@ -132,6 +181,12 @@ class Args:
         'help': "Kernel defconfig name",
     }
 
+    dedup = {
+        'name': '--dedup',
+        'help': "Only upload files not already in the storage",
+        'action': 'store_true',
+    }
+
     delete = {
         'name': '--delete',
         'help': "Delete the tarball after extracting",
@@ -159,6 +214,12 @@ class Args:
         'help': "Install the build artifacts ",
     }
 
+    install_mode = {
+        'name': '--install-mode',
+        'help': "How to install the build artifacts, auto by default",
+        'choices': ('auto', 'reflink', 'hardlink', 'copy'),
+    }
+
     install_path = {
         'name': '--install-path',
         'help':
@@ -207,6 +268,12 @@ class Args:
         'section': SECTION_LAB,
     }
 
+    limit = {
+        'name': '--limit',
+        'help': "Maximum number of entries to show",
+        'type': int,
+    }
+
     log = {
         'name': '--log',
         'help': "Path to log file",
@@ -217,6 +284,11 @@ class Args:
         'help': "Mach name (aka SoC family)",
     }
 
+    max_size = {
+        'name': '--max-size',
+        'help': "Maximum size in bytes with an optional K, M, G or T suffix",
+    }
+
     mirror = {
         'name': '--mirror',
         'help': "Path to the local kernel git mirror",
@@ -228,16 +300,35 @@ class Args:
         "Path to the installed modules, or _modules_ inside output by default",
     }
 
+    no_checksums = {
+        'name': '--no-checksums',
+        'help': ("Don't read artifacts installed without copying them "
+                 "just to compute their checksums"),
+        'action': 'store_true',
+    }
+
     output = {
         'name': '--output',
         'help': "Path the output directory",
     }
 
+    output_cache = {
+        'name': '--output-cache',
+        'help': ("Path to the cache of build output directories, "
+                 "copied in full without file system reflink support"),
+    }
+
     plan = {
         'name': '--plan',
         'help': "Test plan name",
     }
 
+    port = {
+        'name': '--port',
+        'help': "Port number to listen on",
+        'type': int,
+    }
+
     publish_path = {
         'name': '--publish-path',
         'help': "Relative path where build artifacts are published",
@@ -266,6 +357,11 @@ class Args:
         'choices': ('debos', 'buildroot')
     }
 
+    spool = {
+        'name': '--spool',
+        'help': "Path to a spool directory to queue database submissions",
+    }
+
     storage = {
         'name': '--storage',
         'help': "Storage URL",
@@ -296,6 +392,18 @@ class Args:
         'help': "Upload path on Storage where rootfs stored",
     }
 
+    upload_jobs = {
+        'name': '--upload-jobs',
+        'help': "Maximum number of concurrent uploads",
+        'type': int,
+    }
+
+    upload_queue = {
+        'name': '--upload-queue',
+        'help': "Add the installed artifacts to the background upload queue",
+        'action': 'store_true',
+    }
+
     url = {
         'name': '--url',
         'help': "Kernel sources download URL",
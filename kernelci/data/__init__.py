@@ -19,6 +19,11 @@
 import importlib
 
 
+class Rejected(Exception):
+    """Submission permanently rejected by the database"""
+    pass
+
+
 class Database:
     """KernelCI database interface"""
 
@@ -50,6 +55,19 @@ class Database:
         """
         raise NotImplementedError("Database.submit() must be implemented")
 
+    def submit_one(self, path, data, verbose=False):
+        """Submit one item of data to the database
+
+        Return True if the data was sent successfully or False if it may be
+        sent again later.  Raise Rejected if the database has refused the
+        data, in which case sending it again would fail in the same way.
+
+        *path* is the database path or collection name, e.g. 'build'
+        *data* is a dictionary with the data to submit
+        *verbose* is to print more information
+        """
+        return self.submit({path: data}, verbose)
+
     def submit_build(self, meta, verbose=False):
         """Submit meta-data for a kernel build
 
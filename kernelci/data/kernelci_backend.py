@@ -19,7 +19,11 @@
 import json
 import requests
 import urllib
-from kernelci.data import Database
+import kernelci.http
+from kernelci.data import Database, Rejected
+
+# Client errors which may not happen again if the same request is retried
+TRANSIENT_ERRORS = {408, 429}
 
 
 class KernelCIBackend(Database):
@@ -30,9 +34,9 @@ class KernelCIBackend(Database):
             raise ValueError("API token required for kernelci_backend")
         self._headers = {'Authorization': self._token}
 
-    def _submit(self, path, data, verbose):
+    def _submit(self, path, data, verbose, reject=False):
         url = urllib.parse.urljoin(self.config.url, path)
-        resp = requests.post(url, json=data, headers=self._headers)
+        resp = kernelci.http.post(url, json=data, headers=self._headers)
         try:
             resp.raise_for_status()
         except requests.exceptions.HTTPError as ex:
@@ -41,6 +45,10 @@ class KernelCIBackend(Database):
                 errors = json.loads(ex.response.content).get("errors", [])
                 for err in errors:
                     print(err)
+            status = resp.status_code
+            if reject and 400 <= status < 500 and \
+                    status not in TRANSIENT_ERRORS:
+                raise Rejected(str(ex))
             return False
         if verbose:
             print(resp.text)
@@ -52,6 +60,9 @@ class KernelCIBackend(Database):
                 return False
         return True
 
+    def submit_one(self, path, data, verbose=False):
+        return self._submit(path, data, verbose, reject=True)
+
     def submit_build(self, meta, verbose=False):
         return self._submit('build', meta.get(), verbose)
 
@@ -0,0 +1,367 @@
+# Copyright (C) 2021 Collabora Limited
+# Author: Guillaume Tucker <guillaume.tucker@collabora.com>
+#
+# This module is free software; you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation; either version 2.1 of the License, or (at your option)
+# any later version.
+#
+# This library is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this library; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""On-disk spool for database submissions
+
+Submissions are first appended to a journal file in a spool directory, so
+they are not lost if the database is slow or unavailable.  They are then
+flushed to the database in the background, in batches and in the order they
+were added, with retries.  A submission identical to one which is still
+pending is not added again, based on a hash of their contents.  Submissions
+rejected by the database are not retried.  The journal is compacted after
+each flush so only the pending submissions are kept.
+"""
+
+import contextlib
+import fcntl
+import hashlib
+import json
+import os
+import threading
+import time
+
+from kernelci.data import Database, Rejected
+
+# Name of the journal file in the spool directory
+JOURNAL = 'journal'
+
+# Name of the lock file used to only have one flush at a time
+FLUSH_LOCK = 'flush.lock'
+
+# Default number of submissions recorded in the journal at a time
+BATCH_SIZE = 32
+
+# Default number of retries for each submission within a flush
+RETRIES = 3
+
+# Default backoff factor in seconds, the delay between retries is doubled
+# each time
+BACKOFF = 1.0
+
+# Number of failed attempts after which a submission is not flushed any more
+MAX_ATTEMPTS = 5
+
+# Default delay in seconds between each background flush
+FLUSH_INTERVAL = 10.0
+
+
+def get_hash(path, data):
+    """Get the SHA-256 hash of a submission"""
+    content = json.dumps([path, data], sort_keys=True)
+    return hashlib.sha256(content.encode()).hexdigest()
+
+
+class Spool:
+    """Append-only journal of database submissions"""
+
+    def __init__(self, path):
+        """A Spool is stored in a directory which may be shared by processes
+
+        *path* is the path to the spool directory, created if needed
+        """
+        self._path = path
+        self._journal_path = os.path.join(path, JOURNAL)
+        self._flush_lock_path = os.path.join(path, FLUSH_LOCK)
+        os.makedirs(path, exist_ok=True)
+
+    @property
+    def path(self):
+        """Path to the spool directory"""
+        return self._path
+
+    @contextlib.contextmanager
+    def _lock(self):
+        # The lock is on the directory itself so no extra file gets created
+        fd = os.open(self._path, os.O_RDONLY)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            yield
+        finally:
+            os.close(fd)
+
+    def _append(self, records):
+        with open(self._journal_path, 'a+') as journal:
+            data = ''.join(json.dumps(record) + '\n' for record in records)
+            if journal.tell():
+                journal.seek(journal.tell() - 1)
+                if journal.read(1) != '\n':
+                    data = '\n' + data  # after an interrupted write
+            journal.write(data)
+            journal.flush()
+            os.fsync(journal.fileno())
+
+    def _read(self):
+        if not os.path.exists(self._journal_path):
+            return
+        with open(self._journal_path) as journal:
+            for line in journal:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue  # incomplete record from an interrupted write
+                yield record
+
+    def _load(self):
+        pending = dict()
+        for record in self._read():
+            if 'add' in record:
+                entry = record['add']
+                pending[entry['id']] = entry
+            elif 'done' in record:
+                pending.pop(record['done'], None)
+            elif 'fail' in record:
+                entry = pending.get(record['fail'])
+                if entry:
+                    entry['attempts'] = entry.get('attempts', 0) + 1
+            elif 'reject' in record:
+                entry = pending.get(record['reject'])
+                if entry:
+                    entry['attempts'] = MAX_ATTEMPTS
+                    entry['rejected'] = True
+        return pending
+
+    def add(self, path, data):
+        """Add a submission to the spool
+
+        Return True if it was added, or False if an identical submission is
+        still pending.
+
+        *path* is the database path or collection name, e.g. 'build'
+        *data* is a dictionary with the data to submit
+        """
+        entry_id = get_hash(path, data)
+        with self._lock():
+            if entry_id in self._load():
+                return False
+            self._append([{'add': {
+                'id': entry_id,
+                'path': path,
+                'data': data,
+                'time': time.time(),
+            }}])
+        return True
+
+    def get_pending(self):
+        """Get the list of pending submissions in the order they were added
+
+        Each submission is a dictionary with its hash as 'id', the 'path'
+        and 'data' to submit, the 'time' when it was added and the number of
+        failed 'attempts' if any.  Submissions rejected by the database also
+        have 'rejected' set to True.
+        """
+        with self._lock():
+            pending = self._load()
+        return list(pending.values())
+
+    def compact(self):
+        """Rewrite the journal with only the entries which are still needed"""
+        with self._lock():
+            records = list({'add': entry} for entry in self._load().values())
+            tmp_path = self._journal_path + '.tmp'
+            with open(tmp_path, 'w') as journal:
+                for record in records:
+                    journal.write(json.dumps(record) + '\n')
+                journal.flush()
+                os.fsync(journal.fileno())
+            os.replace(tmp_path, self._journal_path)
+
+    def _submit(self, submit, entry, retries, backoff, stop):
+        error = None
+        for attempt in range(retries + 1):
+            if attempt:
+                delay = backoff * 2 ** (attempt - 1)
+                if stop is None:
+                    time.sleep(delay)
+                elif stop.wait(delay):
+                    break
+            try:
+                if submit(entry['path'], entry['data']):
+                    return True
+            except Rejected:
+                raise
+            except Exception as ex:
+                error = ex
+        if error:
+            print("Failed to submit {}: {}".format(entry['id'], error))
+        return False
+
+    def flush(self, submit, batch_size=BATCH_SIZE, retries=RETRIES,
+              backoff=BACKOFF, stop=None):
+        """Send the pending submissions to the database
+
+        Submissions are sent in the order they were added.  The flush stops
+        at the first one which still fails after all the retries, as the
+        database is then likely to be unavailable.  Submissions rejected by
+        the database are marked as stalled straight away and the flush
+        carries on with the next ones.  Submissions which have failed too
+        many times are skipped.  Only one flush can run at a time for a given
+        spool, so None is returned if another one is running.  Otherwise,
+        return a dictionary with the number of 'submitted', 'failed' and
+        'rejected' submissions.
+
+        *submit* is a function to send one submission, which takes the path
+                 and data as arguments and returns True if successful, or
+                 raises kernelci.data.Rejected if it should not be retried
+        *batch_size* is the number of submissions to send before recording
+                     the results in the journal
+        *retries* is the maximum number of retries for each submission
+        *backoff* is the backoff factor in seconds between retries
+        *stop* is an optional threading.Event to stop retrying when set, the
+               remaining submissions then only get one attempt each
+        """
+        with open(self._flush_lock_path, 'w') as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return None
+            report = {'submitted': 0, 'failed': 0, 'rejected': 0}
+            pending = list(
+                entry for entry in self.get_pending()
+                if entry.get('attempts', 0) < MAX_ATTEMPTS
+            )
+            for index in range(0, len(pending), batch_size):
+                records = []
+                for entry in pending[index:index + batch_size]:
+                    try:
+                        submitted = self._submit(
+                            submit, entry, retries, backoff, stop)
+                    except Rejected as ex:
+                        print("Rejected {}: {}".format(entry['id'], ex))
+                        records.append({'reject': entry['id']})
+                        report['rejected'] += 1
+                        continue
+                    if submitted:
+                        records.append({'done': entry['id']})
+                        report['submitted'] += 1
+                    else:
+                        records.append({'fail': entry['id']})
+                        report['failed'] += 1
+                        break
+                with self._lock():
+                    self._append(records)
+                if report['failed']:
+                    break
+            if report['submitted'] or report['rejected']:
+                self.compact()
+        return report
+
+    def get_metrics(self):
+        """Get the spool queue metrics
+
+        Return a dictionary with the number of 'pending' submissions, the
+        number of 'stalled' ones which have failed too many times, the total
+        'bytes' of pending data, the 'age' in seconds of the oldest pending
+        submission and the size of the 'journal' file in bytes.
+        """
+        pending = self.get_pending()
+        now = time.time()
+        journal = (os.path.getsize(self._journal_path)
+                   if os.path.exists(self._journal_path) else 0)
+        return {
+            'pending': len(pending),
+            'stalled': sum(1 for entry in pending
+                           if entry.get('attempts', 0) >= MAX_ATTEMPTS),
+            'bytes': sum(len(json.dumps(entry['data'])) for entry in pending),
+            'age': max((now - entry['time'] for entry in pending), default=0),
+            'journal': journal,
+        }
+
+
+class SpooledDatabase(Database):
+    """Database wrapper which sends submissions via a spool"""
+
+    def __init__(self, db, path, interval=FLUSH_INTERVAL):
+        """A SpooledDatabase accepts submissions without waiting
+
+        Submissions are added to the spool and a background thread flushes
+        them to the actual database.
+
+        *db* is the Database object to send the submissions to
+        *path* is the path to the spool directory
+        *interval* is the delay in seconds between each background flush
+        """
+        super().__init__(db.config)
+        self._db = db
+        self._spool = Spool(path)
+        self._interval = interval
+        self._verbose = False
+        self._event = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        self._thread_lock = threading.Lock()
+
+    @property
+    def spool(self):
+        """Spool object used to store the submissions"""
+        return self._spool
+
+    def _submit_one(self, path, data):
+        return self._db.submit_one(path, data, self._verbose)
+
+    def _run(self):
+        while True:
+            self._event.wait(self._interval)
+            self._event.clear()
+            stopping = self._stop.is_set()
+            report = self._spool.flush(
+                self._submit_one, retries=0 if stopping else RETRIES,
+                stop=self._stop)
+            # Make a last attempt if asked to stop during a successful flush,
+            # as some submissions may have been added in the meantime
+            if stopping or (self._stop.is_set() and report and
+                            report['failed']):
+                break
+
+    def _add(self, path, data, verbose):
+        self._verbose = verbose
+        self._spool.add(path, data)
+        with self._thread_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+        self._event.set()
+        return True
+
+    def close(self, timeout=None):
+        """Stop the background thread after a last flush
+
+        The last flush makes only one attempt for each submission without
+        any retries, and a flush already running stops retrying, so this
+        doesn't block when the database is unavailable.  Any submissions
+        which could not be sent remain in the spool, to be sent later for
+        example with `kci_data flush`.
+
+        *timeout* is the maximum time in seconds to wait for the last flush
+        """
+        with self._thread_lock:
+            thread = self._thread
+        if thread is None:
+            return
+        self._stop.set()
+        self._event.set()
+        thread.join(timeout)
+
+    def submit(self, data, verbose=False):
+        for path, item in data.items():
+            self._add(path, item, verbose)
+        return True
+
+    def submit_build(self, meta, verbose=False):
+        return self._add('build', meta.get(), verbose)
+
+    def submit_test(self, results, verbose=False):
+        return self._add('test', results, verbose)
@@ -21,10 +21,16 @@
 
 """Open the ELF file and read some of its content."""
 
+import collections
 import elftools.elf.constants as elfconst
 import elftools.elf.elffile as elffile
+import gzip
 import io
+import json
+import mmap
+import operator
 import os
+import struct
 
 # Default section names and their build document keys to look in the ELF file.
 # These are supposed to always be available.
@@ -37,6 +43,194 @@ DEFAULT_ELF_SECTIONS = [
 ELF_WA_FLAG = elfconst.SH_FLAGS.SHF_WRITE | elfconst.SH_FLAGS.SHF_ALLOC
 ELF_A_FLAG = elfconst.SH_FLAGS.SHF_ALLOC
 
+# Section header types for program data, symbol tables and no data.
+SHT_PROGBITS = 1
+SHT_SYMTAB = 2
+SHT_NOBITS = 8
+
+# Special section index values from the ELF specification.
+SHN_UNDEF = 0
+SHN_LORESERVE = 0xff00
+SHN_XINDEX = 0xffff
+
+# Symbol types for data objects, functions and source files.
+STT_OBJECT = 1
+STT_FUNC = 2
+STT_FILE = 4
+
+# Name of the symbol size info file produced with each vmlinux.
+SIZE_INFO_FILE = "vmlinux-size.json.gz"
+
+# ELF header fields after e_ident, for 32-bit and 64-bit files.
+ELF_HEADER = {
+    1: 'HHIIIIIHHHHHH',
+    2: 'HHIQQQIHHHHHH',
+}
+
+# Section header fields, for 32-bit and 64-bit files.
+ELF_SECTION = {
+    1: 'IIIIIIIIII',
+    2: 'IIQQQQIIQQ',
+}
+
+# Symbol table entry fields, for 32-bit and 64-bit files.
+ELF_SYMBOL = {
+    1: 'IIIBBH',
+    2: 'IBBHQQ',
+}
+
+Section = collections.namedtuple('Section', [
+    'name', 'type', 'flags', 'addr', 'offset', 'size', 'link', 'info',
+    'addralign', 'entsize',
+])
+
+
+class ElfFile:
+    """Minimal ELF file reader.
+
+    Only the ELF header and the section header table get parsed, directly
+    from the file mapped in memory.  This is much faster than pyelftools for
+    large files such as vmlinux with debug info and many sections.  Both
+    32-bit and 64-bit files are supported with either endianness.
+    """
+
+    def __init__(self, path):
+        """Open an ELF file.
+
+        :param path: The path to the ELF file.
+        :raises ValueError: If the file is not a valid ELF file.
+        """
+        with io.open(path, mode="rb") as elf_strm:
+            self._map = mmap.mmap(
+                elf_strm.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            self._parse()
+        except (IndexError, KeyError, ValueError, struct.error):
+            self.close()
+            raise ValueError("Invalid ELF file: {}".format(path))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        """Close the file."""
+        self._map.close()
+
+    @property
+    def elf_class(self):
+        """The ELF class, 32 or 64 for 32-bit and 64-bit files."""
+        return 32 if self._class == 1 else 64
+
+    @property
+    def endian(self):
+        """The struct byte order character, '<' or '>'."""
+        return self._endian
+
+    @property
+    def sections(self):
+        """List of the sections as Section tuples."""
+        return self._sections
+
+    def _parse(self):
+        if self._map[:4] != b'\x7fELF':
+            raise ValueError("Invalid magic")
+        self._class = self._map[4]
+        self._endian = {1: '<', 2: '>'}[self._map[5]]
+        header = struct.unpack_from(
+            self._endian + ELF_HEADER[self._class], self._map, 16)
+        shoff, shentsize, shnum, shstrndx = (
+            header[5], header[10], header[11], header[12])
+        section_fmt = struct.Struct(self._endian + ELF_SECTION[self._class])
+        if shoff == 0:
+            self._sections = []
+            self._by_name = {}
+            return
+        if shentsize < section_fmt.size:
+            raise ValueError("Invalid section header size")
+        if shnum == 0 or shstrndx == SHN_XINDEX:
+            first = Section(0, *section_fmt.unpack_from(self._map, shoff)[1:])
+            if shnum == 0:
+                shnum = first.size
+            if shstrndx == SHN_XINDEX:
+                shstrndx = first.link
+        headers = [
+            section_fmt.unpack_from(self._map, shoff + i * shentsize)
+            for i in range(shnum)
+        ]
+        strtab = Section(0, *headers[shstrndx][1:])
+        self._sections = [
+            Section(self._get_string(strtab, header[0]), *header[1:])
+            for header in headers
+        ]
+        self._by_name = {
+            section.name: section for section in reversed(self._sections)
+        }
+
+    def _get_string(self, strtab, offset):
+        start = strtab.offset + offset
+        end = self._map.find(b'\0', start, strtab.offset + strtab.size)
+        if end < 0:
+            raise ValueError("Invalid string table")
+        return self._map[start:end].decode(errors='replace')
+
+    def get_section_by_name(self, name):
+        """Get a section by its name.
+
+        :param name: The section name.
+        :return The first Section with this name or None.
+        """
+        return self._by_name.get(name)
+
+    def get_data(self, section):
+        """Get the contents of a section.
+
+        :param section: A Section tuple.
+        :return A memoryview with the section data.
+        """
+        return memoryview(self._map)[
+            section.offset:section.offset + section.size]
+
+    def iter_symbols(self):
+        """Iterate over the entries of the symbol table.
+
+        The entries are read directly from the file mapped in memory and the
+        names are only decoded for functions, data objects and source files.
+
+        :return An iterator with (name, type, bind, shndx, value, size)
+        tuples.
+        """
+        symtab = next(
+            (sect for sect in self._sections if sect.type == SHT_SYMTAB),
+            None)
+        if symtab is None:
+            return
+        strtab = self._sections[symtab.link]
+        names = self._map[strtab.offset:strtab.offset + strtab.size]
+        sym_fmt = struct.Struct(self._endian + ELF_SYMBOL[self._class])
+        count = symtab.size // sym_fmt.size
+        entries = sym_fmt.iter_unpack(
+            self.get_data(symtab)[:count * sym_fmt.size])
+        if self._class == 1:
+            entries = (
+                (name, info, shndx, value, size)
+                for name, value, size, info, _, shndx in entries
+            )
+        else:
+            entries = (
+                (name, info, shndx, value, size)
+                for name, info, _, shndx, value, size in entries
+            )
+        find = names.find
+        for name, info, shndx, value, size in entries:
+            sym_type = info & 0xf
+            if sym_type in (STT_OBJECT, STT_FUNC, STT_FILE):
+                name = names[name:find(b'\0', name)].decode(
+                    errors='replace')
+            yield name, sym_type, info >> 4, shndx, value, size
+
 
 def calculate_data_size(elf_file):
     """Loop through the ELF file sections and compute the .data size.
@@ -58,15 +252,35 @@ def calculate_data_size(elf_file):
     return data_size
 
 
-def read(path):
-    """Read a vmlinux file and extract some info from it.
+def _calculate_data_size_fast(sections):
+    return sum(
+        section.size for section in sections
+        if section.type == SHT_PROGBITS and
+        section.flags in (ELF_WA_FLAG, ELF_A_FLAG)
+    )
 
-    Update the build document in place.
 
-    Info extracted:
-        0. Size of the .text section.
-        1. Size of the .data section.
-        2. Size of the .bss section.
+def _read_fast(path):
+    extracted = {}
+    with ElfFile(path) as elf_file:
+        for name, key in DEFAULT_ELF_SECTIONS:
+            sect = elf_file.get_section_by_name(name)
+            if sect:
+                extracted[key] = sect.size
+        data_sect = elf_file.get_section_by_name(".data")
+        if data_sect:
+            extracted["vmlinux_data_size"] = data_sect.size
+        else:
+            extracted["vmlinux_data_size"] = \
+                _calculate_data_size_fast(elf_file.sections)
+    return extracted
+
+
+def read_pyelftools(path):
+    """Read a vmlinux file with pyelftools and extract some info from it.
+
+    This is the same as read() but slower, using pyelftools to parse the
+    file.
 
     :param path: The path to the vmlinux file.
     :type path: str
@@ -91,3 +305,192 @@ def read(path):
                     calculate_data_size(elf_file)
 
     return extracted
+
+
+def _get_symbol_kind(section):
+    if section.type == SHT_NOBITS:
+        return 'b'
+    if section.flags & elfconst.SH_FLAGS.SHF_EXECINSTR:
+        return 't'
+    if section.flags & elfconst.SH_FLAGS.SHF_WRITE:
+        return 'd'
+    return 'r'
+
+
+# Section kinds for the sizes returned by read_section_sizes().
+SECTION_KINDS = ('t', 'r', 'd', 'b')
+
+
+def read_section_sizes(path):
+    """Read the total size of the allocated sections of an ELF file.
+
+    This is typically used for kernel modules.  Sections are grouped by
+    kind, like for symbols in read_size_info().
+
+    :param path: The path to the ELF file.
+    :type path: str
+    :return A list with the text, read-only data, data and bss sizes as
+    named in SECTION_KINDS.
+    """
+    sizes = dict.fromkeys(SECTION_KINDS, 0)
+    with ElfFile(path) as elf_file:
+        for section in elf_file.sections:
+            if section.flags & ELF_A_FLAG:
+                sizes[_get_symbol_kind(section)] += section.size
+    return [sizes[kind] for kind in SECTION_KINDS]
+
+
+def read_size_info(path):
+    """Read the symbol sizes from a vmlinux file.
+
+    Get the size of each function and data object from the symbol table, as
+    well as the size of each allocated section and the total size of the
+    symbols for each source file when available.  Only local symbols can be
+    associated with a source file, as they follow the file entry in the
+    symbol table while global symbols are all placed at the end.  Symbols
+    with the same name, typically static ones in different files, are added
+    together.
+
+    :param path: The path to the vmlinux file.
+    :type path: str
+    :return A dictionary with the 'sections' and 'objects' sizes and the
+    'symbols' as a list of [name, kind, size] sorted by decreasing size,
+    kind being 't' for text, 'r' for read-only data, 'd' for data and 'b'
+    for bss like with nm.
+    :raises ValueError: If the file or its symbol table can't be parsed.
+    """
+    try:
+        return _read_size_info(path)
+    except (IndexError, struct.error):
+        raise ValueError("Invalid symbol table: {}".format(path))
+
+
+def _read_size_info(path):
+    symbols = {}
+    objects = collections.Counter()
+    with ElfFile(path) as elf_file:
+        sections = elf_file.sections
+        kinds = [_get_symbol_kind(section) for section in sections]
+        source = None
+        source_size = 0
+        for name, sym_type, bind, shndx, _, size in elf_file.iter_symbols():
+            if sym_type == STT_FILE:
+                if source:
+                    objects[source] += source_size
+                source, source_size = name, 0
+                continue
+            if not size or sym_type not in (STT_OBJECT, STT_FUNC) or \
+                    shndx == SHN_UNDEF or shndx >= SHN_LORESERVE:
+                continue
+            sym = symbols.get(name)
+            if sym is None:
+                symbols[name] = [name, kinds[shndx], size]
+            else:
+                sym[2] += size
+            if bind == 0:  # STB_LOCAL
+                source_size += size
+        if source:
+            objects[source] += source_size
+        section_sizes = {
+            section.name: section.size for section in sections
+            if section.flags & ELF_A_FLAG and section.size
+        }
+    # Sort by name first so symbols with the same size are in a stable order
+    symbols = sorted(symbols.values(), key=operator.itemgetter(0))
+    symbols.sort(key=operator.itemgetter(2), reverse=True)
+    return {
+        'sections': section_sizes,
+        'objects': dict(objects),
+        'symbols': symbols,
+    }
+
+
+def save_size_info(size_info, path):
+    """Save symbol size info in a compressed JSON file.
+
+    :param size_info: The size info as returned by read_size_info().
+    :param path: The path to the output .json.gz file.
+    """
+    with gzip.open(path, 'wt') as size_file:
+        json.dump(size_info, size_file, separators=(',', ':'))
+
+
+def load_size_info(path):
+    """Load symbol size info from a compressed JSON file.
+
+    :param path: The path to the .json.gz file.
+    :return The size info as returned by read_size_info().
+    """
+    with gzip.open(path, 'rt') as size_file:
+        return json.load(size_file)
+
+
+def diff_size_info(base, new):
+    """Compare the symbol sizes from two builds.
+
+    This follows the same logic as the bloat-o-meter script from the kernel
+    source tree.
+
+    :param base: The size info of the base build.
+    :param new: The size info of the new build.
+    :return A dictionary with the number of 'added', 'removed', 'grown' and
+    'shrunk' symbols, the total size increase 'up' and decrease 'down' and
+    a 'symbols' list of (name, old size, new size) tuples sorted by
+    decreasing absolute size difference, with None for added or removed
+    symbols.
+    """
+    old_syms = {sym[0]: sym[2] for sym in base['symbols']}
+    new_syms = {sym[0]: sym[2] for sym in new['symbols']}
+    diff = {
+        'added': 0,
+        'removed': 0,
+        'grown': 0,
+        'shrunk': 0,
+        'up': 0,
+        'down': 0,
+    }
+    symbols = []
+    for name in set(old_syms).union(new_syms):
+        old_size, new_size = old_syms.get(name), new_syms.get(name)
+        delta = (new_size or 0) - (old_size or 0)
+        if not delta:
+            continue
+        if old_size is None:
+            diff['added'] += 1
+        elif new_size is None:
+            diff['removed'] += 1
+        elif delta > 0:
+            diff['grown'] += 1
+        else:
+            diff['shrunk'] += 1
+        diff['up' if delta > 0 else 'down'] += delta
+        symbols.append((name, old_size, new_size))
+    symbols.sort(key=lambda sym: (
+        -abs((sym[2] or 0) - (sym[1] or 0)), sym[0]))
+    diff['symbols'] = symbols
+    diff['old_total'] = sum(old_syms.values())
+    diff['new_total'] = sum(new_syms.values())
+    return diff
+
+
+def read(path):
+    """Read a vmlinux file and extract some info from it.
+
+    Info extracted:
+        0. Size of the .text section.
+        1. Size of the .data section.
+        2. Size of the .bss section.
+
+    Only the section headers are read, with the file mapped in memory.  If
+    this fails, pyelftools is used instead.
+
+    :param path: The path to the vmlinux file.
+    :type path: str
+    :return A dictionary with the extracted values.
+    """
+    if not os.path.isfile(path):
+        return {}
+    try:
+        return _read_fast(path)
+    except ValueError:
+        return read_pyelftools(path)
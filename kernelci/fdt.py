@@ -0,0 +1,57 @@
+# Copyright (C) 2021 Collabora Limited
+# Author: Guillaume Tucker <guillaume.tucker@collabora.com>
+#
+# This module is free software; you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation; either version 2.1 of the License, or (at your option)
+# any later version.
+#
+# This library is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this library; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""Flattened device tree blob helpers"""
+
+import struct
+
+# Magic number at the start of a device tree blob
+FDT_MAGIC = 0xd00dfeed
+
+# Device tree blob header, all fields are 32-bit big-endian values
+FDT_HEADER = struct.Struct('>10I')
+
+# Sizes read from the header, in the order returned by read_sizes()
+FDT_SIZES = ('total', 'struct', 'strings', 'mem_rsvmap')
+
+
+def read_sizes(path):
+    """Read the sizes of the blocks of a device tree blob from its header
+
+    Return a list with the total size of the blob, the size of the structure
+    block, the size of the strings block and the size of the memory
+    reservation block in bytes as named in FDT_SIZES.  The size of the
+    strings block is None for blobs older than version 3, as it's not in
+    their header.
+
+    *path* is the path to the dtb file
+    """
+    with open(path, 'rb') as dtb:
+        data = dtb.read(FDT_HEADER.size)
+    if len(data) < FDT_HEADER.size:
+        raise ValueError("Invalid device tree blob: {}".format(path))
+    magic, total, off_struct, off_strings, off_rsvmap, version, _, _, \
+        size_strings, size_struct = FDT_HEADER.unpack(data)
+    if magic != FDT_MAGIC:
+        raise ValueError("Invalid device tree blob: {}".format(path))
+    if version < 17:
+        # No size_dt_struct field before version 17
+        size_struct = off_strings - off_struct
+    if version < 3:
+        # No size_dt_strings field before version 3
+        size_strings = None
+    return [total, size_struct, size_strings, off_struct - off_rsvmap]
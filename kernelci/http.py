@@ -0,0 +1,188 @@
+# Copyright (C) 2021 Collabora Limited
+# Author: Guillaume Tucker <guillaume.tucker@collabora.com>
+#
+# This module is free software; you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation; either version 2.1 of the License, or (at your option)
+# any later version.
+#
+# This library is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this library; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""Shared HTTP session
+
+All the HTTP requests sent by KernelCI tools go through a single session per
+process, so connections are kept alive and reused between requests to the
+same host.  Each request has connect and read timeouts, and idempotent
+requests such as GET and HEAD are retried with an exponential backoff on
+connection errors and server errors.  Requests with other methods such as
+POST are only retried when the connection could not be established, as the
+server can't have received them.  Some metrics are also kept for each host.
+"""
+
+import os
+import threading
+import time
+import urllib.parse
+
+import requests
+import urllib3
+
+# Default maximum number of connections kept alive for each host
+POOL_SIZE = 10
+
+# Default (connect, read) timeouts in seconds
+TIMEOUT = (10, 120)
+
+# Default number of retries for each request
+RETRIES = 3
+
+# Default backoff factor in seconds, the delay between retries is doubled
+# each time
+BACKOFF = 1.0
+
+# HTTP status codes for server errors which can be retried
+RETRY_STATUS = (429, 500, 502, 503, 504)
+
+
+class Session(requests.Session):
+    """HTTP session with a connection pool, timeouts, retries and metrics"""
+
+    def __init__(self, pool_size=POOL_SIZE, timeout=TIMEOUT, retries=RETRIES,
+                 backoff=BACKOFF):
+        """A Session can be used to send requests to any number of hosts
+
+        *pool_size* is the maximum number of connections kept for each host
+        *timeout* is either a (connect, read) tuple or a single value for
+                  both timeouts in seconds, used when not provided with
+                  each request
+        *retries* is the maximum number of retries for each request
+        *backoff* is the backoff factor in seconds between retries
+        """
+        super().__init__()
+        retry = urllib3.util.Retry(
+            total=retries, backoff_factor=backoff,
+            status_forcelist=RETRY_STATUS, raise_on_status=False,
+        )
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=pool_size, pool_maxsize=pool_size,
+            max_retries=retry,
+        )
+        self.mount('http://', adapter)
+        self.mount('https://', adapter)
+        self._timeout = timeout
+        self._metrics = dict()
+        self._metrics_lock = threading.Lock()
+
+    @property
+    def metrics(self):
+        """Dictionary with the metrics for each host
+
+        The keys are the host names, with the port number if not the default
+        one.  The values are dictionaries with the total number of
+        'requests' sent, the number of 'retries', the number of 'errors'
+        when no response was received, the number of 'http_errors' with a
+        4xx or 5xx status code and the total 'duration' in seconds.
+        """
+        with self._metrics_lock:
+            return {
+                host: dict(metrics)
+                for host, metrics in self._metrics.items()
+            }
+
+    def _add_metrics(self, url, duration, resp=None):
+        host = urllib.parse.urlparse(url).netloc
+        retries = resp.raw.retries if resp is not None else None
+        with self._metrics_lock:
+            metrics = self._metrics.setdefault(host, {
+                'requests': 0,
+                'retries': 0,
+                'errors': 0,
+                'http_errors': 0,
+                'duration': 0.0,
+            })
+            metrics['requests'] += 1
+            metrics['duration'] += duration
+            if retries is not None:
+                metrics['retries'] += len(retries.history)
+            if resp is None:
+                metrics['errors'] += 1
+            elif resp.status_code >= 400:
+                metrics['http_errors'] += 1
+
+    def request(self, method, url, *args, **kwargs):
+        kwargs.setdefault('timeout', self._timeout)
+        start = time.monotonic()
+        try:
+            resp = super().request(method, url, *args, **kwargs)
+        except requests.RequestException:
+            self._add_metrics(url, time.monotonic() - start)
+            raise
+        self._add_metrics(url, time.monotonic() - start, resp)
+        return resp
+
+
+_session = None
+_session_pid = None
+_session_kwargs = dict()
+_session_lock = threading.Lock()
+
+
+def configure(**kwargs):
+    """Configure the shared session
+
+    The session gets created again with the new parameters the next time it
+    is used.  The parameters are the same as for the Session class, with the
+    default values for the ones not provided.
+    """
+    global _session
+    with _session_lock:
+        _session_kwargs.clear()
+        _session_kwargs.update(kwargs)
+        _session = None
+
+
+def get_session():
+    """Get the shared session for the current process
+
+    A new session is created after a fork as connections can't be shared
+    between processes.
+    """
+    global _session, _session_pid
+    with _session_lock:
+        if _session is None or _session_pid != os.getpid():
+            _session = Session(**_session_kwargs)
+            _session_pid = os.getpid()
+        return _session
+
+
+def get_metrics():
+    """Get the metrics for each host from the shared session"""
+    return get_session().metrics
+
+
+def request(method, url, **kwargs):
+    """Send a request with the shared session, see requests.request()"""
+    return get_session().request(method, url, **kwargs)
+
+
+def get(url, **kwargs):
+    """Send a GET request with the shared session, see requests.get()"""
+    return request('GET', url, **kwargs)
+
+
+def head(url, **kwargs):
+    """Send a HEAD request with the shared session, see requests.head()"""
+    kwargs.setdefault('allow_redirects', False)
+    return request('HEAD', url, **kwargs)
+
+
+def post(url, **kwargs):
+    """Send a POST request with the shared session, see requests.post()"""
+    return request('POST', url, **kwargs)
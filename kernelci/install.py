@@ -0,0 +1,292 @@
+# Copyright (C) 2021 Collabora Limited
+# Author: Guillaume Tucker <guillaume.tucker@collabora.com>
+#
+# This module is free software; you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation; either version 2.1 of the License, or (at your option)
+# any later version.
+#
+# This library is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this library; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""Installation of build artifacts
+
+Build artifacts can be installed without copying their data when the file
+system supports it, either by cloning files with reflink which shares the
+data blocks until either file gets modified, or by creating hard links.  When
+this is not possible, the data is copied.  The size and SHA-256 checksum of
+each installed file are computed while copying it, so the data only gets
+read once.  Text files can also be compressed with gzip as they get
+installed.
+"""
+
+import fcntl
+import gzip
+import hashlib
+import os
+import shutil
+
+# Size of the buffer used to copy and hash files
+CHUNK_SIZE = 1024 * 1024
+
+# ioctl request number to clone a file, FICLONE from linux/fs.h
+FICLONE = 0x40049409
+
+# Install modes, 'auto' uses reflink when possible and falls back to copy
+INSTALL_MODES = ('auto', 'reflink', 'hardlink', 'copy')
+
+# Compression level used to install files with gzip
+GZIP_LEVEL = 6
+
+
+class HashReader:
+    """File object wrapper to hash the data as it gets read"""
+
+    def __init__(self, fileobj):
+        """A HashReader computes the size and SHA-256 checksum of the data
+
+        *fileobj* is the binary file object to read the data from
+        """
+        self._fileobj = fileobj
+        self._checksum = hashlib.sha256()
+        self._size = 0
+
+    @property
+    def size(self):
+        """Number of bytes read so far"""
+        return self._size
+
+    @property
+    def sha256(self):
+        """SHA-256 checksum of the data read so far"""
+        return self._checksum.hexdigest()
+
+    def read(self, size=-1):
+        """Read some data, see io.RawIOBase.read()"""
+        data = self._fileobj.read(size)
+        self._checksum.update(data)
+        self._size += len(data)
+        return data
+
+
+class HashWriter:
+    """File object wrapper to hash the data as it gets written"""
+
+    def __init__(self, fileobj):
+        """A HashWriter computes the size and SHA-256 checksum of the data
+
+        *fileobj* is the binary file object to write the data to
+        """
+        self._fileobj = fileobj
+        self._checksum = hashlib.sha256()
+        self._size = 0
+
+    @property
+    def size(self):
+        """Number of bytes written so far"""
+        return self._size
+
+    @property
+    def sha256(self):
+        """SHA-256 checksum of the data written so far"""
+        return self._checksum.hexdigest()
+
+    def write(self, data):
+        """Write some data, see io.RawIOBase.write()"""
+        self._checksum.update(data)
+        self._size += len(data)
+        return self._fileobj.write(data)
+
+    def flush(self):
+        """Flush the underlying file object"""
+        self._fileobj.flush()
+
+
+class Installer:
+    """Install files using the most efficient method available"""
+
+    def __init__(self, mode=None, checksums=True):
+        """An Installer installs files and keeps statistics about it
+
+        With the 'hardlink' mode, installed files share the same inode as the
+        original ones so they must not be modified in place afterwards.  With
+        'reflink' and 'auto', files are cloned when possible.  If hard links
+        or reflink can't be used, the files are copied.
+
+        Checksums are computed in the same pass as the data when files get
+        copied.  With reflinks or hard links, the files still need to be read
+        just to compute their checksums unless *checksums* is False.
+
+        *mode* is the install mode from INSTALL_MODES, 'auto' by default
+        *checksums* is whether to compute the checksums of files installed
+                    without copying them
+        """
+        self._mode = mode or 'auto'
+        self._checksums = checksums
+        if self._mode not in INSTALL_MODES:
+            raise ValueError("Invalid install mode: {}".format(mode))
+        self._no_reflink = set()
+        self._stats = None
+        self.reset()
+
+    @property
+    def mode(self):
+        """Install mode"""
+        return self._mode
+
+    @property
+    def stats(self):
+        """Dictionary with the number of installed files and bytes
+
+        The 'files' and 'bytes' values are the total number of files and bytes
+        installed, and 'bytes_copied' is the number of bytes which had to be
+        actually copied.  The number of bytes read only to compute the
+        checksums of files installed without copying them is 'bytes_hashed'.
+        The number of files installed with each method is also provided with
+        the 'reflink', 'hardlink', 'copy' and 'gzip' values.  For files
+        compressed with gzip, the compressed size is used.
+        """
+        return dict(self._stats)
+
+    def reset(self):
+        """Reset the statistics"""
+        self._stats = {
+            'files': 0,
+            'bytes': 0,
+            'bytes_copied': 0,
+            'bytes_hashed': 0,
+            'reflink': 0,
+            'hardlink': 0,
+            'copy': 0,
+            'gzip': 0,
+        }
+
+    def _hardlink(self, src, dst):
+        try:
+            os.link(src, dst)
+        except OSError:
+            return False
+        return True
+
+    def _reflink(self, src, dst):
+        devs = (os.stat(src).st_dev, os.stat(os.path.dirname(dst)).st_dev)
+        if devs in self._no_reflink:
+            return False
+        with open(src, 'rb') as src_file, open(dst, 'wb') as dst_file:
+            try:
+                fcntl.ioctl(dst_file.fileno(), FICLONE, src_file.fileno())
+                return True
+            except OSError:
+                self._no_reflink.add(devs)
+        os.unlink(dst)
+        return False
+
+    def _copy(self, src_file, dst_file=None):
+        checksum = hashlib.sha256()
+        size = 0
+        buf = bytearray(CHUNK_SIZE)
+        view = memoryview(buf)
+        while True:
+            count = src_file.readinto(buf)
+            if not count:
+                break
+            checksum.update(view[:count])
+            if dst_file:
+                dst_file.write(view[:count])
+            size += count
+        return size, checksum.hexdigest()
+
+    def _add_stats(self, method, size):
+        self._stats['files'] += 1
+        self._stats['bytes'] += size
+        self._stats[method] += 1
+        if method in ('copy', 'gzip'):
+            self._stats['bytes_copied'] += size
+        elif self._checksums:
+            self._stats['bytes_hashed'] += size
+
+    def install(self, src, dst):
+        """Install a file
+
+        Return a dictionary with the method used, either 'reflink',
+        'hardlink' or 'copy', the size of the file and its SHA-256 checksum.
+        The checksum is omitted if the file was not copied and checksums are
+        disabled.  Any existing destination file gets replaced.
+
+        *src* is the path to the file to install
+        *dst* is the destination path, its directory needs to exist
+        """
+        if os.path.lexists(dst):
+            # Never write through a hard link to a previously installed file
+            os.unlink(dst)
+        if self._mode == 'hardlink' and self._hardlink(src, dst):
+            method = 'hardlink'
+        elif self._mode != 'copy' and self._reflink(src, dst):
+            method = 'reflink'
+        else:
+            method = 'copy'
+        if method == 'copy' or self._checksums:
+            with open(src, 'rb') as src_file:
+                if method == 'copy':
+                    with open(dst, 'wb') as dst_file:
+                        size, checksum = self._copy(src_file, dst_file)
+                else:
+                    size, checksum = self._copy(src_file)
+        else:
+            size, checksum = os.path.getsize(dst), None
+        if method != 'hardlink':
+            shutil.copymode(src, dst)
+        self._add_stats(method, size)
+        installed = {'method': method, 'size': size}
+        if checksum:
+            installed['sha256'] = checksum
+        return installed
+
+    def install_gzip(self, src, dst):
+        """Install a file compressed with gzip
+
+        Return a dictionary with the method which is always 'gzip', the size
+        and SHA-256 checksum of the compressed file and the 'original_size'
+        of the file.  The modification time is not stored in the gzip header
+        so identical files always give the same compressed data.
+
+        *src* is the path to the file to install
+        *dst* is the destination path, its directory needs to exist
+        """
+        if os.path.lexists(dst):
+            os.unlink(dst)
+        with open(src, 'rb') as src_file, open(dst, 'wb') as dst_file:
+            writer = HashWriter(dst_file)
+            with gzip.GzipFile(fileobj=writer, mode='wb',
+                               compresslevel=GZIP_LEVEL, mtime=0) as gz_file:
+                original_size, _ = self._copy(src_file, gz_file)
+        shutil.copymode(src, dst)
+        self._add_stats('gzip', writer.size)
+        return {
+            'method': 'gzip',
+            'size': writer.size,
+            'sha256': writer.sha256,
+            'original_size': original_size,
+        }
+
+    def install_stream(self, stream, dst):
+        """Install a file from a stream
+
+        Return a dictionary with the same data as install(), the method
+        always being 'copy'.
+
+        *stream* is a binary file object to read the data from
+        *dst* is the destination path, its directory needs to exist
+        """
+        if os.path.lexists(dst):
+            os.unlink(dst)
+        with open(dst, 'wb') as dst_file:
+            size, checksum = self._copy(stream, dst_file)
+        self._add_stats('copy', size)
+        return {'method': 'copy', 'size': size, 'sha256': checksum}
@@ -15,9 +15,9 @@
 # along with this library; if not, write to the Free Software Foundation, Inc.,
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
 
-import requests
 import urllib.parse
 
+import kernelci.http
 from .lava import LAVA
 
 
@@ -39,7 +39,7 @@ class LAVAREST(LAVA):
                 {'offset': offset, 'limit': limit, 'ordering': ordering}
             )
             url = '?'.join([base_url, query])
-            response = requests.get(url, headers=headers)
+            response = kernelci.http.get(url, headers=headers)
             response.raise_for_status()
             data = response.json()
             results.extend(data['results'])
@@ -17,8 +17,7 @@
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
 
 from kernelci import shell_cmd
-from kernelci.storage import upload_files
-import os
+from kernelci.storage import discover_files, upload_files
 
 
 def _build_debos(name, config, data_path, arch):
@@ -79,17 +78,16 @@ def build(name, config, data_path, arch):
                          .format(config.rootfs_type))
 
 
-def upload(api, token, upload_path, input_dir):
+def upload(api, token, upload_path, input_dir, jobs=None):
     """Upload rootfs to KernelCI backend.
 
+    Return the upload statistics from kernelci.storage.upload_files().
+
     *api* is the URL of the KernelCI backend API
     *token* is the backend API token to use
     *upload_path* is the target on KernelCI backend
     *input_dir* is the local rootfs directory path to upload
+    *jobs* is the maximum number of concurrent uploads
     """
-    artifacts = {}
-    for root, _, files in os.walk(input_dir):
-        for f in files:
-            px = os.path.relpath(root, input_dir)
-            artifacts[os.path.join(px, f)] = open(os.path.join(root, f), "rb")
-    upload_files(api, token, upload_path, artifacts)
+    artifacts = discover_files(input_dir)
+    return upload_files(api, token, upload_path, artifacts, jobs)
@@ -0,0 +1,523 @@
+# Copyright (C) 2020 Collabora Limited
+# Author: Lakshmipathi Ganapathi <lakshmipathi.ganapathi@collabora.com>
+#
+# This module is free software; you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation; either version 2.1 of the License, or (at your option)
+# any later version.
+#
+# This library is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this library; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+import concurrent.futures
+import hashlib
+import os
+import time
+import uuid
+import requests
+from urllib.parse import urljoin
+from kernelci import shell_cmd
+import kernelci.http
+
+
+class LazyFile:
+    """File to upload which only gets opened while its data is being read"""
+
+    def __init__(self, path):
+        """A LazyFile keeps the path to a file without opening it
+
+        *path* is the path to the file
+        """
+        self._path = path
+
+    @property
+    def path(self):
+        """Path to the file"""
+        return self._path
+
+    @property
+    def size(self):
+        """Current size of the file in bytes"""
+        return os.stat(self._path).st_size
+
+    def open(self):
+        """Open the file and return a binary file object"""
+        return open(self._path, 'rb')
+
+
+class MultipartEncoder:
+    """Streaming multipart/form-data encoder
+
+    The body of the request is generated on the fly as it gets read, so only
+    a small chunk of data is kept in memory at any time regardless of the
+    size of the files being sent.  Its total length is known in advance,
+    which lets requests send it with a Content-Length header.
+    """
+
+    def __init__(self, fields, files):
+        """Prepare a multipart body with some form fields and files
+
+        *fields* is a dictionary with the names and values of form fields
+        *files* is a dictionary with the names of the form fields as keys and
+                (file name, data) tuples as values, the data being either a
+                LazyFile, a binary file object, some bytes or a string
+
+        Each LazyFile is only opened while its data is being read and closed
+        as soon as it has all been sent, so only one of them is open at a
+        time.  Call close() to close any file left open if the body was not
+        read entirely.
+        """
+        self._boundary = uuid.uuid4().hex
+        self._parts = []
+        for name, value in fields.items():
+            self._add_part(name, None, value)
+        for name, (file_name, data) in files.items():
+            self._add_part(name, file_name, data)
+        self._parts.append(
+            '--{}--\r\n'.format(self._boundary).encode())
+        self._sizes = list(self._get_size(part) for part in self._parts)
+        self._length = sum(self._sizes)
+        self._current = 0
+        self._part_sent = 0
+        self._sent = 0
+        self._open_file = None
+
+    @property
+    def content_type(self):
+        """Value of the Content-Type header for this body"""
+        return 'multipart/form-data; boundary={}'.format(self._boundary)
+
+    @property
+    def sent(self):
+        """Number of bytes read so far"""
+        return self._sent
+
+    def __len__(self):
+        return self._length
+
+    def _open(self, lazy_file):
+        self._open_file = lazy_file.open()
+        self._parts[self._current] = self._open_file
+        return self._open_file
+
+    def close(self):
+        """Close the file currently being read, if any"""
+        if self._open_file:
+            self._open_file.close()
+            self._open_file = None
+
+    def _add_part(self, name, file_name, data):
+        disposition = 'form-data; name="{}"'.format(name)
+        if file_name is not None:
+            disposition += '; filename="{}"'.format(
+                file_name.replace('"', '%22'))
+        header = '--{}\r\nContent-Disposition: {}\r\n'.format(
+            self._boundary, disposition)
+        if file_name is not None:
+            header += 'Content-Type: application/octet-stream\r\n'
+        self._parts.append((header + '\r\n').encode())
+        if isinstance(data, str):
+            data = data.encode()
+        self._parts.append(data)
+        self._parts.append(b'\r\n')
+
+    @classmethod
+    def _get_size(cls, part):
+        if isinstance(part, bytes):
+            return len(part)
+        if isinstance(part, LazyFile):
+            return part.size
+        return os.fstat(part.fileno()).st_size - part.tell()
+
+    def read(self, size=-1):
+        """Read the next chunk of the body
+
+        *size* is the maximum number of bytes to read, or -1 for all
+        """
+        if size is None or size < 0:
+            size = self._length - self._sent
+        chunks = []
+        while size > 0 and self._current < len(self._parts):
+            part = self._parts[self._current]
+            if isinstance(part, bytes):
+                chunk = part[:size]
+                self._parts[self._current] = part[size:]
+                if len(chunk) == len(part):
+                    self._current += 1
+            else:
+                if isinstance(part, LazyFile):
+                    part = self._open(part)
+                remaining = self._sizes[self._current] - self._part_sent
+                chunk = part.read(min(size, remaining))
+                if remaining and not chunk:
+                    # The length of the body has already been sent
+                    raise OSError("File size changed while uploading")
+                self._part_sent += len(chunk)
+                if self._part_sent == self._sizes[self._current]:
+                    self._current += 1
+                    self._part_sent = 0
+                    if part is self._open_file:
+                        self.close()
+            chunks.append(chunk)
+            size -= len(chunk)
+        data = b''.join(chunks)
+        self._sent += len(data)
+        return data
+
+
+def discover_files(path):
+    """Discover files recustively so they can then be uploaded
+
+    Recursively walk through a file hierarchy and return a dictionary with the
+    file paths and LazyFile objects which can then be passed directly to
+    upload_files().  The files only get opened while they are being uploaded,
+    so there is no limit on the number of files.
+
+    *path* is the path to the file hierarchy where to look for files
+    """
+    artifacts = {}
+    for root, _, files in os.walk(path):
+        for fname in files:
+            px = os.path.relpath(root, path)
+            artifacts[os.path.join(px, fname)] = LazyFile(
+                os.path.join(root, fname))
+    return artifacts
+
+
+# Default maximum size of each batch of files to upload in bytes
+UPLOAD_BATCH_SIZE = 64 * 1024 * 1024
+
+# Default number of concurrent uploads
+UPLOAD_JOBS = 4
+
+# Default number of retries for each batch of files
+UPLOAD_RETRIES = 3
+
+# Size of the buffer used to hash files
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def _get_data_size(data):
+    if isinstance(data, str):
+        return len(data.encode())
+    if isinstance(data, bytes):
+        return len(data)
+    if isinstance(data, LazyFile):
+        return data.size
+    return os.fstat(data.fileno()).st_size - data.tell()
+
+
+def get_batches(input_files, batch_size=UPLOAD_BATCH_SIZE):
+    """Split a set of files into batches to upload
+
+    Files are added to each batch until it reaches the maximum size, so
+    files bigger than the maximum size are uploaded on their own.
+
+    *input_files* is a dictionary with the file names and data as values
+    *batch_size* is the maximum size of each batch in bytes
+    """
+    batches = []
+    batch, size = {}, 0
+    for name, data in input_files.items():
+        data_size = _get_data_size(data)
+        if batch and size + data_size > batch_size:
+            batches.append(batch)
+            batch, size = {}, 0
+        batch[name] = data
+        size += data_size
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def _upload_batch(session, url, token, fields, batch, retries, backoff):
+    offsets = {
+        name: data.tell() for name, data in batch.items()
+        if hasattr(data, 'tell')
+    }
+    attempts = 0
+    while True:
+        attempts += 1
+        for name, offset in offsets.items():
+            batch[name].seek(offset)
+        files = {
+            'file{}'.format(i): (name, data)
+            for i, (name, data) in enumerate(batch.items())
+        }
+        body = MultipartEncoder(fields, files)
+        headers = {
+            'Authorization': token,
+            'Content-Type': body.content_type,
+        }
+        try:
+            resp = session.post(url, headers=headers, data=body)
+            resp.raise_for_status()
+            return attempts, body.sent, None
+        except (requests.RequestException, OSError) as exc:
+            response = getattr(exc, 'response', None)
+            client_error = response is not None and \
+                400 <= response.status_code < 500
+            if client_error or attempts > retries:
+                return attempts, body.sent, str(exc)
+        finally:
+            body.close()
+        time.sleep(backoff * 2 ** (attempts - 1))
+
+
+def _upload(url, token, fields, input_files, jobs, batch_size, retries,
+            backoff):
+    batches = get_batches(input_files, batch_size)
+    jobs = max(1, min(jobs or UPLOAD_JOBS, len(batches)))
+    session = kernelci.http.get_session()
+    report = {
+        'bytes': 0,
+        'files': {},
+        'failed': [],
+    }
+    start = time.monotonic()
+    with concurrent.futures.ThreadPoolExecutor(jobs) as executor:
+        futures = {
+            executor.submit(_upload_batch, session, url, token, fields, batch,
+                            retries, backoff): batch
+            for batch in batches
+        }
+        for future in concurrent.futures.as_completed(futures):
+            attempts, sent, error = future.result()
+            for name in futures[future]:
+                status = {
+                    'status': 'FAIL' if error else 'PASS',
+                    'attempts': attempts,
+                }
+                if error:
+                    status['error'] = error
+                    report['failed'].append(name)
+                report['files'][name] = status
+            if not error:
+                report['bytes'] += sent
+    duration = time.monotonic() - start
+    report['duration'] = duration
+    report['throughput'] = report['bytes'] / duration if duration else 0
+    return report
+
+
+def upload_files(api, token, path, input_files, jobs=UPLOAD_JOBS,
+                 batch_size=UPLOAD_BATCH_SIZE, retries=UPLOAD_RETRIES,
+                 backoff=1.0):
+    """Upload files to the KernelCI backend
+
+    The files are split into batches which are uploaded concurrently, using
+    the pool of connections from the shared kernelci.http session.  Each
+    batch is sent in a separate request and retried with an exponential
+    backoff in case of a server or connection error.  The files are streamed
+    so the memory usage stays the same regardless of their size.
+
+    Return a dictionary with the number of 'bytes' sent, the 'duration' of
+    the upload in seconds and the 'throughput' in bytes per second.  The
+    status of each file is also provided in a 'files' dictionary with the
+    file names as keys and dictionaries with 'status' set to either 'PASS'
+    or 'FAIL', the number of 'attempts' and the 'error' message if the
+    upload failed.  The names of the files which could not be uploaded are
+    listed in 'failed'.
+
+    *api* is the URL of the KernelCI backend API
+    *token* is the backend API token to use
+    *path* is the target on KernelCI backend
+    *input_files* dictionary of input files
+    *jobs* is the maximum number of concurrent uploads
+    *batch_size* is the maximum size of each batch of files in bytes
+    *retries* is the number of times to retry uploading each batch
+    *backoff* is the delay in seconds before the first retry, which then
+              doubles for each retry
+    """
+    url = urljoin(api, 'upload')
+    return _upload(url, token, {'path': path}, input_files, jobs,
+                   batch_size, retries, backoff)
+
+
+def get_sha256(data):
+    """Get the SHA-256 checksum of some data to upload
+
+    *data* is either a LazyFile, a binary file object, some bytes or a string
+    """
+    if isinstance(data, str):
+        data = data.encode()
+    if isinstance(data, bytes):
+        return hashlib.sha256(data).hexdigest()
+    checksum = hashlib.sha256()
+    if isinstance(data, LazyFile):
+        with data.open() as data_file:
+            for chunk in iter(lambda: data_file.read(HASH_CHUNK_SIZE), b''):
+                checksum.update(chunk)
+    else:
+        offset = data.tell()
+        for chunk in iter(lambda: data.read(HASH_CHUNK_SIZE), b''):
+            checksum.update(chunk)
+        data.seek(offset)
+    return checksum.hexdigest()
+
+
+def _post_json(api, token, endpoint, data):
+    resp = kernelci.http.post(urljoin(api, endpoint), json=data,
+                              headers={'Authorization': token})
+    resp.raise_for_status()
+    return resp.json()
+
+
+def get_missing_blobs(api, token, hashes):
+    """Get the list of blobs which are not already in the storage
+
+    *api* is the URL of the KernelCI backend API
+    *token* is the backend API token to use
+    *hashes* is an iterable with the SHA-256 checksums of the blobs
+    """
+    resp = _post_json(api, token, 'blobs/missing', {'hashes': list(hashes)})
+    return resp['missing']
+
+
+def upload_blobs(api, token, blobs, jobs=UPLOAD_JOBS,
+                 batch_size=UPLOAD_BATCH_SIZE, retries=UPLOAD_RETRIES,
+                 backoff=1.0):
+    """Upload blobs to the content-addressed storage
+
+    Blobs are uploaded in the same way as with upload_files(), with their
+    SHA-256 checksums as file names.  The storage verifies the checksum of
+    each blob it receives.  Return a report in the same format as
+    upload_files().
+
+    *api* is the URL of the KernelCI backend API
+    *token* is the backend API token to use
+    *blobs* is a dictionary with the SHA-256 checksums as keys and the data
+            as values
+    """
+    return _upload(urljoin(api, 'blobs'), token, {}, blobs, jobs,
+                   batch_size, retries, backoff)
+
+
+def publish_manifest(api, token, path, manifest):
+    """Publish files from blobs already in the storage
+
+    *api* is the URL of the KernelCI backend API
+    *token* is the backend API token to use
+    *path* is the target on KernelCI backend
+    *manifest* is a dictionary with the file names as keys and the SHA-256
+               checksums of their blobs as values
+    """
+    _post_json(api, token, 'manifest', {'path': path, 'files': manifest})
+
+
+def upload_dedup(api, token, path, input_files, hashes=None,
+                 jobs=UPLOAD_JOBS, batch_size=UPLOAD_BATCH_SIZE,
+                 retries=UPLOAD_RETRIES, backoff=1.0):
+    """Upload files to a content-addressed storage without duplicates
+
+    The storage is first asked which blobs it already has, using the SHA-256
+    checksums of all the files in one request.  Only the missing blobs get
+    uploaded, each of them only once even if several files have the same
+    contents.  A manifest with the file names and their checksums is then
+    sent to publish all the files in the target path.  If the storage
+    doesn't reply as expected, for example because it doesn't support
+    content-addressed uploads, all the files are uploaded with
+    upload_files() instead.
+
+    Return a report in the same format as upload_files(), with an extra
+    'dedup' dictionary with the number of unique 'blobs', how many were
+    'missing' and had to be uploaded and the number of 'bytes_skipped' which
+    didn't need to be sent.
+
+    *api* is the URL of the KernelCI backend API
+    *token* is the backend API token to use
+    *path* is the target on KernelCI backend
+    *input_files* dictionary of input files
+    *hashes* is an optional dictionary with the SHA-256 checksums of some of
+             the input files already known, typically computed when they
+             were installed, the other ones get computed here
+    *jobs* is the maximum number of concurrent uploads
+    *batch_size* is the maximum size of each batch of files in bytes
+    *retries* is the number of times to retry uploading each batch
+    *backoff* is the delay in seconds before the first retry, which then
+              doubles for each retry
+    """
+    start = time.monotonic()
+    hashes = hashes or dict()
+    manifest = {
+        name: hashes.get(os.path.normpath(name)) or get_sha256(data)
+        for name, data in input_files.items()
+    }
+    blobs = {
+        sha256: input_files[name] for name, sha256 in manifest.items()
+    }
+    total = sum(_get_data_size(data) for data in input_files.values())
+    try:
+        missing = get_missing_blobs(api, token, blobs.keys())
+        report = upload_blobs(
+            api, token, {sha256: blobs[sha256] for sha256 in missing},
+            jobs, batch_size, retries, backoff)
+        failed = set(report['failed'])
+        if not failed:
+            publish_manifest(api, token, path, manifest)
+    except (requests.RequestException, ValueError, KeyError,
+            TypeError) as exc:
+        print("Failed to upload without duplicates, uploading all files: {}"
+              .format(exc))
+        report = upload_files(api, token, path, input_files, jobs,
+                              batch_size, retries, backoff)
+        report['duration'] = duration = time.monotonic() - start
+        report['throughput'] = report['bytes'] / duration if duration else 0
+        report['dedup'] = {
+            'blobs': len(blobs),
+            'missing': len(blobs),
+            'bytes_skipped': 0,
+        }
+        return report
+    error = None
+    if failed:
+        error = "Failed to upload {} blobs: {}".format(
+            len(failed), report['files'][min(failed)]['error'])
+    files = dict()
+    for name, sha256 in manifest.items():
+        # Nothing gets published if any blob is missing
+        status = {
+            'status': 'FAIL' if error else 'PASS',
+            'attempts': report['files'].get(sha256, {}).get('attempts', 0),
+        }
+        if error:
+            status['error'] = error
+        files[name] = status
+    uploaded = sum(_get_data_size(blobs[sha256]) for sha256 in missing)
+    duration = time.monotonic() - start
+    return {
+        'bytes': report['bytes'],
+        'files': files,
+        'failed': list(files) if error else [],
+        'duration': duration,
+        'throughput': report['bytes'] / duration if duration else 0,
+        'dedup': {
+            'blobs': len(blobs),
+            'missing': len(missing),
+            'bytes_skipped': total - uploaded,
+        },
+    }
+
+
+def print_report(report):
+    """Print an upload report and return True if all the files were uploaded
+
+    *report* is the upload report as returned by upload_files()
+    """
+    for name in sorted(report['failed']):
+        print("Failed to upload {}: {}".format(
+            name, report['files'][name]['error']))
+    print("Uploaded {} files, {} bytes in {:.1f}s ({:.1f} MB/s)".format(
+        len(report['files']) - len(report['failed']), report['bytes'],
+        report['duration'], report['throughput'] / 1e6))
+    dedup = report.get('dedup')
+    if dedup:
+        print("Uploaded {} out of {} unique blobs, skipped {} bytes".format(
+            dedup['missing'], dedup['blobs'], dedup['bytes_skipped']))
+    return not report['failed']
@@ -0,0 +1,541 @@
+# Copyright (C) 2021 Collabora Limited
+# Author: Guillaume Tucker <guillaume.tucker@collabora.com>
+#
+# This module is free software; you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation; either version 2.1 of the License, or (at your option)
+# any later version.
+#
+# This library is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this library; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""Local stand-in storage server
+
+This module provides a small HTTP server implementing the storage parts of
+the KernelCI backend API, to test and develop the upload code without a real
+backend.  Files sent to /upload get stored in a local directory and served
+back with GET requests.  It also implements the content-addressed storage
+protocol used for deduplicated uploads:
+
+* POST /blobs/missing with a JSON list of SHA-256 checksums in 'hashes'
+  returns the ones which are not stored yet in 'missing'
+* POST /blobs with a multipart body with one blob per file, each file name
+  being the SHA-256 checksum of the blob which gets verified
+* POST /manifest with a JSON target 'path' and 'files' dictionary mapping
+  file names to blob checksums publishes the files from the blobs
+
+The /build, /test, /bisect and /send backend API endpoints are also
+implemented, the JSON data they receive simply gets stored in files.  Latency
+and bandwidth limits can be set to emulate a remote server when benchmarking
+uploads and downloads.  To start a server on port 8000:
+
+  python3 -m kernelci.storage.devserver --path=storage --port=8000
+"""
+
+import argparse
+import functools
+import hashlib
+import http.server
+import json
+import os
+import re
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+import uuid
+
+from kernelci import parse_size
+
+# Size of the chunks of data read from requests
+CHUNK_SIZE = 64 * 1024
+
+# Name of the directory with the blobs, within the storage directory
+BLOBS_DIR = '_blobs_'
+
+# Name of the directory with the data sent to the backend API endpoints
+DATA_DIR = '_data_'
+
+# Backend API endpoints which accept JSON data
+DATA_ENDPOINTS = ('build', 'test', 'bisect', 'send')
+
+SHA256_RE = re.compile(r'^[0-9a-f]{64}$')
+PARAM_RE = re.compile(r'(\w+)="([^"]*)"')
+
+
+class MultipartReader:
+    """Streaming multipart/form-data parser"""
+
+    def __init__(self, stream, length, boundary):
+        """A MultipartReader reads the parts of a request body one by one
+
+        The data of each part is read directly from the stream so it never
+        needs to be entirely kept in memory.
+
+        *stream* is the file object to read the request body from
+        *length* is the length of the request body in bytes
+        *boundary* is the multipart boundary from the Content-Type header
+        """
+        self._stream = stream
+        self._remaining = length
+        self._delimiter = '\r\n--{}'.format(boundary).encode()
+        # The first delimiter is not preceded by a new line
+        self._buf = b'\r\n'
+
+    def _fill(self):
+        if not self._remaining:
+            raise ValueError("Truncated multipart data")
+        chunk = self._stream.read(min(self._remaining, CHUNK_SIZE))
+        if not chunk:
+            raise ValueError("Truncated multipart data")
+        self._remaining -= len(chunk)
+        self._buf += chunk
+
+    def read(self, size=-1):
+        """Read some data from the current part, see io.RawIOBase.read()"""
+        if size is None or size < 0:
+            return b''.join(iter(lambda: self.read(CHUNK_SIZE), b''))
+        while True:
+            end = self._buf.find(self._delimiter)
+            if end == -1:
+                end = len(self._buf) - len(self._delimiter)
+            if end > 0 or self._buf.startswith(self._delimiter):
+                break
+            self._fill()
+        data = self._buf[:min(end, size)]
+        self._buf = self._buf[len(data):]
+        return data
+
+    def _read_line(self):
+        while b'\r\n' not in self._buf:
+            self._fill()
+        line, self._buf = self._buf.split(b'\r\n', 1)
+        return line.decode()
+
+    def __iter__(self):
+        """Iterate over the parts
+
+        Each part is a 2-tuple with a dictionary of the Content-Disposition
+        parameters such as 'name' and 'filename', and this object to read
+        the data of the part.  Any data not read is skipped when moving on to
+        the next part.
+        """
+        while True:
+            while self.read(CHUNK_SIZE):
+                pass
+            self._buf = self._buf[len(self._delimiter):]
+            while len(self._buf) < 2:
+                self._fill()
+            if self._buf.startswith(b'--'):
+                while self._remaining:
+                    self._fill()
+                break
+            self._read_line()
+            params = dict()
+            while True:
+                line = self._read_line()
+                if not line:
+                    break
+                name, _, value = line.partition(':')
+                if name.strip().lower() == 'content-disposition':
+                    params = dict(PARAM_RE.findall(value))
+            yield params, self
+
+
+class Throttle:
+    """Bandwidth limit for a stream of data"""
+
+    def __init__(self, bandwidth):
+        """A Throttle makes the caller wait to not go above the bandwidth
+
+        *bandwidth* is the maximum bandwidth in bytes per second
+        """
+        self._bandwidth = bandwidth
+        self._next = time.monotonic()
+
+    def __call__(self, size):
+        """Wait for the time it takes to transfer some data
+
+        *size* is the number of bytes transferred
+        """
+        now = time.monotonic()
+        self._next = max(self._next, now) + size / self._bandwidth
+        time.sleep(self._next - now)
+
+
+class ThrottledStream:
+    """File object wrapper to limit the bandwidth when reading or writing"""
+
+    def __init__(self, stream, bandwidth):
+        """A ThrottledStream delays each read and write operation
+
+        Reading and writing are throttled separately, so the bandwidth
+        limit applies to each direction.
+
+        *stream* is the file object to wrap
+        *bandwidth* is the maximum bandwidth in bytes per second
+        """
+        self._stream = stream
+        self._read_throttle = Throttle(bandwidth)
+        self._write_throttle = Throttle(bandwidth)
+
+    def __getattr__(self, name):
+        return getattr(self._stream, name)
+
+    def read(self, size=-1):
+        """Read some data, see io.BufferedIOBase.read()"""
+        data = self._stream.read(size)
+        self._read_throttle(len(data))
+        return data
+
+    def readline(self, size=-1):
+        """Read a line, see io.IOBase.readline()"""
+        line = self._stream.readline(size)
+        self._read_throttle(len(line))
+        return line
+
+    def write(self, data):
+        """Write some data, see io.BufferedIOBase.write()"""
+        view = memoryview(data)
+        for offset in range(0, len(view), CHUNK_SIZE):
+            chunk = view[offset:offset + CHUNK_SIZE]
+            # Wait first as the data is received as soon as it's written
+            self._write_throttle(len(chunk))
+            self._stream.write(chunk)
+        return len(view)
+
+
+class Storage:
+    """Local storage directory for uploaded files and blobs"""
+
+    def __init__(self, path):
+        """Files are stored in a directory along with a blobs directory
+
+        *path* is the path to the storage directory
+        """
+        self._path = path
+        self._blobs_path = os.path.join(path, BLOBS_DIR)
+        self._data_path = os.path.join(path, DATA_DIR)
+        self._lock = threading.Lock()
+        os.makedirs(self._blobs_path, exist_ok=True)
+
+    @property
+    def path(self):
+        """Path to the storage directory"""
+        return self._path
+
+    def get_path(self, *names):
+        """Get the path to a stored file
+
+        Raise ValueError if the resulting path is outside the storage
+        directory.
+
+        *names* are the components of the file path relative to the storage
+                directory, such as the upload path and the file name
+        """
+        rel_path = os.path.normpath(
+            '/'.join(name.strip('/') for name in names if name))
+        if rel_path.startswith('..') or os.path.isabs(rel_path):
+            raise ValueError("Invalid path: {}".format(rel_path))
+        return os.path.join(self._path, rel_path)
+
+    def _get_blob_path(self, sha256):
+        if not SHA256_RE.match(sha256):
+            raise ValueError("Invalid blob checksum: {}".format(sha256))
+        return os.path.join(self._blobs_path, sha256[:2], sha256)
+
+    def _write(self, path, stream):
+        dir_path = os.path.dirname(path)
+        os.makedirs(dir_path, exist_ok=True)
+        checksum = hashlib.sha256()
+        with tempfile.NamedTemporaryFile(dir=dir_path, delete=False) as tmp:
+            try:
+                for chunk in iter(lambda: stream.read(CHUNK_SIZE), b''):
+                    checksum.update(chunk)
+                    tmp.write(chunk)
+            except BaseException:
+                # Don't leave partial files behind, e.g. truncated uploads
+                os.unlink(tmp.name)
+                raise
+        return tmp.name, checksum.hexdigest()
+
+    def put_file(self, path, stream):
+        """Store a file
+
+        *path* is the path to the file as returned by get_path()
+        *stream* is a file object to read the data from
+        """
+        tmp_path, _ = self._write(path, stream)
+        os.replace(tmp_path, path)
+
+    def add_data(self, endpoint, data):
+        """Store some data sent to a backend API endpoint
+
+        Return a unique identifier for the data, which is stored in
+        _data_/endpoint/identifier.json in the storage directory.
+
+        *endpoint* is the name of the API endpoint, such as 'build'
+        *data* is the JSON data sent to the API endpoint
+        """
+        data_id = uuid.uuid4().hex
+        dir_path = os.path.join(self._data_path, endpoint)
+        os.makedirs(dir_path, exist_ok=True)
+        with open(os.path.join(dir_path, data_id + '.json'), 'w') as data_file:
+            json.dump(data, data_file, indent='  ')
+        return data_id
+
+    def has_blob(self, sha256):
+        """Check whether a blob is already stored"""
+        return os.path.exists(self._get_blob_path(sha256))
+
+    def put_blob(self, sha256, stream):
+        """Store a blob after verifying its checksum
+
+        *sha256* is the expected SHA-256 checksum of the blob
+        *stream* is a file object to read the data from
+        """
+        path = self._get_blob_path(sha256)
+        tmp_path, checksum = self._write(path, stream)
+        if checksum != sha256:
+            os.unlink(tmp_path)
+            raise ValueError("Checksum mismatch for blob {}".format(sha256))
+        os.replace(tmp_path, path)
+
+    def publish(self, path, manifest):
+        """Publish files from blobs
+
+        Return the list of the blobs which are missing, in which case no
+        files get published.
+
+        *path* is the target path relative to the storage directory
+        *manifest* is a dictionary with the file names and blob checksums
+        """
+        files = {
+            self.get_path(path, name): self._get_blob_path(sha256)
+            for name, sha256 in manifest.items()
+        }
+        missing = sorted(set(
+            sha256 for sha256 in manifest.values()
+            if not self.has_blob(sha256)
+        ))
+        if missing:
+            return missing
+        for file_path, blob_path in files.items():
+            os.makedirs(os.path.dirname(file_path), exist_ok=True)
+            tmp_path = file_path + '.tmp'
+            with self._lock:
+                try:
+                    os.link(blob_path, tmp_path)
+                except OSError:
+                    shutil.copyfile(blob_path, tmp_path)
+                os.replace(tmp_path, file_path)
+        return []
+
+
+class StorageRequestHandler(http.server.BaseHTTPRequestHandler):
+    """HTTP request handler implementing the storage API"""
+
+    def setup(self):
+        super().setup()
+        if self.server.bandwidth:
+            self.rfile = ThrottledStream(self.rfile, self.server.bandwidth)
+            self.wfile = ThrottledStream(self.wfile, self.server.bandwidth)
+
+    def parse_request(self):
+        # Emulate the network latency before handling each request
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        return super().parse_request()
+
+    def _send_json(self, code, data):
+        body = json.dumps(data).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', len(body))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _check_token(self):
+        token = self.server.token
+        if token and self.headers.get('Authorization') != token:
+            self._send_json(401, {'error': "Invalid token"})
+            self.close_connection = True
+            return False
+        return True
+
+    def _read_json(self):
+        length = int(self.headers.get('Content-Length', 0))
+        return json.loads(self.rfile.read(length))
+
+    def _read_multipart(self):
+        content_type = self.headers.get('Content-Type', '')
+        boundary = content_type.partition('boundary=')[2]
+        if not content_type.startswith('multipart/form-data') or \
+                not boundary:
+            raise ValueError("Invalid content type: {}".format(content_type))
+        length = int(self.headers.get('Content-Length', 0))
+        return MultipartReader(self.rfile, length, boundary.strip('"'))
+
+    def _upload(self):
+        path = ''
+        files = []
+        for params, data in self._read_multipart():
+            file_name = params.get('filename')
+            if file_name is None:
+                if params.get('name') == 'path':
+                    path = data.read().decode()
+                continue
+            file_name = file_name.replace('%22', '"')
+            self.server.storage.put_file(
+                self.server.storage.get_path(path, file_name), data)
+            files.append(file_name)
+        return 200, {'path': path, 'files': files}
+
+    def _blobs(self):
+        blobs = []
+        for params, data in self._read_multipart():
+            sha256 = params.get('filename')
+            if sha256 is not None:
+                self.server.storage.put_blob(sha256, data)
+                blobs.append(sha256)
+        return 200, {'blobs': blobs}
+
+    def _blobs_missing(self):
+        hashes = self._read_json()['hashes']
+        missing = [
+            sha256 for sha256 in hashes
+            if not self.server.storage.has_blob(sha256)
+        ]
+        return 200, {'missing': missing}
+
+    def _manifest(self):
+        data = self._read_json()
+        missing = self.server.storage.publish(data['path'], data['files'])
+        if missing:
+            return 400, {'error': "Missing blobs", 'missing': missing}
+        return 200, {'path': data['path'], 'files': list(data['files'])}
+
+    def _submit(self, endpoint):
+        data_id = self.server.storage.add_data(endpoint, self._read_json())
+        return 201, {'code': 201, 'result': [{'_id': data_id}]}
+
+    def do_POST(self):
+        handlers = {
+            '/upload': self._upload,
+            '/blobs': self._blobs,
+            '/blobs/missing': self._blobs_missing,
+            '/manifest': self._manifest,
+        }
+        for endpoint in DATA_ENDPOINTS:
+            handlers['/' + endpoint] = functools.partial(
+                self._submit, endpoint)
+        handler = handlers.get(urllib.parse.urlparse(self.path).path)
+        if handler is None:
+            self._send_json(404, {'error': "Not found"})
+            self.close_connection = True
+            return
+        if not self._check_token():
+            return
+        try:
+            code, data = handler()
+        except (ValueError, KeyError, TypeError) as exc:
+            code, data = 400, {'error': str(exc), 'errors': [str(exc)]}
+            self.close_connection = True
+        self._send_json(code, data)
+
+    def _get(self, send_data):
+        url_path = urllib.parse.unquote(urllib.parse.urlparse(self.path).path)
+        try:
+            path = self.server.storage.get_path(url_path)
+        except ValueError:
+            self.send_error(400)
+            return
+        if not os.path.isfile(path):
+            self.send_error(404)
+            return
+        with open(path, 'rb') as stored:
+            size = os.fstat(stored.fileno()).st_size
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/octet-stream')
+            self.send_header('Content-Length', size)
+            self.end_headers()
+            if send_data:
+                shutil.copyfileobj(stored, self.wfile)
+
+    def do_GET(self):
+        self._get(True)
+
+    def do_HEAD(self):
+        self._get(False)
+
+    def log_message(self, *args):
+        if self.server.verbose:
+            super().log_message(*args)
+
+
+class StorageServer(http.server.ThreadingHTTPServer):
+    """Local HTTP storage server"""
+
+    def __init__(self, address, path, token=None, verbose=False, latency=0,
+                 bandwidth=None):
+        """The storage server keeps all the files in a local directory
+
+        *address* is a (host, port) tuple for the server socket
+        *path* is the path to the storage directory
+        *token* is an optional API token required to upload files
+        *verbose* is whether to print a log line for each request
+        *latency* is a delay in seconds to add before handling each request
+        *bandwidth* is an optional maximum bandwidth in bytes per second for
+                    each connection and each direction
+        """
+        super().__init__(address, StorageRequestHandler)
+        self.storage = Storage(path)
+        self.token = token
+        self.verbose = verbose
+        self.latency = latency
+        self.bandwidth = bandwidth
+
+
+def main(args=None):
+    """Run a storage server until interrupted"""
+    parser = argparse.ArgumentParser(
+        "python3 -m kernelci.storage.devserver",
+        description="Local stand-in KernelCI storage and backend server")
+    parser.add_argument('--path', required=True,
+                        help="Path to the storage directory")
+    parser.add_argument('--host', default='',
+                        help="Address to listen on")
+    parser.add_argument('--port', type=int, default=8000,
+                        help="Port number to listen on")
+    parser.add_argument('--token',
+                        help="API token required to send data")
+    parser.add_argument('--latency', type=float, default=0,
+                        help="Latency in seconds to add to each request")
+    parser.add_argument('--bandwidth',
+                        help="Bandwidth limit per connection in bytes per "
+                        "second with an optional K, M or G suffix")
+    parser.add_argument('--verbose', action='store_true',
+                        help="Print a log line for each request")
+    args = parser.parse_args(args)
+    bandwidth = parse_size(args.bandwidth) if args.bandwidth else None
+    server = StorageServer((args.host, args.port), args.path, args.token,
+                           args.verbose, args.latency, bandwidth)
+    print("Serving {} on port {}".format(args.path, server.server_port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+    return True
+
+
+if __name__ == '__main__':
+    sys.exit(0 if main() is True else 1)
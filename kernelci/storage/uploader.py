@@ -0,0 +1,296 @@
+# Copyright (C) 2021 Collabora Limited
+# Author: Guillaume Tucker <guillaume.tucker@collabora.com>
+#
+# This module is free software; you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation; either version 2.1 of the License, or (at your option)
+# any later version.
+#
+# This library is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this library; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""Background uploads
+
+Build artifacts can be uploaded in the background while the next build steps
+are running.  Each step adds the files it has installed to an upload queue,
+which is a directory with one JSON file per batch of files to upload.  An
+upload daemon processes the queue as new batches are added, and records the
+files it has uploaded.  The last step is a barrier which stops the daemon,
+waits for it to finish, uploads any files which are missing or have changed
+since they were uploaded and finally uploads the meta-data files.  Consumers
+of the meta-data can then rely on all the build artifacts being available.
+
+When uploading to a content-addressed storage, each batch also carries the
+SHA-256 checksums of its files as computed when they were installed so both
+the daemon and the barrier can skip the blobs which are already stored.
+"""
+
+import json
+import os
+import time
+
+from kernelci.storage import (
+    LazyFile,
+    discover_files,
+    upload_dedup,
+    upload_files,
+)
+
+# Name of the upload queue directory, within the build output directory
+QUEUE_DIR = '_upload_'
+
+# Meta-data files which are only uploaded by the barrier
+META_FILES = {
+    name + ext
+    for name in ('bmeta.json', 'steps.json', 'artifacts.json')
+    for ext in ('', '.gz')
+}
+
+# Default delay in seconds between each check for new batches in the queue
+POLL_INTERVAL = 1.0
+
+
+def _get_file_state(path):
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def _upload(api, token, path, files, hashes, dedup, jobs):
+    if dedup:
+        return upload_dedup(api, token, path, files, hashes, jobs)
+    return upload_files(api, token, path, files, jobs)
+
+
+class UploadQueue:
+    """Queue of files to upload, shared between processes"""
+
+    def __init__(self, output_path):
+        """An UploadQueue is stored in a directory in the build output
+
+        *output_path* is the path to the build output directory
+        """
+        self._path = self.get_path(output_path)
+        self._pending_path = os.path.join(self._path, 'pending')
+        self._done_path = os.path.join(self._path, 'done')
+        self._stop_path = os.path.join(self._path, 'stop')
+        self._pid_path = os.path.join(self._path, 'daemon.pid')
+
+    @classmethod
+    def get_path(cls, output_path):
+        """Get the path to the queue directory"""
+        return os.path.join(output_path, QUEUE_DIR)
+
+    @classmethod
+    def exists(cls, output_path):
+        """Check whether an upload queue has been created"""
+        return os.path.isdir(cls.get_path(output_path))
+
+    @property
+    def path(self):
+        """Path to the queue directory"""
+        return self._path
+
+    def create(self):
+        """Create the queue directory if it doesn't exist already"""
+        for path in (self._pending_path, self._done_path):
+            os.makedirs(path, exist_ok=True)
+
+    def _write(self, dir_path, data):
+        name = '{:020d}-{}.json'.format(time.time_ns(), os.getpid())
+        tmp_path = os.path.join(self._path, name + '.tmp')
+        with open(tmp_path, 'w') as entry:
+            json.dump(data, entry)
+        os.replace(tmp_path, os.path.join(dir_path, name))
+
+    def add(self, publish_path, files, hashes=None):
+        """Add a batch of files to upload
+
+        *publish_path* is the target on KernelCI backend
+        *files* is a list of file paths relative to the install directory
+        *hashes* is an optional dictionary with the SHA-256 checksums of some
+                 of the files, used when uploading without duplicates
+        """
+        files = list(name for name in files
+                     if os.path.basename(name) not in META_FILES)
+        if files:
+            hashes = hashes or dict()
+            self._write(self._pending_path, {
+                'path': publish_path,
+                'files': files,
+                'sha256': {
+                    name: hashes[name] for name in files if name in hashes
+                },
+            })
+
+    def get_pending(self):
+        """Get a list of (entry name, batch) for each pending batch
+
+        Each batch is a dictionary with the publish 'path', the list of
+        'files' to upload and the 'sha256' checksums known for them.
+        """
+        pending = list()
+        for name in sorted(os.listdir(self._pending_path)):
+            with open(os.path.join(self._pending_path, name)) as entry:
+                pending.append((name, json.load(entry)))
+        return pending
+
+    def complete(self, name, uploaded):
+        """Mark a pending batch as processed
+
+        *name* is the name of the entry as returned by get_pending()
+        *uploaded* is a dictionary with the paths of the files which were
+                   uploaded and their [size, mtime] when they were uploaded
+        """
+        self._write(self._done_path, uploaded)
+        os.unlink(os.path.join(self._pending_path, name))
+
+    def get_uploaded(self):
+        """Get all the files uploaded so far with their [size, mtime]"""
+        uploaded = dict()
+        for name in sorted(os.listdir(self._done_path)):
+            with open(os.path.join(self._done_path, name)) as entry:
+                uploaded.update(json.load(entry))
+        return uploaded
+
+    def stop(self):
+        """Ask the daemon to stop once the queue is empty"""
+        with open(self._stop_path, 'w'):
+            pass
+
+    def is_stopped(self):
+        """Check whether the daemon has been asked to stop"""
+        return os.path.exists(self._stop_path)
+
+    def set_daemon_pid(self, pid):
+        """Record the process ID of the daemon, or remove it if None"""
+        if pid is None:
+            if os.path.exists(self._pid_path):
+                os.unlink(self._pid_path)
+        else:
+            with open(self._pid_path, 'w') as pid_file:
+                pid_file.write(str(pid))
+
+    def is_daemon_running(self):
+        """Check whether the daemon process is still running"""
+        try:
+            with open(self._pid_path) as pid_file:
+                os.kill(int(pid_file.read()), 0)
+        except (FileNotFoundError, ValueError, ProcessLookupError):
+            return False
+        except PermissionError:
+            pass
+        return True
+
+
+def run_daemon(output_path, install_path, api, token, jobs=None,
+               poll_interval=POLL_INTERVAL, verbose=False, dedup=False):
+    """Upload the files from the queue until asked to stop
+
+    Each batch of files in the queue gets uploaded as soon as it is found.
+    Files which can't be uploaded are left for the barrier to upload again.
+
+    *output_path* is the path to the build output directory
+    *install_path* is the path to the install directory
+    *api* is the URL of the KernelCI backend API
+    *token* is the backend API token to use
+    *jobs* is the maximum number of concurrent uploads
+    *poll_interval* is the delay in seconds between checks for new batches
+    *verbose* is whether to print the files being uploaded
+    *dedup* is whether to only upload the blobs missing from a
+            content-addressed storage, see kernelci.storage.upload_dedup()
+    """
+    queue = UploadQueue(output_path)
+    queue.create()
+    queue.set_daemon_pid(os.getpid())
+    try:
+        while True:
+            stopped = queue.is_stopped()
+            pending = queue.get_pending()
+            if not pending and stopped:
+                break
+            for name, batch in pending:
+                paths = {
+                    rel_path: os.path.join(install_path, rel_path)
+                    for rel_path in batch['files']
+                }
+                states = {
+                    rel_path: _get_file_state(path)
+                    for rel_path, path in paths.items()
+                    if os.path.exists(path)
+                }
+                report = _upload(api, token, batch['path'], {
+                    rel_path: LazyFile(paths[rel_path])
+                    for rel_path in states
+                }, batch.get('sha256'), dedup, jobs)
+                for rel_path in report['failed']:
+                    del states[rel_path]
+                if verbose:
+                    print("Uploaded {} files, {} failed".format(
+                        len(states), len(report['failed'])))
+                queue.complete(name, states)
+            if not pending:
+                time.sleep(poll_interval)
+    finally:
+        queue.set_daemon_pid(None)
+    return True
+
+
+def push_queued(output_path, install_path, api, token, publish_path,
+                jobs=None, poll_interval=POLL_INTERVAL, dedup=False,
+                hashes=None):
+    """Wait for the background uploads and publish the meta-data
+
+    The daemon is asked to stop once the queue is empty.  Then any files in
+    the install directory which have not been uploaded or have changed
+    since, typically because the upload failed, are uploaded.  The
+    meta-data files are uploaded last, only if all the other files were
+    uploaded successfully.
+
+    Return a report in the same format as kernelci.storage.upload_files()
+    for all the files uploaded here, or upload_dedup() if *dedup* is set.
+
+    *output_path* is the path to the build output directory
+    *install_path* is the path to the install directory
+    *api* is the URL of the KernelCI backend API
+    *token* is the backend API token to use
+    *publish_path* is the target on KernelCI backend
+    *jobs* is the maximum number of concurrent uploads
+    *poll_interval* is the delay in seconds between checks for the daemon
+    *dedup* is whether to only upload the blobs missing from a
+            content-addressed storage, see kernelci.storage.upload_dedup()
+    *hashes* is an optional dictionary with the SHA-256 checksums of some of
+             the files already known, used with *dedup*
+    """
+    queue = UploadQueue(output_path)
+    queue.stop()
+    while queue.is_daemon_running():
+        time.sleep(poll_interval)
+    uploaded = queue.get_uploaded()
+    artifacts, meta = dict(), dict()
+    for rel_path, data in discover_files(install_path).items():
+        rel_path = os.path.normpath(rel_path)
+        if rel_path in META_FILES:
+            meta[rel_path] = data
+        elif uploaded.get(rel_path) != _get_file_state(data.path):
+            artifacts[rel_path] = data
+    report = _upload(
+        api, token, publish_path, artifacts, hashes, dedup, jobs)
+    if not report['failed']:
+        meta_report = _upload(
+            api, token, publish_path, meta, None, dedup, jobs)
+        for key in ('bytes', 'duration'):
+            report[key] += meta_report[key]
+        if dedup:
+            for key, value in meta_report['dedup'].items():
+                report['dedup'][key] += value
+        report['files'].update(meta_report['files'])
+        report['failed'] = meta_report['failed']
+        duration = report['duration']
+        report['throughput'] = report['bytes'] / duration if duration else 0
+    return report
@@ -15,10 +15,40 @@
 # along with this library; if not, write to the Free Software Foundation, Inc.,
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
 
+import concurrent.futures
 import os
+import threading
+import time
 import urllib.parse
 
-COMPRESSION_FORMATS = ['gz', 'bz2', 'xz']
+import requests
+
+import kernelci.http
+
+# File extensions and their compression format names
+COMPRESSION_FORMATS = {
+    'gz': 'gz',
+    'bz2': 'bz2',
+    'xz': 'xz',
+    'zst': 'zstd',
+}
+
+# Test parameters with the URLs of the artifacts needed to run a test job,
+# optional meta-data such as kselftests_index_url is not checked
+URL_PARAMS = [
+    'kernel_url',
+    'dtb_url',
+    'modules_url',
+    'kselftests_url',
+    'initrd_url',
+    'nfsrootfs_url',
+]
+
+# Default number of concurrent requests to check that URLs exist
+CHECK_JOBS = 16
+
+# Default time in seconds during which the result of a check is kept
+CHECK_TTL = 300
 
 
 def match_configs(configs, meta, lab):
@@ -84,7 +114,7 @@ def get_params(meta, target, plan_config, storage):
 
     def _get_compression(url):
         fmt = os.path.splitext(url)[1].replace('.', '') if url else ''
-        return fmt if fmt in COMPRESSION_FORMATS else ''
+        return COMPRESSION_FORMATS.get(fmt, '')
 
     kernel, rev = (meta.get('bmeta', key) for key in ['kernel', 'revision'])
     arch = target.arch
@@ -123,6 +153,11 @@ def get_params(meta, target, plan_config, storage):
         urllib.parse.urljoin(storage, '/'.join([url_px, kselftests]))
         if kselftests else None
     )
+    kselftests_index = meta.get_single_artifact('kselftest', 'index', 'path')
+    kselftests_index_url = (
+        urllib.parse.urljoin(storage, '/'.join([url_px, kselftests_index]))
+        if kselftests_index else None
+    )
     initrd_url = rootfs.get_url('ramdisk', arch, endian)
     initrd_compression = _get_compression(initrd_url)
     nfsroot_url = rootfs.get_url('nfs', arch, endian)
@@ -165,6 +200,7 @@ def get_params(meta, target, plan_config, storage):
         'file_server_resource': publish_path,
         'build_environment': meta.get('bmeta', 'environment', 'name'),
         'kselftests_url': kselftests_url,
+        'kselftests_index_url': kselftests_index_url,
     }
 
     params.update(rootfs.params)
@@ -172,3 +208,80 @@ def get_params(meta, target, plan_config, storage):
     params.update(target.params)
 
     return params
+
+
+class URLChecker:
+    """Check that artifact URLs exist, with a short-lived cache"""
+
+    def __init__(self, jobs=CHECK_JOBS, ttl=CHECK_TTL):
+        """A URLChecker sends HEAD requests to check whether URLs exist
+
+        Each URL is only checked once within the cache time-to-live, even if
+        it's needed by many test jobs.
+
+        *jobs* is the maximum number of concurrent requests
+        *ttl* is the time in seconds during which results are cached
+        """
+        self._jobs = jobs
+        self._ttl = ttl
+        self._cache = dict()
+        self._lock = threading.Lock()
+
+    def _head(self, url):
+        try:
+            resp = kernelci.http.head(url, allow_redirects=True)
+        except requests.RequestException:
+            return False
+        return resp.status_code == 200
+
+    def check(self, urls):
+        """Check a list of URLs concurrently
+
+        Return a dictionary with each URL as a key and whether it exists as
+        the value.
+
+        *urls* is an iterable with the URLs to check, duplicates and None
+               values are ignored
+        """
+        urls = set(url for url in urls if url)
+        now = time.monotonic()
+        results = dict()
+        with self._lock:
+            for url in urls:
+                cached = self._cache.get(url)
+                if cached and now - cached[1] < self._ttl:
+                    results[url] = cached[0]
+        missing = sorted(urls - set(results))
+        if missing:
+            with concurrent.futures.ThreadPoolExecutor(self._jobs) as pool:
+                checked = dict(zip(missing, pool.map(self._head, missing)))
+            now = time.monotonic()
+            with self._lock:
+                for url, exists in checked.items():
+                    self._cache[url] = (exists, now)
+            results.update(checked)
+        return results
+
+
+def get_missing_urls(params_list, checker=None):
+    """Get the artifact URLs which don't exist for each test job
+
+    All the URLs from all the jobs are checked together, so each one is only
+    requested once.  Return a list with a dictionary for each job in the
+    same order as *params_list*, with the parameter names as keys and the
+    missing URLs as values.
+
+    *params_list* is a list of test parameters as returned by get_params()
+    *checker* is a URLChecker object, or None to use a new one
+    """
+    checker = checker or URLChecker()
+    results = checker.check(
+        params.get(key) for params in params_list for key in URL_PARAMS
+    )
+    return list(
+        {
+            key: params[key] for key in URL_PARAMS
+            if params.get(key) and not results[params[key]]
+        }
+        for params in params_list
+    )
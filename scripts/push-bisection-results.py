@@ -20,7 +20,6 @@
 import argparse
 import json
 import re
-import requests
 import subprocess
 try:
     from io import StringIO
@@ -28,6 +27,8 @@ except ImportError:
     from io import StringIO
 import urllib.parse
 
+import kernelci.http
+
 RE_ADDR = r'.*@.*\.[a-z]+'
 RE_TRAILER = re.compile(r'^(?P<tag>[A-Z][a-z-]*)\: (?P<value>.*)$')
 RE_EMAIL = re.compile(r'^(?P<name>.*)(?P<email><{}>)'.format(RE_ADDR))
@@ -149,7 +150,8 @@ def upload_log(args, upload_path, log_file_name, token, api):
         ('file1', (log_file_name, StringIO(json.dumps(log_data, indent=4)))),
     }
     url = urllib.parse.urljoin(api, '/upload')
-    response = requests.post(url, headers=headers, data=data, files=files)
+    response = kernelci.http.post(
+        url, headers=headers, data=data, files=files)
     response.raise_for_status()
 
 
@@ -182,7 +184,8 @@ def send_result(args, log_file_name, token, api):
         'checks': checks_dict(args),
     })
     url = urllib.parse.urljoin(api, '/bisect')
-    response = requests.post(url, headers=headers, data=json.dumps(data))
+    response = kernelci.http.post(
+        url, headers=headers, data=json.dumps(data))
     response.raise_for_status()
 
 
@@ -237,7 +240,8 @@ def send_report(args, log_file_name, token, api):
     })
 
     url = urllib.parse.urljoin(api, '/send')
-    response = requests.post(url, headers=headers, data=json.dumps(data))
+    response = kernelci.http.post(
+        url, headers=headers, data=json.dumps(data))
     response.raise_for_status()
 
 
@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+
+# Copyright (C) 2021 Collabora Limited
+# Author: Guillaume Tucker <guillaume.tucker@collabora.com>
+#
+# This module is free software; you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation; either version 2.1 of the License, or (at your option)
+# any later version.
+#
+# This library is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this library; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""Benchmark artifact uploads and downloads
+
+Generate some fake build artifacts and measure the end-to-end throughput when
+pushing them, downloading a source tarball and submitting build meta-data.
+By default, a local storage server from kernelci.storage.devserver is started
+with the given latency and bandwidth limits.  An existing server can be used
+instead with --api and --storage.  This needs the kernelci package to be
+installed or in PYTHONPATH, for example:
+
+  PYTHONPATH=. scripts/storage-benchmark.py --latency=0.05 --bandwidth=10M
+"""
+
+import argparse
+import json
+import os
+import shutil
+import sys
+import tarfile
+import tempfile
+import threading
+import time
+import urllib.parse
+
+import kernelci.build
+import kernelci.config.data
+import kernelci.data
+import kernelci.http
+import kernelci.storage
+import kernelci.storage.devserver
+from kernelci import parse_size
+
+TOKEN = 'storage-benchmark'
+
+
+def create_artifacts(path, files, file_size, tarball_size):
+    """Create an install directory with random data"""
+    dtbs = os.path.join(path, 'dtbs')
+    os.makedirs(dtbs)
+    for index in range(files):
+        file_path = os.path.join(dtbs, 'board-{}.dtb'.format(index))
+        with open(file_path, 'wb') as dtb:
+            dtb.write(os.urandom(file_size))
+    with open(os.path.join(path, 'modules.tar.xz'), 'wb') as tarball:
+        for _ in range(0, tarball_size, 1024 * 1024):
+            tarball.write(os.urandom(1024 * 1024))
+
+
+def create_source_tarball(path, tarball_size):
+    """Create a source tarball to download"""
+    data_path = os.path.join(path, 'linux')
+    os.makedirs(data_path)
+    with open(os.path.join(data_path, 'data.bin'), 'wb') as data:
+        data.write(os.urandom(tarball_size))
+    tarball = os.path.join(path, 'linux-src.tar.gz')
+    with tarfile.open(tarball, 'w:gz', compresslevel=1) as tar:
+        tar.add(data_path, arcname='linux')
+    return tarball
+
+
+def run(name, func, size):
+    """Run a benchmark step and print the results"""
+    start = time.monotonic()
+    result = func()
+    duration = time.monotonic() - start
+    throughput = size / duration / 1e6 if duration else 0
+    status = "PASS" if result else "FAIL"
+    print("{:<16} {:>12} {:>8.2f}s {:>9.1f} MB/s  {}".format(
+        name, size, duration, throughput, status))
+    return result
+
+
+def benchmark(args, api, storage, work_dir):
+    install = os.path.join(work_dir, 'install')
+    create_artifacts(install, args.files, args.file_size, args.tarball_size)
+    artifacts = kernelci.storage.discover_files(install)
+    total = sum(data.size for data in artifacts.values())
+    tarball = create_source_tarball(work_dir, args.tarball_size)
+    tarball_size = os.path.getsize(tarball)
+    publish_path = 'storage-benchmark/{}'.format(int(time.time()))
+
+    print("{:<16} {:>12} {:>9} {:>14}".format(
+        "Step", "Bytes", "Time", "Throughput"))
+
+    def push_kernel():
+        report = kernelci.storage.upload_files(
+            api, args.token, publish_path, artifacts, jobs=args.jobs)
+        return not report['failed']
+
+    def push_dedup():
+        report = kernelci.storage.upload_dedup(
+            api, args.token, publish_path + '-dedup', artifacts,
+            jobs=args.jobs)
+        return not report['failed']
+
+    def push_tarball():
+        with open(tarball, 'rb') as tarball_file:
+            report = kernelci.storage.upload_files(
+                api, args.token, publish_path,
+                {'linux-src.tar.gz': tarball_file})
+        return not report['failed']
+
+    def pull_tarball():
+        url = urllib.parse.urljoin(
+            storage, '/'.join([publish_path, 'linux-src.tar.gz']))
+        return kernelci.build.pull_tarball(
+            os.path.join(work_dir, 'linux-pulled'), url,
+            os.path.join(work_dir, 'pulled.tar.gz'), 1, True)
+
+    config = kernelci.config.data.Backend(
+        'storage-benchmark', 'kernelci_backend', api)
+    db = kernelci.data.get_db(config, args.token)
+    build_data = {
+        'artifacts': {
+            'dtbs': list(
+                {'path': path, 'size': data.size}
+                for path, data in artifacts.items()
+            ),
+        },
+    }
+
+    def submit():
+        return all(db.submit({'build': build_data})
+                   for _ in range(args.submit_count))
+
+    results = [
+        run('push_kernel', push_kernel, total),
+        run('push_dedup', push_dedup, total),
+        run('push_dedup_warm', push_dedup, total),
+        run('push_tarball', push_tarball, tarball_size),
+        run('pull_tarball', pull_tarball, tarball_size),
+        run('submit', submit,
+            len(json.dumps(build_data).encode()) * args.submit_count),
+    ]
+    for host, metrics in kernelci.http.get_metrics().items():
+        print("{}: {} requests, {} retries, {} errors, {:.2f}s".format(
+            host, metrics['requests'], metrics['retries'],
+            metrics['errors'] + metrics['http_errors'], metrics['duration']))
+    return all(results)
+
+
+def main(args):
+    work_dir = tempfile.mkdtemp(prefix='kci-storage-benchmark-')
+    server = None
+    try:
+        if args.api:
+            api, storage = args.api, args.storage or args.api
+        else:
+            bandwidth = parse_size(args.bandwidth) if args.bandwidth else None
+            server = kernelci.storage.devserver.StorageServer(
+                ('127.0.0.1', 0), os.path.join(work_dir, 'storage'),
+                args.token,
+                latency=args.latency, bandwidth=bandwidth)
+            threading.Thread(target=server.serve_forever).start()
+            api = storage = 'http://127.0.0.1:{}/'.format(server.server_port)
+        return benchmark(args, api, storage, work_dir)
+    finally:
+        if server:
+            server.shutdown()
+            server.server_close()
+        shutil.rmtree(work_dir)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        "Benchmark artifact uploads and downloads")
+    parser.add_argument("--api",
+                        help="KernelCI API URL, to use an existing server")
+    parser.add_argument("--storage",
+                        help="Storage URL, same as --api by default")
+    parser.add_argument("--token", default=TOKEN,
+                        help="KernelCI API token")
+    parser.add_argument("--latency", type=float, default=0,
+                        help="Latency of the local server in seconds")
+    parser.add_argument("--bandwidth",
+                        help="Bandwidth limit of the local server per "
+                        "connection, e.g. 10M")
+    parser.add_argument("--files", type=int, default=1000,
+                        help="Number of small files to push")
+    parser.add_argument("--file-size", type=parse_size, default='32K',
+                        help="Size of each small file")
+    parser.add_argument("--tarball-size", type=parse_size, default='64M',
+                        help="Size of the tarballs to push and pull")
+    parser.add_argument("--jobs", type=int,
+                        help="Number of concurrent uploads")
+    parser.add_argument("--submit-count", type=int, default=10,
+                        help="Number of build meta-data submissions")
+    args = parser.parse_args()
+    sys.exit(0 if main(args) else 1)
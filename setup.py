@@ -30,6 +30,7 @@ setuptools.setup(
         "kernelci.config",
         "kernelci.lab",
         "kernelci.data",
+        "kernelci.storage",
     ],
     package_data={
         '': ['../doc/*.md'],
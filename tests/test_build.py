@@ -0,0 +1,420 @@
+# Copyright (C) 2021 Collabora Limited
+# Author: Guillaume Tucker <guillaume.tucker@collabora.com>
+#
+# This module is free software; you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation; either version 2.1 of the License, or (at your option)
+# any later version.
+#
+# This library is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this library; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+import gzip
+import hashlib
+import json
+import multiprocessing
+import os
+import tarfile
+import time
+
+import pytest
+
+import kernelci.build
+
+WRITERS = 16
+STEPS = 10
+ARTIFACTS = 20
+
+
+def _write_meta(data_path, writer):
+    step_name = 'step-{}'.format(writer)
+    for step in range(STEPS):
+        # Alternate between journal and direct writes to mix both
+        meta = kernelci.build.Metadata(data_path, journal=bool(writer % 2))
+        meta.get('bmeta').setdefault('kernel', dict())[step_name] = step
+        meta.get('bmeta')[step_name] = {'step': step}
+        for artifact in range(ARTIFACTS):
+            meta.add_artifact(
+                step_name, 'dir', 'file-{}-{}'.format(step, artifact))
+        meta.add_step({
+            'name': step_name,
+            'duration': 1,
+            'status': 'PASS',
+        })
+        meta.save()
+
+
+def test_metadata_concurrent_writers(tmp_path):
+    """Verify no meta-data is lost with many concurrent writers"""
+    data_path = str(tmp_path)
+    procs = list(
+        multiprocessing.Process(target=_write_meta, args=(data_path, writer))
+        for writer in range(WRITERS)
+    )
+    for proc in procs:
+        proc.start()
+    for proc in procs:
+        proc.join()
+        assert proc.exitcode == 0
+
+    meta = kernelci.build.Metadata(data_path)
+    meta.compact()
+    meta = kernelci.build.Metadata(data_path)
+    assert len(meta.get('steps')) == WRITERS * STEPS
+    assert meta.get('bmeta', 'build') == {
+        'duration': WRITERS * STEPS,
+        'status': 'PASS',
+    }
+    for writer in range(WRITERS):
+        step_name = 'step-{}'.format(writer)
+        assert meta.get('bmeta', 'kernel', step_name) == STEPS - 1
+        assert meta.get('bmeta', step_name) == {'step': STEPS - 1}
+        assert len(meta.get('artifacts', step_name)) == STEPS * ARTIFACTS
+
+
+@pytest.mark.parametrize('journal', [False, True])
+def test_metadata_new_section_merge(tmp_path, journal):
+    """Keep the keys added by another writer to a new section"""
+    data_path = str(tmp_path)
+    first = kernelci.build.Metadata(data_path, journal=journal)
+    second = kernelci.build.Metadata(data_path, journal=journal)
+    first.get('bmeta')['kernel'] = {'A': 1}
+    second.get('bmeta')['kernel'] = {'B': 1}
+    first.save()
+    second.save()
+    meta = kernelci.build.Metadata(data_path)
+    meta.compact()
+    meta = kernelci.build.Metadata(data_path)
+    assert meta.get('bmeta', 'kernel') == {'A': 1, 'B': 1}
+
+
+def _make_step(name):
+    return {'name': name, 'duration': 1, 'status': 'PASS'}
+
+
+def test_metadata_journal_torn_write(tmp_path):
+    """Replay a journal with an incomplete last record and compact it"""
+    data_path = str(tmp_path)
+    meta = kernelci.build.Metadata(data_path, journal=True)
+    meta.get('bmeta')['kernel'] = {'defconfig': 'defconfig'}
+    meta.add_artifact('kernel', 'kernel', 'Image')
+    meta.add_step(_make_step('kernel'))
+    meta.save()
+    journal = tmp_path / 'meta.journal'
+    with open(str(journal), 'a') as journal_file:
+        journal_file.write('{"step": {"name": "torn", "dur')
+
+    meta = kernelci.build.Metadata(data_path, journal=True)
+    assert list(step['name'] for step in meta.get('steps')) == ['kernel']
+    assert meta.get('bmeta', 'kernel') == {'defconfig': 'defconfig'}
+    meta.add_step(_make_step('modules'))
+    meta.save()
+    assert journal.read_text().endswith('\n')
+
+    meta = kernelci.build.Metadata(data_path)
+    assert list(step['name'] for step in meta.get('steps')) == [
+        'kernel', 'modules',
+    ]
+    meta.compact()
+    assert not journal.exists()
+    meta = kernelci.build.Metadata(data_path)
+    assert list(step['name'] for step in meta.get('steps')) == [
+        'kernel', 'modules',
+    ]
+    assert meta.get('bmeta', 'build') == {'duration': 2, 'status': 'PASS'}
+    assert meta.get('artifacts', 'kernel') == [
+        {'type': 'file', 'path': 'kernel/Image'},
+    ]
+
+
+def test_metadata_artifacts_benchmark(tmp_path):
+    """Install a large number of artifacts and look them up by key"""
+    count = 20000
+    meta = kernelci.build.Metadata(str(tmp_path), journal=True)
+    start = time.monotonic()
+    for index in range(count):
+        name = 'module-{}.ko'.format(index)
+        meta.add_artifact('modules', 'lib/modules', name, key=name)
+    for index in range(count):
+        name = 'module-{}.ko'.format(index)
+        path = meta.get_single_artifact('modules', name, 'path')
+        assert path == 'lib/modules/' + name
+    meta.save()
+    meta.compact()
+    duration = time.monotonic() - start
+    print("\n{} artifacts: {:.3f}s".format(count, duration))
+    assert len(meta.get('artifacts', 'modules')) == count
+    # Generous limit, this used to take about a minute
+    assert duration < 30
+
+
+def test_config_cache_key(tmp_path):
+    """Only the Kconfig inputs affect the config cache key"""
+    kdir = tmp_path / 'linux'
+    files = {
+        'Kconfig': 'source "arch/$(SRCARCH)/Kconfig"\nsource "init/Kconfig"\n',
+        'arch/x86/Kconfig': 'config X86\n\trsource "Kconfig.cpu"\n',
+        'arch/x86/Kconfig.cpu': 'config CPU\n',
+        'arch/x86/configs/x86_64_defconfig': 'CONFIG_X86=y\n',
+        'arch/arm64/Kconfig': 'config ARM64\n',
+        'init/Kconfig': 'config INIT\n',
+        'scripts/kconfig/conf.c': 'int main(void);\n',
+        'scripts/setlocalversion.sh': 'echo\n',
+        'drivers/foo.c': 'int foo;\n',
+    }
+    for rel_path, content in files.items():
+        path = kdir / rel_path
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(content)
+    bmeta = {
+        'environment': {
+            'arch': 'x86_64',
+            'compiler': 'gcc',
+            'compiler_version_full': 'gcc 10',
+            'cross_compile': '',
+            'cross_compile_compat': '',
+            'make_opts': {},
+        },
+        'kernel': {'defconfig_expanded': 'x86_64_defconfig'},
+    }
+
+    def get_key():
+        return kernelci.build.ConfigCache.get_key(str(kdir), bmeta)
+
+    key = get_key()
+    for rel_path in ['drivers/foo.c', 'arch/arm64/Kconfig']:
+        (kdir / rel_path).write_text('changed\n')
+        assert get_key() == key
+    for rel_path in ['arch/x86/Kconfig.cpu', 'init/Kconfig',
+                     'arch/x86/configs/x86_64_defconfig',
+                     'scripts/kconfig/conf.c', 'scripts/setlocalversion.sh']:
+        (kdir / rel_path).write_text('changed\n')
+        new_key = get_key()
+        assert new_key != key
+        key = new_key
+
+
+def test_modules_tarball(tmp_path):
+    """Hash each module while creating the tarball, keyed by path"""
+    step = kernelci.build.MakeModules(str(tmp_path))
+    mod_dir = tmp_path / 'build' / '_modules_' / 'lib' / 'modules' / '5.10'
+    modules = {
+        'kernel/drivers/a/foo.ko': b'foo in a',
+        'kernel/drivers/b/foo.ko': b'foo in b',
+        'kernel/fs/bar.ko': b'bar',
+    }
+    for rel_path, data in modules.items():
+        path = mod_dir / rel_path
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(data)
+    (mod_dir / 'modules.dep').write_text('')
+
+    tarball, contents = step._create_modules_tarball(False, 'gz')
+    assert tarball == 'modules.tar.gz'
+    assert contents == ['bar.ko', 'foo.ko']
+    installed = step._installed[tarball]
+    keys = list(os.path.join('lib', 'modules', '5.10', rel_path)
+                for rel_path in modules)
+    assert installed['contents_size'] == {
+        key: len(data) for key, data in zip(keys, modules.values())
+    }
+    assert installed['contents_sha256'] == {
+        key: hashlib.sha256(data).hexdigest()
+        for key, data in zip(keys, modules.values())
+    }
+    tarball_path = os.path.join(step.install_path, tarball)
+    with open(tarball_path, 'rb') as tarball_file:
+        assert installed['sha256'] == \
+            hashlib.sha256(tarball_file.read()).hexdigest()
+    with tarfile.open(tarball_path) as tar:
+        for key, data in zip(keys, modules.values()):
+            assert tar.extractfile('./' + key).read() == data
+
+
+def test_tarball_index(tmp_path):
+    """Index a directory packed in a tarball and load the index"""
+    src = tmp_path / 'kselftest_install'
+    (src / 'net').mkdir(parents=True)
+    (src / 'kselftest-packages').mkdir()
+    files = {
+        'run_kselftest.sh': b'#!/bin/sh\n',
+        'net/data.bin': bytes(range(256)) * 1000,
+    }
+    for rel_path, data in files.items():
+        (src / rel_path).write_bytes(data)
+    (src / 'link').symlink_to('run_kselftest.sh')
+    tarball = src / 'kselftest-packages' / 'kselftest.tar'
+    with tarfile.open(str(tarball), 'w', format=tarfile.GNU_FORMAT) as tar:
+        for path in sorted(src.iterdir()):
+            if path.name != 'kselftest-packages':
+                tar.add(str(path), './' + path.name)
+
+    index = kernelci.build.TarballIndex.scan(
+        str(src), exclude=['kselftest-packages'])
+    index_path = str(tmp_path / 'kselftest.tar.index.json')
+    index.save(index_path)
+    members = kernelci.build.TarballIndex.load(index_path)
+
+    assert members == index.members
+    with tarfile.open(str(tarball)) as tar:
+        expected = sorted(
+            [info.name, 'f' if info.isreg() else 'd' if info.isdir()
+             else 'l' if info.issym() else 'o', info.size]
+            for info in tar
+        )
+    assert members == expected
+    assert [name for name, _, _ in members] == [
+        './link', './net', './net/data.bin', './run_kselftest.sh',
+    ]
+
+
+BMETA = {
+    'revision': {'tree': 'mainline', 'branch': 'master'},
+    'environment': {
+        'arch': 'x86_64', 'name': 'gcc-10', 'compiler': 'gcc',
+        'cross_compile': '', 'cross_compile_compat': '', 'use_ccache': False,
+        'make_opts': {},
+    },
+    'kernel': {'defconfig_full': 'defconfig'},
+}
+
+
+def test_output_cache(tmp_path):
+    """Save and restore an output directory without the build files"""
+    output = tmp_path / 'output'
+    (output / 'kernel').mkdir(parents=True)
+    (output / 'kernel' / 'fork.o').write_bytes(b'fork')
+    (output / '.config').write_text('CONFIG_X=y\n')
+    (output / '_install_').mkdir()
+    (output / 'bmeta.json').write_text('{}')
+    (output / 'kernel.log').write_text('log')
+    cache = kernelci.build.OutputCache(str(tmp_path / 'cache'))
+    key = cache.get_key(BMETA)
+    assert key == cache.get_key(dict(BMETA))
+    assert cache.get_key({'revision': BMETA['revision']}) is None
+
+    restored = tmp_path / 'restored'
+    restored.mkdir()
+    assert not cache.restore(key, str(restored))
+    assert cache.save(key, str(output))
+    (output / 'kernel' / 'fork.o').write_bytes(b'new')
+    assert cache.save(key, str(output))
+    assert cache.restore(key, str(restored))
+    assert sorted(
+        str(path.relative_to(restored)) for path in restored.rglob('*')
+    ) == ['.config', 'kernel', 'kernel/fork.o']
+    assert (restored / 'kernel' / 'fork.o').read_bytes() == b'new'
+    assert sorted(os.listdir(str(tmp_path / 'cache'))) == [key]
+
+
+class ObjectStep(kernelci.build.Step):
+    """Build step which runs make to rebuild one object"""
+
+    @property
+    def name(self):
+        return 'kernel'
+
+    def run(self, jopt=None, verbose=False, opts=None):
+        res = self._make('all', 1, verbose)
+        res = res and self._make('all', 1, verbose)
+        return self._add_run_step(res, jopt)
+
+
+def test_objects_rebuilt(tmp_path):
+    """Count the objects rebuilt after restoring an output directory"""
+    (tmp_path / 'Makefile').write_text(
+        'all:\n'
+        '\ttouch $(O)/kernel/.fork.o.d $(O)/kernel/fork.o\n'
+        '\trm $(O)/kernel/.fork.o.d\n'
+    )
+    output = tmp_path / 'build'
+    for name in ('kernel/fork.o', 'mm/slab.o', 'mm/slub.o'):
+        (output / name).parent.mkdir(parents=True, exist_ok=True)
+        (output / name).write_bytes(b'')
+    for path in output.rglob('*'):
+        os.utime(str(path), (0, 0))
+    meta = kernelci.build.Metadata(str(output))
+    meta.get('bmeta').update(BMETA)
+    meta.get('bmeta', 'kernel')['output_cache'] = {'restored': True}
+    meta.save()
+
+    step = ObjectStep(str(tmp_path))
+    assert step.run()
+    meta = kernelci.build.Metadata(str(output))
+    assert meta.get('steps')[0]['objects_rebuilt'] == 1
+    assert meta.get('bmeta', 'kernel', 'output_cache') == {
+        'restored': True,
+        'objects_rebuilt': 1,
+    }
+
+
+class LogStep(kernelci.build.Step):
+    """Build step which only writes a log file"""
+
+    @property
+    def name(self):
+        return 'kernel'
+
+    def run(self, jopt=None, verbose=False, opts=None):
+        with open(self._log_path, 'w') as log_file:
+            log_file.write("Building the kernel\n" * 1000)
+        return self._add_run_step(True, jopt)
+
+
+def test_compact_on_install(tmp_path):
+    """Record the steps in the journal and compact it when installing"""
+    step = LogStep(str(tmp_path))
+    assert step.run()
+    output = tmp_path / 'build'
+    journal = output / 'meta.journal'
+    assert journal.exists()
+    assert not (output / 'steps.json').exists()
+    assert step.install()
+    assert not journal.exists()
+    steps = json.loads((output / 'steps.json').read_text())
+    assert list(item['name'] for item in steps) == [
+        'kernel', 'kernel install',
+    ]
+    installed = kernelci.build.Metadata(str(output / '_install_'))
+    assert installed.get('steps') == steps
+
+
+def test_compress_text(tmp_path):
+    """Install compressed logs and meta-data and point to them"""
+    step = LogStep(str(tmp_path), compress_text=True)
+    assert step.run()
+    assert step.install()
+    install = tmp_path / 'build' / '_install_'
+    installed = sorted(
+        str(path.relative_to(install)) for path in install.rglob('*')
+        if path.is_file())
+    assert installed == [
+        'artifacts.json.gz', 'bmeta.json.gz', 'logs/kernel.log.gz',
+        'steps.json.gz',
+    ]
+    meta = kernelci.build.Metadata(str(install))
+    steps = meta.get('steps')
+    assert list(step['log_file'] for step in steps) == ['kernel.log.gz'] * 2
+    log_path = install / 'logs' / steps[0]['log_file']
+    with gzip.open(str(log_path), 'rt') as log_file:
+        assert log_file.read() == "Building the kernel\n" * 1000
+    artifact = meta.get('artifacts', 'kernel')[0]
+    assert artifact['path'] == 'logs/kernel.log.gz'
+    assert artifact['encoding'] == 'gzip'
+    assert artifact['sha256'] == \
+        hashlib.sha256(log_path.read_bytes()).hexdigest()
+
+    # Installing again without compression replaces the compressed files
+    step = LogStep(str(tmp_path))
+    assert step.run()
+    assert step.install()
+    assert (install / 'logs' / 'kernel.log').exists()
+    assert not (install / 'logs' / 'kernel.log.gz').exists()
+    assert kernelci.build.Metadata(str(install)).get(
+        'steps')[-1]['log_file'] == 'kernel.log'
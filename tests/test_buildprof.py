@@ -0,0 +1,83 @@
+# Copyright (C) 2021 Collabora Limited
+# Author: Guillaume Tucker <guillaume.tucker@collabora.com>
+#
+# This module is free software; you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation; either version 2.1 of the License, or (at your option)
+# any later version.
+#
+# This library is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this library; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+import os
+
+import kernelci.buildprof
+
+
+def test_run_wrapper(tmp_path):
+    """Record one line per compiled object and skip other commands"""
+    log_path = str(tmp_path / 'profile.csv')
+    obj = str(tmp_path / 'foo.o')
+    stats_log = tmp_path / 'stats.log'
+    cc = ['sh', '-c', 'printf 12345 > "$1"', '-o', obj]
+    assert kernelci.buildprof.run_wrapper(log_path, cc) == 0
+    assert kernelci.buildprof.run_wrapper(log_path, ['false', '-c',
+                                                     '-o', obj]) == 1
+    entries = kernelci.buildprof.load(log_path)
+    assert len(entries) == 1
+    duration, cache, size, path = entries[0]
+    assert duration >= 0
+    assert cache == ''
+    assert size == 5
+    assert path == os.path.relpath(obj)
+
+    stats_log.write_text("# comment\ncache_miss\n")
+    assert kernelci.buildprof._read_ccache_result(str(stats_log)) == 'miss'
+    stats_log.write_text("direct_cache_hit\n")
+    assert kernelci.buildprof._read_ccache_result(str(stats_log)) == 'hit'
+    assert kernelci.buildprof._read_ccache_result(
+        str(tmp_path / 'missing.log')) == ''
+
+
+def test_summarise_compare(tmp_path):
+    """Aggregate the profile entries by directory and compare them"""
+    log_path = tmp_path / 'profile.csv'
+    log_path.write_text(''.join([
+        "100,hit,10,drivers/foo/a.o\n",
+        "300,miss,20,drivers/foo/b.o\n",
+        "50,,5,init.o\n",
+        "200,miss,40,fs/c.o\n",
+    ]))
+    base = kernelci.buildprof.summarise(
+        kernelci.buildprof.load(str(log_path)))
+    assert base['drivers/foo'] == {
+        'duration': 400,
+        'objects': 2,
+        'hits': 1,
+        'misses': 1,
+        'size': 30,
+    }
+    assert base['.'] == {
+        'duration': 50,
+        'objects': 1,
+        'hits': 0,
+        'misses': 0,
+        'size': 5,
+    }
+    new = {
+        'drivers/foo': dict(base['drivers/foo'], duration=100),
+        'fs': dict(base['fs'], duration=900),
+        'mm': dict(base['fs'], duration=10),
+    }
+    assert kernelci.buildprof.compare(base, new) == [
+        ('fs', 200, 900),
+        ('mm', 0, 10),
+        ('.', 50, 0),
+        ('drivers/foo', 400, 100),
+    ]
@@ -0,0 +1,187 @@
+# Copyright (C) 2021 Collabora Limited
+# Author: Guillaume Tucker <guillaume.tucker@collabora.com>
+#
+# This module is free software; you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation; either version 2.1 of the License, or (at your option)
+# any later version.
+#
+# This library is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this library; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+import io
+import threading
+
+import kernelci.ccache
+
+
+def _put(store, key, data):
+    stream = io.BytesIO(data)
+    stored = store.put(key, stream, len(data))
+    assert stream.tell() == len(data)
+    return stored
+
+
+def test_cache_store_lru(tmp_path):
+    """Evict the least recently used files above the maximum size"""
+    store = kernelci.ccache.CacheStore(str(tmp_path), 100)
+    assert _put(store, 'a/1', b'a' * 40)
+    assert _put(store, 'b/2', b'b' * 40)
+    store.open('a/1').close()
+    assert _put(store, 'c/3', b'c' * 40)
+    assert store.size == 80
+    assert store.open('b/2') is None
+    assert not (tmp_path / 'b' / '2').exists()
+
+    cached = store.open('a/1')
+    assert _put(store, 'd/4', b'd' * 90)
+    assert store.open('a/1') is None
+    with cached:
+        assert cached.read() == b'a' * 40
+
+    reloaded = kernelci.ccache.CacheStore(str(tmp_path), 100)
+    assert reloaded.size == 90
+    with reloaded.open('d/4') as cached:
+        assert cached.read() == b'd' * 90
+
+
+def test_cache_store_max_size(tmp_path):
+    """Discard files larger than the cache"""
+    store = kernelci.ccache.CacheStore(str(tmp_path), 100)
+    assert _put(store, 'small', b'x' * 100)
+    assert not _put(store, 'large', b'y' * 101)
+    assert store.open('large') is None
+    assert store.size == 100
+    with store.open('small') as cached:
+        assert cached.read() == b'x' * 100
+
+
+def test_cache_store_concurrent(tmp_path):
+    """Keep the size and files consistent with concurrent requests"""
+    store = kernelci.ccache.CacheStore(str(tmp_path), 1000)
+
+    def worker(index):
+        for count in range(50):
+            key = 'obj/{}'.format((index + count) % 20)
+            _put(store, key, bytes(50 + index))
+            store.delete('obj/{}'.format((index * count) % 20))
+
+    threads = list(threading.Thread(target=worker, args=(index,))
+                   for index in range(8))
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    on_disk = {
+        str(path.relative_to(tmp_path)): path.stat().st_size
+        for path in tmp_path.rglob('*') if path.is_file()
+    }
+    assert store.size == sum(on_disk.values()) <= 1000
+    for key, size in on_disk.items():
+        with store.open(key) as cached:
+            assert len(cached.read()) == size
+
+
+def test_cache_store_delete_missing(tmp_path):
+    """Report a file removed behind the cache's back as not found"""
+    store = kernelci.ccache.CacheStore(str(tmp_path), 100)
+    assert _put(store, 'a/1', b'a' * 40)
+    (tmp_path / 'a' / '1').unlink()
+    assert not store.delete('a/1')
+    assert store.size == 0
+    assert not store.delete('a/1')
+
+
+# Output of ccache 4.6 --print-stats
+CCACHE_4_STATS = """\
+autoconf_test\t0
+bad_compiler_arguments\t2
+cache_miss\t120
+cache_size_kibibyte\t51200
+called_for_link\t35
+called_for_preprocessing\t0
+compile_failed\t1
+direct_cache_hit\t300
+direct_cache_miss\t140
+files_in_cache\t480
+no_input_file\t3
+preprocessed_cache_hit\t20
+preprocessed_cache_miss\t120
+stats_updated_timestamp\t1634567890
+stats_zeroed_timestamp\t0
+"""
+
+# Output of ccache 3.7 --print-stats, without any cache size
+CCACHE_3_STATS = """\
+stats_zeroed_timestamp\t1634567890
+cache_hit_direct\t0
+cache_hit_preprocessed\t0
+cache_miss\t7
+called_for_link\t2
+"""
+
+
+def test_parse_stats():
+    """Parse the counters from ccache 3.7 and 4.x"""
+    assert kernelci.ccache.parse_stats(CCACHE_4_STATS) == {
+        'hits': 320,
+        'misses': 120,
+        'uncacheable': 41,
+        'size': 51200 * 1024,
+    }
+    stats = kernelci.ccache.parse_stats(CCACHE_3_STATS)
+    assert stats == {'hits': 0, 'misses': 7, 'uncacheable': 2, 'size': 0}
+    assert kernelci.ccache.hit_rate(stats) == 0.0
+    empty = kernelci.ccache.parse_stats("stats_zeroed_timestamp\tnever\n")
+    assert empty == {'hits': 0, 'misses': 0, 'uncacheable': 0, 'size': 0}
+    assert kernelci.ccache.hit_rate(empty) is None
+
+
+def test_diff_add_stats():
+    """Get the statistics of each step and add them up"""
+    before = kernelci.ccache.parse_stats(CCACHE_3_STATS)
+    after = kernelci.ccache.parse_stats(CCACHE_4_STATS)
+    diff = kernelci.ccache.diff_stats(before, after)
+    assert diff == {
+        'hits': 320, 'misses': 113, 'uncacheable': 39, 'size': 51200 * 1024,
+    }
+    total = kernelci.ccache.add_stats(dict(), diff)
+    assert kernelci.ccache.add_stats(total, diff) is total
+    assert total == {
+        'hits': 640, 'misses': 226, 'uncacheable': 78, 'size': 51200 * 1024,
+    }
+    assert kernelci.ccache.hit_rate(total) == 640 * 100.0 / 866
+
+
+def test_report():
+    """Aggregate the statistics of several builds in a table"""
+    env = {'arch': 'arm64', 'compiler': 'gcc', 'name': 'gcc-10'}
+    bmeta_list = [
+        {'environment': env, 'ccache': {
+            'hits': 30, 'misses': 10, 'uncacheable': 5, 'size': 3 << 20}},
+        {'environment': env, 'ccache': {
+            'hits': 50, 'misses': 10, 'uncacheable': 1, 'size': 2 << 20}},
+        {'environment': dict(env, arch='x86_64'), 'ccache': {
+            'hits': 0, 'misses': 0, 'uncacheable': 7, 'size': 0}},
+        {'environment': env},
+    ]
+    groups = kernelci.ccache.report(bmeta_list)
+    assert groups[('arm64', 'gcc', 'gcc-10')] == {
+        'builds': 2, 'hits': 80, 'misses': 20, 'uncacheable': 6,
+        'size': 3 << 20,
+    }
+    assert kernelci.ccache.format_report(groups) == [
+        "  builds     hits   misses  uncache   rate  size (MB)  "
+        "arch/compiler/build_env",
+        "       2       80       20        6  80.0%          3  "
+        "arm64/gcc/gcc-10",
+        "       1        0        0        7      -          0  "
+        "x86_64/gcc/gcc-10",
+    ]
@@ -0,0 +1,116 @@
+# Copyright (C) 2021 Collabora Limited
+# Author: Guillaume Tucker <guillaume.tucker@collabora.com>
+#
+# This module is free software; you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation; either version 2.1 of the License, or (at your option)
+# any later version.
+#
+# This library is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this library; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+import time
+
+import kernelci.data
+import kernelci.data.spool
+
+
+class FakeDatabase(kernelci.data.Database):
+    """Fail all submissions until it's online"""
+
+    def __init__(self):
+        super().__init__(None)
+        self.online = False
+        self.rejected = []
+        self.submitted = []
+
+    def submit(self, data, verbose=False):
+        if not self.online:
+            return False
+        self.submitted.extend(data.items())
+        return True
+
+    def submit_one(self, path, data, verbose=False):
+        if data in self.rejected:
+            raise kernelci.data.Rejected("Bad data")
+        return super().submit_one(path, data, verbose)
+
+
+def test_spool(tmp_path):
+    """Keep submissions until they can be sent, in order and only once"""
+    db = FakeDatabase()
+    spool = kernelci.data.spool.Spool(str(tmp_path / 'spool'))
+    for index in range(5):
+        assert spool.add('test', {'index': index})
+    assert not spool.add('test', {'index': 0})
+
+    def submit(path, data):
+        return db.submit_one(path, data)
+
+    offline = spool.flush(submit, retries=1, backoff=0)
+    assert offline == {'submitted': 0, 'failed': 1, 'rejected': 0}
+    assert spool.get_metrics()['pending'] == 5
+
+    db.online = True
+    spooled = kernelci.data.spool.SpooledDatabase(
+        db, spool.path, interval=0.1)
+    assert spooled.submit_test({'index': 5})
+    assert spooled.submit({'test': {'index': 1}})
+    spooled.close(timeout=10)
+
+    assert db.submitted == list(('test', {'index': index})
+                                for index in range(6))
+    metrics = spool.get_metrics()
+    assert metrics['pending'] == 0
+    assert metrics['bytes'] == 0
+    assert spool.flush(submit) == {'submitted': 0, 'failed': 0, 'rejected': 0}
+    assert spool.add('test', {'index': 3})
+    assert spool.flush(submit) == {'submitted': 1, 'failed': 0, 'rejected': 0}
+    assert db.submitted[-1] == ('test', {'index': 3})
+
+
+def test_spool_rejected(tmp_path):
+    """Carry on flushing after a submission has been rejected"""
+    db = FakeDatabase()
+    db.online = True
+    db.rejected.append({'index': 1})
+    spool = kernelci.data.spool.Spool(str(tmp_path / 'spool'))
+    for index in range(3):
+        assert spool.add('test', {'index': index})
+
+    def submit(path, data):
+        return db.submit_one(path, data)
+
+    report = spool.flush(submit, retries=3, backoff=10)
+    assert report == {'submitted': 2, 'failed': 0, 'rejected': 1}
+    assert db.submitted == [('test', {'index': 0}), ('test', {'index': 2})]
+    metrics = spool.get_metrics()
+    assert metrics['pending'] == 1
+    assert metrics['stalled'] == 1
+    assert spool.get_pending()[0]['rejected']
+    assert spool.flush(submit) == {'submitted': 0, 'failed': 0, 'rejected': 0}
+
+
+def test_spool_close_offline(tmp_path):
+    """Don't wait for the retries when closing with the database offline"""
+    db = FakeDatabase()
+    spool_path = str(tmp_path / 'spool')
+    spooled = kernelci.data.spool.SpooledDatabase(db, spool_path)
+    start = time.monotonic()
+    assert spooled.submit_test({'index': 0})
+    assert spooled.submit_test({'index': 1})
+    spooled.close()
+    assert time.monotonic() - start < kernelci.data.spool.BACKOFF
+
+    pending = kernelci.data.spool.Spool(spool_path).get_pending()
+    assert list(entry['data'] for entry in pending) == [
+        {'index': 0}, {'index': 1},
+    ]
+    assert pending[0]['attempts'] == 1
+    assert 'attempts' not in pending[1]
@@ -0,0 +1,192 @@
+# Copyright (C) 2021 Collabora Limited
+# Author: Guillaume Tucker <guillaume.tucker@collabora.com>
+#
+# This module is free software; you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation; either version 2.1 of the License, or (at your option)
+# any later version.
+#
+# This library is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this library; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+import struct
+import time
+
+import pytest
+
+import kernelci.elf
+
+SHT_PROGBITS = 1
+SHT_STRTAB = 3
+SHT_NOBITS = 8
+SHF_WRITE = 1
+SHF_ALLOC = 2
+SHF_EXECINSTR = 4
+
+
+def _make_elf(path, sections, elf_class=64, endian='<', data_size=0,
+              contents=None):
+    """Write a synthetic ELF file with some sections
+
+    *sections* is a list of (name, type, flags, size) tuples
+    *data_size* is the size of a sparse area to make the file bigger
+    *contents* is a dictionary with section indexes as keys and (data, link)
+               tuples as values for sections with some actual contents
+    """
+    names = b'\0'
+    name_offsets = []
+    for name, _, _, _ in sections + [('.shstrtab', 0, 0, 0)]:
+        name_offsets.append(len(names))
+        names += name.encode() + b'\0'
+    ehsize = 52 if elf_class == 32 else 64
+    shentsize = 40 if elf_class == 32 else 64
+    strtab_offset = ehsize + data_size
+    contents_offset = strtab_offset + len(names)
+    offsets = dict()
+    for index, (data, _) in sorted((contents or {}).items()):
+        offsets[index] = contents_offset
+        contents_offset += len(data)
+    shoff = contents_offset
+    shnum = len(sections) + 2
+    header_fmt = endian + kernelci.elf.ELF_HEADER[elf_class // 32]
+    section_fmt = endian + kernelci.elf.ELF_SECTION[elf_class // 32]
+    ident = b'\x7fELF' + bytes([elf_class // 32, 1 if endian == '<' else 2,
+                                1]) + bytes(9)
+    header = struct.pack(header_fmt, 2, 62, 1, 0, 0, shoff, 0, ehsize, 0, 0,
+                         shentsize, shnum, shnum - 1)
+    headers = [struct.pack(section_fmt, *([0] * 10))]
+    for index, (name, sh_type, flags, size) in enumerate(sections, 1):
+        data, link = (contents or {}).get(index, (None, 0))
+        headers.append(struct.pack(
+            section_fmt, name_offsets[index - 1], sh_type, flags, 0,
+            offsets.get(index, ehsize), len(data) if data else size, link, 0,
+            1, 0))
+    headers.append(struct.pack(
+        section_fmt, name_offsets[-1], SHT_STRTAB, 0, 0, strtab_offset,
+        len(names), 0, 0, 1, 0))
+    with open(path, 'wb') as elf_file:
+        elf_file.write(ident + header)
+        elf_file.seek(strtab_offset)
+        elf_file.write(names)
+        for _, (data, _) in sorted((contents or {}).items()):
+            elf_file.write(data)
+        elf_file.write(b''.join(headers))
+
+
+VMLINUX_SECTIONS = [
+    ('.text', SHT_PROGBITS, SHF_ALLOC | SHF_EXECINSTR, 0x1000000),
+    ('.rodata', SHT_PROGBITS, SHF_ALLOC, 0x400000),
+    ('.init.data', SHT_PROGBITS, SHF_ALLOC | SHF_WRITE, 0x20000),
+    ('.bss', SHT_NOBITS, SHF_ALLOC | SHF_WRITE, 0x80000),
+]
+
+
+@pytest.mark.parametrize('elf_class,endian', [
+    (32, '<'), (32, '>'), (64, '<'), (64, '>'),
+])
+def test_elf_read(tmp_path, elf_class, endian):
+    """Verify the ELF reader gives the same results as pyelftools"""
+    vmlinux = str(tmp_path / 'vmlinux')
+    _make_elf(vmlinux, VMLINUX_SECTIONS, elf_class, endian)
+    expected = {
+        'vmlinux_text_size': 0x1000000,
+        'vmlinux_bss_size': 0x80000,
+        'vmlinux_data_size': 0x420000,
+    }
+    assert kernelci.elf.read_pyelftools(vmlinux) == expected
+    assert kernelci.elf.read(vmlinux) == expected
+    _make_elf(vmlinux, VMLINUX_SECTIONS + [
+        ('.data', SHT_PROGBITS, SHF_ALLOC | SHF_WRITE, 0x2000)
+    ], elf_class, endian)
+    assert kernelci.elf.read(vmlinux)['vmlinux_data_size'] == 0x2000
+
+
+def test_elf_read_benchmark(tmp_path):
+    """Read a large ELF file with many sections"""
+    vmlinux = str(tmp_path / 'vmlinux')
+    debug_sections = list(
+        ('.debug_{}'.format(index), SHT_PROGBITS, 0, 0x1000)
+        for index in range(20000)
+    )
+    _make_elf(vmlinux, VMLINUX_SECTIONS + debug_sections,
+              data_size=512 * 1024 * 1024)
+
+    start = time.monotonic()
+    slow = kernelci.elf.read_pyelftools(vmlinux)
+    slow_duration = time.monotonic() - start
+    start = time.monotonic()
+    fast = kernelci.elf.read(vmlinux)
+    fast_duration = time.monotonic() - start
+    print("\npyelftools: {:.3f}s, mmap: {:.3f}s".format(
+        slow_duration, fast_duration))
+    assert fast == slow
+
+
+def test_elf_size_info(tmp_path):
+    """Read and compare the symbol sizes from a large symbol table"""
+    count = 200000
+    sections = VMLINUX_SECTIONS + [
+        ('.symtab', 2, 0, 0),
+        ('.strtab', 3, 0, 0),
+    ]
+    sym_fmt = struct.Struct('<' + kernelci.elf.ELF_SYMBOL[2])
+    strtab = bytearray(b'\0file.c\0')
+    symbols = [sym_fmt.pack(0, 0, 0, 0, 0, 0), sym_fmt.pack(1, 4, 0, 0, 0, 0)]
+    for index in range(count):
+        name_offset = len(strtab)
+        strtab += 'sym_{}\0'.format(index).encode()
+        bind = 0 if index % 2 else 1 << 4
+        shndx, sym_type = (1, 2) if index % 3 else (3, 1)
+        symbols.append(sym_fmt.pack(
+            name_offset, bind | sym_type, 0, shndx, index * 16, index % 100))
+    vmlinux = str(tmp_path / 'vmlinux')
+    _make_elf(vmlinux, sections, contents={
+        5: (b''.join(symbols), 6),
+        6: (bytes(strtab), 0),
+    })
+
+    start = time.monotonic()
+    size_info = kernelci.elf.read_size_info(vmlinux)
+    duration = time.monotonic() - start
+    print("\n{} symbols: {:.3f}s".format(count, duration))
+    assert size_info['symbols'][0] == ['sym_100099', 't', 99]
+    assert size_info['sections']['.text'] == 0x1000000
+    assert size_info['objects']['file.c'] == sum(
+        index % 100 for index in range(1, count, 2))
+
+    size_path = str(tmp_path / kernelci.elf.SIZE_INFO_FILE)
+    kernelci.elf.save_size_info(size_info, size_path)
+    base = kernelci.elf.load_size_info(size_path)
+    assert base == size_info
+    new = {'symbols': [['sym_1', 't', 50], ['new_sym', 'd', 8]]}
+    diff = kernelci.elf.diff_size_info(base, new)
+    assert diff['added'] == 1
+    assert diff['grown'] == 1
+    assert diff['removed'] == len(base['symbols']) - 1
+    assert ('new_sym', None, 8) in diff['symbols']
+
+
+def test_elf_size_info_invalid(tmp_path):
+    """Raise ValueError for files which can't be parsed"""
+    vmlinux = tmp_path / 'vmlinux'
+    vmlinux.write_bytes(b'\x7fELF' + b'\xff' * 60)
+    with pytest.raises(ValueError):
+        kernelci.elf.read_size_info(str(vmlinux))
+
+
+def test_elf_read_no_sections(tmp_path):
+    """Read a stripped ELF file without any section headers"""
+    vmlinux = tmp_path / 'vmlinux'
+    header = struct.pack('<' + kernelci.elf.ELF_HEADER[2],
+                         2, 62, 1, 0, 0, 0, 0, 64, 0, 0, 64, 0, 0)
+    vmlinux.write_bytes(b'\x7fELF' + bytes([2, 1, 1]) + bytes(9) + header)
+    with kernelci.elf.ElfFile(str(vmlinux)) as elf_file:
+        assert elf_file.sections == []
+        assert elf_file.get_section_by_name('.text') is None
+    assert kernelci.elf.read(str(vmlinux)) == {'vmlinux_data_size': 0}
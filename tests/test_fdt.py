@@ -0,0 +1,50 @@
+# Copyright (C) 2021 Collabora Limited
+# Author: Guillaume Tucker <guillaume.tucker@collabora.com>
+#
+# This module is free software; you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation; either version 2.1 of the License, or (at your option)
+# any later version.
+#
+# This library is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this library; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+import pytest
+
+import kernelci.fdt
+
+
+def _make_dtb(path, version, size_strings=0x40, size_struct=0x100):
+    header = kernelci.fdt.FDT_HEADER.pack(
+        kernelci.fdt.FDT_MAGIC, 0x200, 0x38, 0x138, 0x28, version, 2, 0,
+        size_strings, size_struct)
+    path.write_bytes(header + bytes(0x200 - len(header)))
+    return str(path)
+
+
+@pytest.mark.parametrize('version,sizes', [
+    (17, [0x200, 0x100, 0x40, 0x10]),
+    (16, [0x200, 0x100, 0x40, 0x10]),
+    (3, [0x200, 0x100, 0x40, 0x10]),
+    (2, [0x200, 0x100, None, 0x10]),
+    (1, [0x200, 0x100, None, 0x10]),
+])
+def test_read_sizes(tmp_path, version, sizes):
+    """Only report the header fields present in each version"""
+    size_struct = 0xff if version < 17 else 0x100
+    dtb = _make_dtb(tmp_path / 'board.dtb', version, size_struct=size_struct)
+    assert kernelci.fdt.read_sizes(dtb) == sizes
+
+
+def test_read_sizes_invalid(tmp_path):
+    """Raise ValueError for files which aren't device tree blobs"""
+    dtb = tmp_path / 'board.dtb'
+    dtb.write_bytes(bytes(64))
+    with pytest.raises(ValueError):
+        kernelci.fdt.read_sizes(str(dtb))
@@ -0,0 +1,77 @@
+# Copyright (C) 2021 Collabora Limited
+# Author: Guillaume Tucker <guillaume.tucker@collabora.com>
+#
+# This module is free software; you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation; either version 2.1 of the License, or (at your option)
+# any later version.
+#
+# This library is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this library; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+import http.server
+import threading
+
+import kernelci.http
+
+
+class FlakyHandler(http.server.BaseHTTPRequestHandler):
+    """Fail every other request with a 503 error"""
+
+    protocol_version = 'HTTP/1.1'
+
+    def _reply(self):
+        length = int(self.headers.get('Content-Length', 0))
+        self.rfile.read(length)
+        self.server.requests += 1
+        self.server.ports.add(self.client_address[1])
+        code = 503 if self.server.requests % 2 else 200
+        self.send_response(code)
+        self.send_header('Content-Length', '2')
+        self.end_headers()
+        self.wfile.write(b'OK')
+
+    def do_GET(self):
+        self._reply()
+
+    def do_POST(self):
+        self._reply()
+
+    def log_message(self, *args):
+        pass
+
+
+def test_session_retries_and_metrics():
+    """Retry idempotent requests, keep connections alive and count them"""
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), FlakyHandler)
+    server.requests = 0
+    server.ports = set()
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    session = kernelci.http.Session(backoff=0)
+    host = '127.0.0.1:{}'.format(server.server_port)
+    url = 'http://{}/'.format(host)
+    try:
+        gets = list(session.get(url).status_code for _ in range(5))
+        post = session.post(url).status_code
+    finally:
+        session.close()
+        server.shutdown()
+        thread.join()
+        server.server_close()
+
+    assert gets == [200] * 5
+    assert post == 503
+    assert server.requests == 11
+    assert len(server.ports) == 1
+    metrics = session.metrics[host]
+    assert metrics['requests'] == 6
+    assert metrics['retries'] == 5
+    assert metrics['http_errors'] == 1
+    assert metrics['errors'] == 0
@@ -0,0 +1,165 @@
+# Copyright (C) 2021 Collabora Limited
+# Author: Guillaume Tucker <guillaume.tucker@collabora.com>
+#
+# This module is free software; you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation; either version 2.1 of the License, or (at your option)
+# any later version.
+#
+# This library is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this library; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+import gzip
+import hashlib
+import io
+import os
+import time
+
+import pytest
+
+import kernelci.install
+
+
+def _make_src(tmp_path, data=b'artifact' * 10000):
+    src = tmp_path / 'src.bin'
+    src.write_bytes(data)
+    os.chmod(str(src), 0o755)
+    dst_dir = tmp_path / 'install'
+    dst_dir.mkdir()
+    return src, dst_dir / 'dst.bin'
+
+
+def test_install_hardlink(tmp_path):
+    """Share the inode with hard links and never write through them"""
+    src, dst = _make_src(tmp_path)
+    installer = kernelci.install.Installer('hardlink')
+    assert installer.install(str(src), str(dst))['method'] == 'hardlink'
+    assert os.stat(str(src)).st_ino == os.stat(str(dst)).st_ino
+
+    # Installing again with a copy must replace the link, not the source
+    other = tmp_path / 'other.bin'
+    other.write_bytes(b'other')
+    copier = kernelci.install.Installer('copy')
+    assert copier.install(str(other), str(dst))['method'] == 'copy'
+    assert dst.read_bytes() == b'other'
+    assert src.read_bytes() == b'artifact' * 10000
+    stats = installer.stats
+    assert (stats['files'], stats['hardlink'], stats['bytes_copied']) == \
+        (1, 1, 0)
+
+
+@pytest.mark.parametrize('mode', ['copy', 'auto', 'reflink'])
+def test_install_copy(tmp_path, mode):
+    """Get separate files, cloned when supported or copied otherwise"""
+    src, dst = _make_src(tmp_path)
+    installer = kernelci.install.Installer(mode)
+    method = installer.install(str(src), str(dst))['method']
+    if mode == 'copy':
+        assert method == 'copy'
+    else:
+        assert method in ('reflink', 'copy')
+    assert os.stat(str(src)).st_ino != os.stat(str(dst)).st_ino
+    assert dst.read_bytes() == src.read_bytes()
+    assert os.stat(str(dst)).st_mode == os.stat(str(src)).st_mode
+    stats = installer.stats
+    assert stats['files'] == 1
+    assert stats[method] == 1
+    assert stats['bytes'] == len(src.read_bytes())
+    assert stats['bytes_copied'] == (stats['bytes'] if method == 'copy'
+                                     else 0)
+
+
+def test_install_invalid_mode():
+    """Reject unknown install modes"""
+    with pytest.raises(ValueError):
+        kernelci.install.Installer('symlink')
+
+
+@pytest.mark.parametrize('mode', ['hardlink', 'copy', 'auto'])
+def test_install_checksum(tmp_path, mode):
+    """Return the size and checksum of what was installed"""
+    data = os.urandom(3 * kernelci.install.CHUNK_SIZE + 123)
+    src, dst = _make_src(tmp_path, data)
+    installed = kernelci.install.Installer(mode).install(str(src), str(dst))
+    installed_data = dst.read_bytes()
+    assert installed['size'] == len(installed_data) == len(data)
+    assert installed['sha256'] == hashlib.sha256(installed_data).hexdigest()
+
+
+@pytest.mark.parametrize('checksums', [True, False])
+def test_install_hardlink_checksums(tmp_path, checksums):
+    """Only read hard-linked files when their checksums are needed"""
+    src, dst = _make_src(tmp_path)
+    installer = kernelci.install.Installer('hardlink', checksums)
+    installed = installer.install(str(src), str(dst))
+    size = len(src.read_bytes())
+    assert installed['size'] == size
+    assert ('sha256' in installed) is checksums
+    stats = installer.stats
+    assert stats['bytes_copied'] == 0
+    assert stats['bytes_hashed'] == (size if checksums else 0)
+
+    # Copied files always get hashed as part of the copy
+    other = tmp_path / 'other.bin'
+    other.write_bytes(b'other')
+    copier = kernelci.install.Installer('copy', checksums)
+    assert 'sha256' in copier.install(str(other), str(dst))
+    assert copier.stats['bytes_hashed'] == 0
+
+
+def test_install_stream(tmp_path):
+    """Hash a stream while installing it"""
+    data = os.urandom(kernelci.install.CHUNK_SIZE + 1)
+    dst = tmp_path / 'stream.bin'
+    installed = kernelci.install.Installer().install_stream(
+        io.BytesIO(data), str(dst))
+    assert installed == {
+        'method': 'copy',
+        'size': len(data),
+        'sha256': hashlib.sha256(data).hexdigest(),
+    }
+    assert dst.read_bytes() == data
+
+
+def test_hash_reader_writer():
+    """Hash the data going through the file object wrappers"""
+    data = os.urandom(100000)
+    reader = kernelci.install.HashReader(io.BytesIO(data))
+    output = io.BytesIO()
+    writer = kernelci.install.HashWriter(output)
+    while True:
+        chunk = reader.read(4096)
+        if not chunk:
+            break
+        writer.write(chunk)
+    writer.flush()
+    checksum = hashlib.sha256(data).hexdigest()
+    assert (reader.size, reader.sha256) == (len(data), checksum)
+    assert (writer.size, writer.sha256) == (len(data), checksum)
+    assert output.getvalue() == data
+
+
+def test_install_gzip(tmp_path):
+    """Get the same compressed data for the same file at any time"""
+    data = b'Some text log\n' * 10000
+    src, dst = _make_src(tmp_path, data)
+    installer = kernelci.install.Installer()
+    first = installer.install_gzip(str(src), str(dst))
+    first_data = dst.read_bytes()
+    time.sleep(1.1)
+    os.utime(str(src))
+    second = installer.install_gzip(str(src), str(dst))
+    assert dst.read_bytes() == first_data
+    assert first == second
+    assert first['method'] == 'gzip'
+    assert first['original_size'] == len(data)
+    assert first['size'] == len(first_data) < len(data)
+    assert first['sha256'] == hashlib.sha256(first_data).hexdigest()
+    assert gzip.decompress(first_data) == data
+    assert installer.stats['gzip'] == 2
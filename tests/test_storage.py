@@ -0,0 +1,496 @@
+# Copyright (C) 2021 Collabora Limited
+# Author: Guillaume Tucker <guillaume.tucker@collabora.com>
+#
+# This module is free software; you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation; either version 2.1 of the License, or (at your option)
+# any later version.
+#
+# This library is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this library; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+import contextlib
+import hashlib
+import http.server
+import io
+import json
+import os
+import re
+import resource
+import threading
+import time
+
+import pytest
+
+import kernelci.http
+import kernelci.storage
+import kernelci.storage.devserver
+import kernelci.storage.uploader
+
+FILES = 30000
+DIRS = 100
+MAX_FDS = 256
+FILE_PART = re.compile(
+    rb'\r\nContent-Disposition: form-data; name="[^"]+"; filename="([^"]+)"'
+    rb'\r\n.*?\r\n\r\n(.*)\r\n$', re.DOTALL)
+
+
+class UploadHandler(http.server.BaseHTTPRequestHandler):
+
+    def do_POST(self):
+        length = int(self.headers['Content-Length'])
+        body = self.rfile.read(length)
+        boundary = self.headers['Content-Type'].split('boundary=')[1]
+        for part in body.split('--{}'.format(boundary).encode()):
+            match = FILE_PART.match(part)
+            if match:
+                self.server.files[match.group(1).decode()] = match.group(2)
+        self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class CountingLazyFile(kernelci.storage.LazyFile):
+    """LazyFile keeping track of how many files are open at the same time"""
+
+    open_files = set()
+    max_open = 0
+
+    def open(self):
+        cls = CountingLazyFile
+        opened = super().open()
+        cls.open_files.add(opened)
+        cls.max_open = max(cls.max_open, sum(
+            1 for open_file in cls.open_files if not open_file.closed))
+        return opened
+
+
+def test_multipart_encoder(tmp_path):
+    """Produce exactly the announced length with one open file at a time"""
+    lazy_paths = list(tmp_path / 'lazy-{}.bin'.format(index)
+                      for index in range(3))
+    for index, path in enumerate(lazy_paths):
+        path.write_bytes(bytes([index]) * (100000 + index))
+    plain = tmp_path / 'plain.bin'
+    plain.write_bytes(b'plain' * 1000)
+    with open(str(plain), 'rb') as plain_file:
+        plain_file.read(5)
+        files = {
+            'file{}'.format(index): (path.name, CountingLazyFile(str(path)))
+            for index, path in enumerate(lazy_paths)
+        }
+        files['bytes'] = ('bytes.bin', b'\0\r\n--')
+        files['str'] = ('str.txt', 'text')
+        files['plain'] = ('plain.bin', plain_file)
+        encoder = kernelci.storage.MultipartEncoder({'path': 'build'}, files)
+        chunks = []
+        while True:
+            chunk = encoder.read(7777)
+            if not chunk:
+                break
+            chunks.append(chunk)
+        encoder.close()
+    body = b''.join(chunks)
+
+    assert len(body) == len(encoder) == encoder.sent
+    assert CountingLazyFile.max_open == 1
+    assert all(open_file.closed for open_file in CountingLazyFile.open_files)
+    boundary = encoder.content_type.split('boundary=')[1].encode()
+    parts = dict()
+    for part in body.split(b'--' + boundary)[1:-1]:
+        header, data = part.split(b'\r\n\r\n', 1)
+        name = re.search(rb'name="([^"]+)"', header).group(1).decode()
+        parts[name] = data[:-2]
+    assert parts == {
+        'path': b'build',
+        'file0': lazy_paths[0].read_bytes(),
+        'file1': lazy_paths[1].read_bytes(),
+        'file2': lazy_paths[2].read_bytes(),
+        'bytes': b'\0\r\n--',
+        'str': b'text',
+        'plain': plain.read_bytes()[5:],
+    }
+
+
+def test_multipart_encoder_size_changed(tmp_path):
+    """Fail if a file gets shorter after the length was computed"""
+    path = tmp_path / 'data.bin'
+    path.write_bytes(bytes(1000))
+    encoder = kernelci.storage.MultipartEncoder({}, {
+        'file': ('data.bin', kernelci.storage.LazyFile(str(path))),
+    })
+    path.write_bytes(bytes(10))
+    with pytest.raises(OSError):
+        while encoder.read(100):
+            pass
+    encoder.close()
+
+
+def test_get_batches():
+    """Split files into batches up to the maximum size, in order"""
+    input_files = {
+        'a': b'a' * 40,
+        'b': b'b' * 40,
+        'c': 'c' * 30,
+        'big': b'x' * 150,
+        'd': b'd' * 10,
+    }
+    batches = kernelci.storage.get_batches(input_files, batch_size=100)
+    assert list(list(batch) for batch in batches) == [
+        ['a', 'b'], ['c'], ['big'], ['d'],
+    ]
+    assert kernelci.storage.get_batches({}) == []
+
+
+class FlakyUploadHandler(UploadHandler):
+    """Reply with the next status code listed for the first file name"""
+
+    def do_POST(self):
+        length = int(self.headers['Content-Length'])
+        body = self.rfile.read(length)
+        names = re.findall(rb'filename="([^"]+)"', body)
+        codes = self.server.codes.get(names[0].decode())
+        code = codes.pop(0) if codes else 200
+        self.server.requests.append(names[0].decode())
+        if code == 200:
+            self.server.files.update(
+                (name.decode(), True) for name in names)
+        self.send_response(code)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+
+def test_upload_retries():
+    """Retry on server errors, not on client errors, and report each file"""
+    server = http.server.ThreadingHTTPServer(
+        ('127.0.0.1', 0), FlakyUploadHandler)
+    server.files = {}
+    server.requests = []
+    server.codes = {
+        'flaky.bin': [500, 503],
+        'down.bin': [502] * 10,
+        'denied.bin': [403],
+    }
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    input_files = {
+        name: b'x' * 100
+        for name in ('flaky.bin', 'down.bin', 'denied.bin', 'ok.bin')
+    }
+    input_files['ok-2.bin'] = b'x' * 50
+    try:
+        report = kernelci.storage.upload_files(
+            'http://127.0.0.1:{}/'.format(server.server_port), 'token',
+            'build', input_files, batch_size=150, retries=2, backoff=0)
+    finally:
+        server.shutdown()
+        thread.join()
+        server.server_close()
+
+    assert sorted(report['failed']) == ['denied.bin', 'down.bin']
+    statuses = {
+        name: (status['status'], status['attempts'])
+        for name, status in report['files'].items()
+    }
+    assert statuses == {
+        'flaky.bin': ('PASS', 3),
+        'down.bin': ('FAIL', 3),
+        'denied.bin': ('FAIL', 1),
+        'ok.bin': ('PASS', 1),
+        'ok-2.bin': ('PASS', 1),
+    }
+    assert '403' in report['files']['denied.bin']['error']
+    assert '502' in report['files']['down.bin']['error']
+    assert sorted(server.files) == ['flaky.bin', 'ok-2.bin', 'ok.bin']
+    assert sorted(server.requests) == sorted(
+        ['flaky.bin'] * 3 + ['down.bin'] * 3 + ['denied.bin', 'ok.bin'])
+
+
+def test_upload_connection_error():
+    """Retry and report the files when the server can't be reached"""
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), UploadHandler)
+    port = server.server_port
+    server.server_close()
+    kernelci.http.configure(backoff=0)
+    try:
+        report = kernelci.storage.upload_files(
+            'http://127.0.0.1:{}/'.format(port), 'token', 'build',
+            {'a.bin': b'a', 'b.bin': b'b'}, retries=1, backoff=0)
+    finally:
+        kernelci.http.configure()
+    assert sorted(report['failed']) == ['a.bin', 'b.bin']
+    assert report['bytes'] == 0
+    for status in report['files'].values():
+        assert status['status'] == 'FAIL'
+        assert status['attempts'] == 2
+
+
+def test_upload_many_small_files(tmp_path):
+    """Upload more files than the maximum number of file descriptors"""
+    for index in range(FILES):
+        dir_path = tmp_path / 'dir-{}'.format(index % DIRS)
+        dir_path.mkdir(exist_ok=True)
+        (dir_path / 'file-{}'.format(index)).write_text(str(index))
+
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), UploadHandler)
+    server.files = {}
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    limits = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (MAX_FDS, limits[1]))
+    try:
+        artifacts = kernelci.storage.discover_files(str(tmp_path))
+        report = kernelci.storage.upload_files(
+            'http://127.0.0.1:{}/'.format(server.server_port), 'token',
+            'upload', artifacts, batch_size=64 * 1024)
+    finally:
+        resource.setrlimit(resource.RLIMIT_NOFILE, limits)
+        server.shutdown()
+        thread.join()
+        server.server_close()
+
+    assert not report['failed']
+    assert len(report['files']) == FILES
+    assert len(server.files) == FILES
+    for index in (0, FILES // 2, FILES - 1):
+        file_name = os.path.join(
+            'dir-{}'.format(index % DIRS), 'file-{}'.format(index))
+        assert server.files[file_name] == str(index).encode()
+
+
+def _upload_dedup(server, input_files, hashes=None):
+    return kernelci.storage.upload_dedup(
+        'http://127.0.0.1:{}/'.format(server.server_port), 'token',
+        'build', input_files, hashes)
+
+
+def test_upload_dedup(tmp_path):
+    """Only upload the blobs which are not already in the storage"""
+    install = tmp_path / 'install'
+    for index in range(20):
+        file_path = install / 'dtbs' / 'board-{}.dtb'.format(index)
+        file_path.parent.mkdir(parents=True, exist_ok=True)
+        file_path.write_bytes(str(index % 5).encode() * 1000)
+
+    server = kernelci.storage.devserver.StorageServer(
+        ('127.0.0.1', 0), str(tmp_path / 'storage'), 'token')
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    try:
+        artifacts = kernelci.storage.discover_files(str(install))
+        first = _upload_dedup(server, artifacts)
+        (install / 'dtbs' / 'board-0.dtb').write_bytes(b'new')
+        hashes = {
+            os.path.join('dtbs', 'board-1.dtb'):
+            kernelci.storage.get_sha256(b'1' * 1000),
+        }
+        second = _upload_dedup(server, artifacts, hashes)
+        bad = _upload_dedup(server, {'bad': b'bad'}, {'bad': '0' * 64})
+    finally:
+        server.shutdown()
+        thread.join()
+        server.server_close()
+
+    assert not first['failed']
+    assert first['dedup']['blobs'] == 5
+    assert first['dedup']['missing'] == 5
+    assert first['dedup']['bytes_skipped'] == 15 * 1000
+    assert not second['failed']
+    assert second['dedup']['missing'] == 1
+    assert second['bytes'] < first['bytes']
+    assert bad['failed'] == ['bad']
+    published = tmp_path / 'storage' / 'build' / 'dtbs'
+    assert (published / 'board-0.dtb').read_bytes() == b'new'
+    for index in range(1, 20):
+        data = (published / 'board-{}.dtb'.format(index)).read_bytes()
+        assert data == str(index % 5).encode() * 1000
+
+
+class BadDedupHandler(UploadHandler):
+    """Reply to the dedup requests with something unexpected"""
+
+    def do_POST(self):
+        if self.path not in ('/blobs/missing', '/manifest'):
+            return super().do_POST()
+        self.rfile.read(int(self.headers['Content-Length']))
+        body = self.server.replies.get(self.path, b'{"missing": []}')
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+@pytest.mark.parametrize('replies', [
+    {'/blobs/missing': b'<html>Not found</html>'},
+    {'/blobs/missing': b'{}'},
+    {'/blobs/missing': b'[]'},
+    {'/manifest': b'Server error'},
+])
+def test_upload_dedup_fallback(replies):
+    """Upload all the files if the storage doesn't reply as expected"""
+    server = http.server.ThreadingHTTPServer(
+        ('127.0.0.1', 0), BadDedupHandler)
+    server.files = {}
+    server.replies = replies
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    input_files = {'a.bin': b'a' * 100, 'b.bin': b'a' * 100}
+    try:
+        report = _upload_dedup(server, input_files)
+    finally:
+        server.shutdown()
+        thread.join()
+        server.server_close()
+
+    assert not report['failed']
+    assert sorted(report['files']) == ['a.bin', 'b.bin']
+    assert report['dedup']['bytes_skipped'] == 0
+    assert server.files == input_files
+
+
+def _wait_for(condition, timeout=10.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "Timeout"
+        time.sleep(0.05)
+
+
+@pytest.mark.parametrize('dedup', [False, True])
+def test_upload_queue(tmp_path, dedup):
+    """Upload queued files in the background and the meta-data last"""
+    output = tmp_path / 'output'
+    install = output / '_install_'
+    (install / 'dtbs').mkdir(parents=True)
+    files = list(os.path.join('dtbs', 'board-{}.dtb'.format(index))
+                 for index in range(5))
+    for name in files:
+        (install / name).write_bytes(name.encode())
+
+    server = kernelci.storage.devserver.StorageServer(
+        ('127.0.0.1', 0), str(tmp_path / 'storage'), 'token')
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    api = 'http://127.0.0.1:{}/'.format(server.server_port)
+    queue = kernelci.storage.uploader.UploadQueue(str(output))
+    queue.create()
+    daemon = threading.Thread(
+        target=kernelci.storage.uploader.run_daemon,
+        args=(str(output), str(install), api, 'token'),
+        kwargs={'poll_interval': 0.1, 'dedup': dedup})
+    daemon.start()
+    published = tmp_path / 'storage' / 'build'
+    try:
+        queue.add('build', files + ['bmeta.json'], {
+            name: hashlib.sha256(name.encode()).hexdigest()
+            for name in files
+        })
+        _wait_for(lambda: not queue.get_pending())
+        background = sorted(published.rglob('*'))
+        (install / files[0]).write_bytes(b'changed')
+        (install / 'bmeta.json').write_text('{}')
+        report = kernelci.storage.uploader.push_queued(
+            str(output), str(install), api, 'token', 'build',
+            poll_interval=0.1, dedup=dedup)
+        daemon.join()
+    finally:
+        server.shutdown()
+        thread.join()
+        server.server_close()
+
+    assert background == [published / 'dtbs'] + list(
+        published / name for name in files)
+    assert not report['failed']
+    assert sorted(report['files']) == ['bmeta.json', files[0]]
+    assert (published / files[0]).read_bytes() == b'changed'
+    assert (published / 'bmeta.json').read_text() == '{}'
+    assert ('dedup' in report) is dedup
+
+
+def test_storage_truncated_upload(tmp_path):
+    """Don't keep any temporary file after a truncated upload"""
+    storage = kernelci.storage.devserver.Storage(str(tmp_path))
+    body = b'--b\r\nContent-Disposition: form-data; name="file0"; ' \
+        b'filename="data.bin"\r\n\r\n' + bytes(1000)
+    reader = kernelci.storage.devserver.MultipartReader(
+        io.BytesIO(body), len(body), 'b')
+    path = storage.get_path('build', 'data.bin')
+    with pytest.raises(ValueError):
+        for _, data in reader:
+            storage.put_file(path, data)
+    assert os.listdir(os.path.dirname(path)) == []
+
+
+@contextlib.contextmanager
+def _devserver(tmp_path, **kwargs):
+    server = kernelci.storage.devserver.StorageServer(
+        ('127.0.0.1', 0), str(tmp_path / 'storage'), 'token', **kwargs)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    try:
+        yield 'http://127.0.0.1:{}/'.format(server.server_port)
+    finally:
+        server.shutdown()
+        thread.join()
+        server.server_close()
+
+
+@pytest.mark.parametrize('endpoint', ['build', 'test', 'bisect'])
+def test_devserver_submit(tmp_path, endpoint):
+    """Store the data sent to the backend API endpoints"""
+    data = {'job': 'mainline', 'status': 'PASS'}
+    with _devserver(tmp_path) as api:
+        url = api + endpoint
+        resp = kernelci.http.post(
+            url, json=data, headers={'Authorization': 'token'})
+        denied = kernelci.http.post(
+            url, json=data, headers={'Authorization': 'bad'})
+        invalid = kernelci.http.post(
+            url, data='{', headers={'Authorization': 'token'})
+
+    assert resp.status_code == 201
+    data_id = resp.json()['result'][0]['_id']
+    data_path = tmp_path / 'storage' / kernelci.storage.devserver.DATA_DIR
+    stored = data_path / endpoint / '{}.json'.format(data_id)
+    assert json.loads(stored.read_text()) == data
+    assert denied.status_code == 401
+    assert invalid.status_code == 400
+    assert len(os.listdir(str(data_path / endpoint))) == 1
+
+
+def test_devserver_latency(tmp_path):
+    """Delay each request by the latency"""
+    latency = 0.2
+    with _devserver(tmp_path, latency=latency) as api:
+        start = time.monotonic()
+        for _ in range(2):
+            resp = kernelci.http.head(api + 'missing.bin')
+            assert resp.status_code == 404
+        duration = time.monotonic() - start
+    assert duration >= 2 * latency
+
+
+def test_devserver_bandwidth(tmp_path):
+    """Limit the bandwidth in each direction"""
+    bandwidth = 200 * 1024
+    data = os.urandom(100 * 1024)
+    with _devserver(tmp_path, bandwidth=bandwidth) as api:
+        start = time.monotonic()
+        report = kernelci.storage.upload_files(
+            api, 'token', 'build', {'data.bin': data})
+        uploaded = time.monotonic()
+        resp = kernelci.http.get(api + 'build/data.bin')
+        downloaded = time.monotonic()
+
+    assert not report['failed']
+    assert resp.content == data
+    assert uploaded - start >= len(data) / bandwidth * 0.9
+    assert downloaded - uploaded >= len(data) / bandwidth * 0.9
@@ -0,0 +1,92 @@
+# Copyright (C) 2021 Collabora Limited
+# Author: Guillaume Tucker <guillaume.tucker@collabora.com>
+#
+# This module is free software; you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation; either version 2.1 of the License, or (at your option)
+# any later version.
+#
+# This library is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this library; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+import http.server
+import threading
+
+import kernelci.test
+
+
+class ArtifactHandler(http.server.BaseHTTPRequestHandler):
+    """Only the paths starting with /ok/ exist"""
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_HEAD(self):
+        self.server.paths.append(self.path)
+        self.send_response(200 if self.path.startswith('/ok/') else 404)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+def test_get_missing_urls():
+    """Check each artifact URL once for all the jobs"""
+    server = http.server.ThreadingHTTPServer(
+        ('127.0.0.1', 0), ArtifactHandler)
+    server.paths = []
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    base = 'http://127.0.0.1:{}/'.format(server.server_port)
+    params_list = list({
+        'kernel_url': base + 'ok/Image',
+        'dtb_url': base + ('ok/board.dtb' if index % 2 else 'missing.dtb'),
+        'modules_url': None,
+    } for index in range(100))
+    checker = kernelci.test.URLChecker()
+    try:
+        missing = kernelci.test.get_missing_urls(params_list, checker)
+        cached = kernelci.test.get_missing_urls(params_list, checker)
+    finally:
+        server.shutdown()
+        thread.join()
+        server.server_close()
+
+    assert missing == cached
+    assert sorted(server.paths) == ['/missing.dtb', '/ok/Image',
+                                    '/ok/board.dtb']
+    for index, job_missing in enumerate(missing):
+        if index % 2:
+            assert job_missing == {}
+        else:
+            assert job_missing == {'dtb_url': base + 'missing.dtb'}
+
+
+def test_get_missing_urls_optional():
+    """Don't require optional artifacts such as the kselftest index"""
+    server = http.server.ThreadingHTTPServer(
+        ('127.0.0.1', 0), ArtifactHandler)
+    server.paths = []
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    base = 'http://127.0.0.1:{}/'.format(server.server_port)
+    params = {
+        'kernel_url': base + 'ok/Image',
+        'kselftests_url': base + 'ok/kselftest.tar.xz',
+        'kselftests_index_url': base + 'kselftest.tar.xz.index.json',
+    }
+    try:
+        missing = kernelci.test.get_missing_urls([params])
+    finally:
+        server.shutdown()
+        thread.join()
+        server.server_close()
+
+    assert missing == [{}]
+    assert sorted(server.paths) == ['/ok/Image', '/ok/kselftest.tar.xz']